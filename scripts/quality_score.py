@@ -10,13 +10,28 @@ Usage:
     python scripts/quality_score.py scripts/python/analysis.py
     python scripts/quality_score.py scripts/stata/analysis.do
     python scripts/quality_score.py slides/*.tex --summary
+    python scripts/quality_score.py slides/ scripts/ --summary
+
+Cross-file indexes are cached in .claude/state/quality_score/.
+
+Library use (no temp files):
+    from quality_score import score_content, score_batch
+    report = score_content(buffer, 'beamer', name='slides/Lecture01.tex')
 """
 
+import os
 import sys
 import argparse
+import bisect
+import hashlib
+import queue
+import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import re
 import json
 
@@ -29,6 +44,7 @@ BEAMER_RUBRIC = {
         'compilation_failure': {'points': 100, 'auto_fail': True},
         'undefined_citation': {'points': 15},
         'overfull_hbox': {'points': 10},
+        'missing_asset': {'points': 15},
     },
     'major': {
         'text_overflow': {'points': 5},
@@ -36,12 +52,16 @@ BEAMER_RUBRIC = {
         'label_title': {'points': 3},
         'generic_closing': {'points': 5},
         'slide_overload': {'points': 3},
+        'lint_error': {'points': 3},
+        'diverging_duplicate': {'points': 3},
     },
     'minor': {
         'font_size_reduction': {'points': 1},
         'orphan_runt': {'points': 2},
         'box_fatigue': {'points': 2},
         'generic_opening': {'points': 2},
+        'style_violation': {'points': 1},
+        'duplicate_slide': {'points': 1},
     }
 }
 
@@ -55,6 +75,8 @@ PYTHON_RUBRIC = {
         'missing_seed': {'points': 10},
         'missing_docstring': {'points': 5},
         'no_main_guard': {'points': 3},
+        'lint_error': {'points': 3},
+        'duplicate_code': {'points': 3},
     },
     'minor': {
         'style_violation': {'points': 1},
@@ -67,14 +89,21 @@ STATA_RUBRIC = {
         'syntax_error': {'points': 100, 'auto_fail': True},
         'hardcoded_path': {'points': 20},
         'missing_clear_all': {'points': 20},
+        'runtime_error': {'points': 20},
+        'missing_dependency': {'points': 20},
     },
     'major': {
         'missing_set_seed': {'points': 10},
         'missing_header': {'points': 10},
         'missing_log': {'points': 5},
+        'convergence_warning': {'points': 5},
+        'lint_error': {'points': 3},
+        'duplicate_code': {'points': 3},
+        'undefined_global': {'points': 5},
     },
     'minor': {
         'style_violation': {'points': 1},
+        'dropped_observations': {'points': 1},
     }
 }
 
@@ -84,6 +113,334 @@ THRESHOLDS = {
     'excellence': 95
 }
 
+# Cost model for --budget-ms: (fixed ms, ms per 10k characters), measured
+# on typical decks and scripts. The Python syntax check pays for a subprocess.
+DETECTOR_COSTS = {
+    'latex_syntax': (0.0, 1.0),
+    'citations': (0.5, 0.5),
+    'overfull_hbox': (0.0, 0.5),
+    'equation_overflow': (0.0, 0.8),
+    'orphan_runts': (0.0, 1.5),
+    'rhetoric': (0.0, 2.0),
+    'layout': (0.2, 4.0),
+    'assets': (2.0, 0.5),
+    'notation': (5.0, 3.0),
+    'duplicates': (5.0, 4.0),
+    'python_syntax': (60.0, 0.5),
+    'python_compile': (0.2, 2.0),
+    'hardcoded_paths': (0.0, 1.0),
+    'python_quality': (0.0, 1.5),
+    'stata_basics': (0.0, 0.5),
+    'duplicate_code': (5.0, 5.0),
+    'stata_pipeline': (0.0, 0.0),  # issues come precomputed from the call graph
+    'stata_logs': (50.0, 0.0),  # dominated by the log's size, not the do-file's
+    'external': (150.0, 1.0),  # subprocesses; near zero on a cache hit
+}
+
+
+# Checks that can auto-fail a file: under a budget they always run, and run first
+AUTO_FAIL_CHECKS = frozenset({'latex_syntax', 'python_syntax', 'python_compile'})
+
+
+def detector_cost(name: str, size: int) -> float:
+    """Estimated runtime in ms of detector `name` on `size` characters."""
+    fixed, per_10k = DETECTOR_COSTS.get(name, (1.0, 1.0))
+    return fixed + per_10k * size / 10000
+
+# ==============================================================================
+# PROJECT HELPERS (root discovery, on-disk caches)
+# ==============================================================================
+
+CACHE_DIR = Path('.claude') / 'state' / 'quality_score'
+# Long-lived sessions (editor integrations) re-check on-disk inputs of
+# session-held indexes at most this often
+INDEX_RECHECK_SECONDS = 1.0
+
+
+def find_project_root(path: Path) -> Path:
+    """Return the nearest ancestor of `path` containing `.git`.
+
+    Falls back to the file's own directory when no repository is found.
+    """
+    path = path.resolve()
+    start = path if path.is_dir() else path.parent
+    for candidate in (start, *start.parents):
+        if (candidate / '.git').exists():
+            return candidate
+    return start
+
+
+def parse_bib_keys(bib_content: str) -> set:
+    """Entry keys defined in a BibTeX file."""
+    return set(re.findall(r'@\w+\{([^,]+),', bib_content))
+
+
+def file_signature(path: Path) -> Optional[List[int]]:
+    """Cheap change detector: [mtime_ns, size], or None if unreadable."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+# Bytes CP1252 leaves undefined; their presence means Latin-1 (or binary)
+_CP1252_UNDEFINED = re.compile(rb'[\x81\x8d\x8f\x90\x9d]')
+
+
+def decode_source(data: bytes) -> str:
+    """Decode source bytes once, sniffing ASCII, UTF-8, CP1252 or Latin-1.
+
+    ASCII is a single C-level scan; otherwise UTF-8 (with or without a
+    BOM) is tried, and legacy files fall back to CP1252, or Latin-1 when
+    they use bytes CP1252 leaves undefined. Never raises.
+    """
+    if data.isascii():
+        return data.decode('ascii')
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('latin-1' if _CP1252_UNDEFINED.search(data) else 'cp1252')
+
+
+def read_source(path: Path) -> str:
+    """Read a source file as text whatever its (ASCII-compatible) encoding."""
+    return decode_source(path.read_bytes())
+
+
+def relative_key(path: Path, root: Path) -> str:
+    """Stable posix key for `path` relative to the project root."""
+    try:
+        return path.resolve().relative_to(root).as_posix()
+    except ValueError:
+        return path.resolve().as_posix()
+
+
+class JsonCache:
+    """Versioned JSON store under `.claude/state/quality_score/`.
+
+    Caches are best-effort: unreadable, stale-version or unwritable
+    files are treated as empty rather than failing the score.
+    """
+
+    def __init__(self, root: Path, name: str, version: int):
+        self.path = root / CACHE_DIR / f'{name}.json'
+        self.version = version
+
+    def load(self) -> Dict:
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return {}
+        return data.get('data', {})
+
+    def save(self, data: Dict) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Per-process temp name: concurrent runs (e.g. shards) must not share it
+            tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+            tmp.write_text(json.dumps({'version': self.version, 'data': data}),
+                           encoding='utf-8')
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+# ==============================================================================
+# ISSUE RECORDS (compact; text rendered on demand)
+# ==============================================================================
+
+# code -> (rubric type, points, description template, details template).
+# Templates are filled from the issue's args ({0}, {1}, ...) and {line}.
+ISSUE_CODES = {
+    # Beamer
+    'latex_syntax': ('compilation_failure', 100,
+                     'LaTeX syntax issue at line {line}', '{0}'),
+    'undefined_citation': ('undefined_citation', 15,
+                           'Citation key not in bibliography: {0}',
+                           'Add to bibliography.bib or fix key'),
+    'overfull_hbox': ('overfull_hbox', 10,
+                      'Potential overfull hbox at line {line}',
+                      'Line >120 chars inside frame may overflow slide width'),
+    'equation_overflow': ('overfull_hbox', 10,
+                          'Potential equation overflow at line {line}',
+                          'Single equation line >120 chars likely to overflow'),
+    'missing_figure': ('missing_asset', 15,
+                       'Missing figure `{0}` at line {line}',
+                       'Not found relative to the deck, \\graphicspath or the '
+                       'project root; check figures/ and project/'),
+    'missing_input': ('missing_asset', 15,
+                      'Missing input file `{0}` at line {line}',
+                      'Not found relative to the deck or the project root'),
+    'asset_case_mismatch': ('missing_asset', 15,
+                            'Missing {1} `{0}` at line {line}',
+                            'Did you mean `{2}`? Case differs; this breaks '
+                            'on case-sensitive systems (Linux, Overleaf)'),
+    'orphan_runt': ('orphan_runt', 2,
+                    'Orphan/runt word at line {line}',
+                    'Short word alone on last line of text block; '
+                    'rephrase to pull it back to the previous line'),
+    'label_title': ('label_title', 3,
+                    'Label title "{0}" at line {line} (slide {1})',
+                    'Slide titles should be assertions, not labels. '
+                    'E.g., "Treatment increased distance by 61 miles" '
+                    'instead of "Results"'),
+    'generic_closing': ('generic_closing', 5,
+                        'Generic closing slide "{0}" at line {line}',
+                        'End with a takeaway, call to action, or thought-provoking '
+                        'question instead of a generic closing'),
+    'slide_overload': ('slide_overload', 3,
+                       'Slide overload ({0} items) at line {line} (slide {1})',
+                       'Frame has {0} \\item entries. '
+                       'One idea per slide; split into multiple slides'),
+    'box_fatigue': ('box_fatigue', 2,
+                    'Box fatigue ({0} boxes) at line {line} (slide {1})',
+                    'Frame has {0} colored box environments. '
+                    'Limit to one per slide to avoid visual clutter'),
+    'generic_opening': ('generic_opening', 2,
+                        'Generic opening slide "{0}" at line {line}',
+                        'First content slide should grab attention and establish '
+                        'stakes, not list an agenda'),
+    'text_overflow': ('text_overflow', 5,
+                      'Estimated text overflow at line {line} (slide {1})',
+                      'Content fills ~{0}% of the frame height. '
+                      'Split the slide or cut content'),
+    'font_size_reduction': ('font_size_reduction', 1,
+                            'Font size reduction ({0}) at line {line} (slide {1})',
+                            'Shrinking text to fit is a sign of overload; '
+                            'cut content instead'),
+    'notation_inconsistency': ('notation_inconsistency', 3,
+                               'Inconsistent notation `{0}` at line {line}',
+                               'Series convention is `{1}` ({2} deck(s)); '
+                               'use one form everywhere'),
+    'notation_macro': ('notation_inconsistency', 3,
+                       'Inconsistent notation `{0}` at line {line}',
+                       'Preamble defines `{1}`; use the macro instead of writing it out'),
+    'duplicate_slide': ('duplicate_slide', 1,
+                        'Duplicate slide at line {line} (slide {0})',
+                        'Identical to {1} slide {2} (line {3}); keep one copy, '
+                        'e.g. in a shared file pulled in with \\input'),
+    'diverging_duplicate': ('diverging_duplicate', 3,
+                            'Near-duplicate slide at line {line} (slide {0})',
+                            '{4}% similar to {1} slide {2} (line {3}); the copies '
+                            'have diverged, reconcile them and keep one source'),
+    # Python
+    'python_syntax': ('syntax_error', 100, 'Python syntax error', '{0}'),
+    'hardcoded_path': ('hardcoded_path', 20,
+                       'Hardcoded absolute path at line {line}',
+                       'Use relative paths or Path() objects'),
+    'missing_import': ('missing_import', 10,
+                       '`{0}` used but `{1}` not imported',
+                       'Add `import {1}` or appropriate import statement'),
+    'missing_seed': ('missing_seed', 10,
+                     'Missing random seed for reproducibility',
+                     'Add np.random.seed() or random.seed() at top of script'),
+    'missing_docstring': ('missing_docstring', 5,
+                          'Missing module-level docstring',
+                          'Add a docstring describing the script purpose'),
+    'no_main_guard': ('no_main_guard', 3,
+                      'Missing `if __name__ == "__main__"` guard',
+                      'Add main guard for importability'),
+    'duplicate_code': ('duplicate_code', 3,
+                       'Duplicated code at lines {0}-{1}',
+                       'Also in `{2}` lines {3}-{4}; factor it into a shared function '
+                       'or program so fixes apply everywhere'),
+    # Stata
+    'hardcoded_path_stata': ('hardcoded_path', 20,
+                             'Hardcoded absolute path at line {line}',
+                             'Use global macros ($root, $data, etc.)'),
+    'missing_clear_all': ('missing_clear_all', 10,
+                          'Missing `clear all` near top of file',
+                          'Add `clear all` after header block'),
+    'missing_header': ('missing_header', 5,
+                       'Missing header comment block',
+                       'Add header with purpose, author, date'),
+    'missing_log': ('missing_log', 5,
+                    'No log file opened',
+                    'Add `log using scripts/stata/logs/filename.smcl, replace`'),
+    'missing_set_seed': ('missing_set_seed', 10,
+                         'Missing `set seed` for reproducibility',
+                         'Add `set seed YYYYMMDD` after `clear all`'),
+    # External checkers (--checkers): args are (tool, tool code, message)
+    'external_undefined_name': ('missing_import', 10,
+                                '{0} {1} at line {line}', '{2}'),
+    'external_error': ('lint_error', 3, '{0} {1} at line {line}', '{2}'),
+    'external_long_line': ('long_line', 1, '{0} {1} at line {line}', '{2}'),
+    'external_warning': ('style_violation', 1, '{0} {1} at line {line}', '{2}'),
+    # Stata pipeline (--stata-pipeline)
+    'missing_do_file': ('missing_dependency', 20,
+                        'Called do-file not found: {0}',
+                        'Line {line}: the pipeline stops here with r(601); fix the path '
+                        'or the global it is built from'),
+    'undefined_global': ('undefined_global', 5,
+                         'Global ${0} used before any caller defines it',
+                         'Line {line}: define it in the master do-file before this '
+                         'script is called'),
+    # Stata logs (--stata-logs)
+    'stata_runtime_error': ('runtime_error', 20,
+                            'Stata error r({0}) running `{1}` at line {line}',
+                            '{2} (log {3}, line {4})'),
+    'convergence_warning': ('convergence_warning', 5,
+                            'Convergence warning running `{0}` at line {line}',
+                            '{1} (log {2}, line {3})'),
+    'dropped_observations': ('dropped_observations', 1,
+                             '{0} observation(s) deleted by `{1}` at line {line}',
+                             'Check the drop is intended (log {2}, line {3})'),
+}
+
+
+class Issue:
+    """One detected issue: a code from ISSUE_CODES, a line and parameters.
+
+    Descriptions are rendered only when read, so a corpus run holds one
+    small slotted record per issue instead of formatted message strings.
+    Supports `issue['description']`-style access for report consumers.
+    """
+
+    __slots__ = ('code', 'line', 'args')
+
+    def __init__(self, code: str, line: int = 0, args: tuple = ()):
+        self.code = code
+        self.line = line
+        self.args = args
+
+    @property
+    def type(self) -> str:
+        return ISSUE_CODES[self.code][0]
+
+    @property
+    def points(self) -> int:
+        return ISSUE_CODES[self.code][1]
+
+    @property
+    def description(self) -> str:
+        return ISSUE_CODES[self.code][2].format(*self.args, line=self.line)
+
+    @property
+    def details(self) -> str:
+        return ISSUE_CODES[self.code][3].format(*self.args, line=self.line)
+
+    def __getitem__(self, key: str):
+        if key not in ('type', 'points', 'description', 'details', 'line'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self) -> Dict:
+        return {'type': self.type, 'description': self.description,
+                'details': self.details, 'points': self.points, 'line': self.line}
+
+    def __repr__(self) -> str:
+        return f'Issue({self.code!r}, {self.line}, {self.args!r})'
+
+
+def json_default(obj):
+    """`json.dumps` hook that renders Issue records."""
+    if isinstance(obj, Issue):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
 # ==============================================================================
 # ISSUE DETECTION (Lightweight checks - full agents run separately)
 # ==============================================================================
@@ -110,58 +467,88 @@ class IssueDetector:
             return False, "Python not found"
 
     @staticmethod
-    def check_stata_basics(content: str) -> Dict[str, List]:
-        """Check Stata .do file for basic quality issues."""
+    def check_python_source(content: Union[str, bytes], name: str) -> Tuple[bool, str]:
+        """Check in-memory Python source for syntax errors with compile().
+
+        Bytes are decoded by compile() itself, honoring PEP 263 coding lines.
+        """
+        try:
+            compile(content, name, 'exec')
+        except (SyntaxError, ValueError) as e:
+            return False, f'{type(e).__name__}: {e}'
+        return True, ""
+
+    @staticmethod
+    def check_stata_basics(content: Union[str, bytes],
+                           inherited: Optional[Dict[str, bool]] = None) -> Dict[str, List['Issue']]:
+        """Check Stata .do file for basic quality issues.
+
+        All patterns are ASCII, so this runs on the raw bytes of the file
+        whatever its encoding (bytes.lower() only folds ASCII letters);
+        text is encoded as UTF-8 first. `inherited` marks settings
+        (clear/seed/log) a calling do-file has already established; those
+        are not required again.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
         issues = {'critical': [], 'major': [], 'minor': []}
-        lines = content.split('\n')
+        inherited = inherited or {}
+        lines = content.split(b'\n')
+        lowered = content.lower()
 
         # Check for clear all in first 20 lines
-        header_region = '\n'.join(lines[:20]).lower()
-        if 'clear all' not in header_region:
-            issues['critical'].append({
-                'type': 'missing_clear_all',
-                'description': 'Missing `clear all` near top of file',
-                'details': 'Add `clear all` after header block',
-                'points': 10
-            })
+        header_region = b'\n'.join(lines[:20]).lower()
+        if not inherited.get('clear') and b'clear all' not in header_region:
+            issues['critical'].append(Issue('missing_clear_all'))
 
         # Check for header block (comments in first 5 lines)
-        first_lines = '\n'.join(lines[:5])
-        if not re.search(r'^\s*(\*|//)', first_lines, re.MULTILINE):
-            issues['major'].append({
-                'type': 'missing_header',
-                'description': 'Missing header comment block',
-                'details': 'Add header with purpose, author, date',
-                'points': 5
-            })
+        first_lines = b'\n'.join(lines[:5])
+        if not re.search(rb'^\s*(\*|//)', first_lines, re.MULTILINE):
+            issues['major'].append(Issue('missing_header'))
 
         # Check for log usage
-        if 'log using' not in content.lower() and 'cmdlog using' not in content.lower():
-            issues['major'].append({
-                'type': 'missing_log',
-                'description': 'No log file opened',
-                'details': 'Add `log using scripts/stata/logs/filename.smcl, replace`',
-                'points': 5
-            })
+        if (not inherited.get('log')
+                and b'log using' not in lowered and b'cmdlog using' not in lowered):
+            issues['major'].append(Issue('missing_log'))
 
         # Check for set seed if randomness detected
-        random_cmds = ['simulate', 'bootstrap', 'permute', 'sample', 'bsample', 'drawnorm']
-        has_random = any(cmd in content.lower() for cmd in random_cmds)
-        if has_random and 'set seed' not in content.lower():
-            issues['major'].append({
-                'type': 'missing_set_seed',
-                'description': 'Missing `set seed` for reproducibility',
-                'details': 'Add `set seed YYYYMMDD` after `clear all`',
-                'points': 10
-            })
+        random_cmds = [b'simulate', b'bootstrap', b'permute', b'sample', b'bsample', b'drawnorm']
+        has_random = any(cmd in lowered for cmd in random_cmds)
+        if has_random and not inherited.get('seed') and b'set seed' not in lowered:
+            issues['major'].append(Issue('missing_set_seed'))
 
         return issues
 
     @staticmethod
-    def check_python_quality(content: str) -> Dict[str, List]:
-        """Check Python script for quality issues."""
+    def check_stata_pipeline(issues: List['Issue']) -> Dict[str, List['Issue']]:
+        """Sort call-graph issues (see StataPipeline) into rubric severities."""
+        found = {'critical': [], 'major': [], 'minor': []}
+        for issue in issues:
+            severity = next(s for s, rules in STATA_RUBRIC.items() if issue.type in rules)
+            found[severity].append(issue)
+        return found
+
+    @staticmethod
+    def check_stata_logs(do_file: Path, content: bytes, root: Path) -> Dict[str, List['Issue']]:
+        """Errors, convergence warnings and dropped observations from the do-file's log.
+
+        Uses the newest log not older than the do-file; stale logs are skipped.
+        """
+        logs = find_stata_logs(do_file, content, root)
+        if not logs:
+            return {'critical': [], 'major': [], 'minor': []}
+        try:
+            return StataLogScanner(content).scan(logs[0], relative_key(logs[0], root))
+        except OSError:
+            return {'critical': [], 'major': [], 'minor': []}
+
+    @staticmethod
+    def check_python_quality(content: Union[str, bytes]) -> Dict[str, List['Issue']]:
+        """Check Python script for quality issues (ASCII patterns over raw bytes)."""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
         issues = {'critical': [], 'major': [], 'minor': []}
-        lines = content.split('\n')
+        lines = content.split(b'\n')
 
         # Check for missing imports (common libraries used but not imported)
         common_modules = {
@@ -169,82 +556,64 @@ class IssueDetector:
             'sns': 'seaborn', 'sm': 'statsmodels', 'os': 'os', 'sys': 'sys',
             'Path': 'pathlib', 're': 're', 'json': 'json',
         }
-        import_lines = [l for l in lines if l.strip().startswith(('import ', 'from '))]
-        import_block = '\n'.join(import_lines)
+        import_lines = [l for l in lines if l.strip().startswith((b'import ', b'from '))]
+        import_block = b'\n'.join(import_lines)
         for alias, module in common_modules.items():
             # Check if alias is used in code (as prefix with dot, or Path() call)
-            usage_pat = re.compile(rf'\b{re.escape(alias)}[.(]')
+            usage_pat = re.compile(rb'\b' + re.escape(alias.encode()) + rb'[.(]')
             if usage_pat.search(content):
-                if alias not in import_block and module not in import_block:
-                    issues['critical'].append({
-                        'type': 'missing_import',
-                        'description': f'`{alias}` used but `{module}` not imported',
-                        'details': f'Add `import {module}` or appropriate import statement',
-                        'points': 10
-                    })
+                if alias.encode() not in import_block and module.encode() not in import_block:
+                    issues['critical'].append(Issue('missing_import', 0, (alias, module)))
                     break  # One deduction is enough
 
         # Check for missing seed if randomness detected
-        random_fns = ['np.random', 'random.', 'torch.manual_seed', 'sklearn']
+        random_fns = [b'np.random', b'random.', b'torch.manual_seed', b'sklearn']
         has_random = any(fn in content for fn in random_fns)
-        seed_patterns = ['np.random.seed', 'random.seed', 'torch.manual_seed',
-                         'np.random.default_rng', 'RandomState']
+        seed_patterns = [b'np.random.seed', b'random.seed', b'torch.manual_seed',
+                         b'np.random.default_rng', b'RandomState']
         has_seed = any(pat in content for pat in seed_patterns)
         if has_random and not has_seed:
-            issues['major'].append({
-                'type': 'missing_seed',
-                'description': 'Missing random seed for reproducibility',
-                'details': 'Add np.random.seed() or random.seed() at top of script',
-                'points': 10
-            })
+            issues['major'].append(Issue('missing_seed'))
 
         # Check for docstring at module level
         stripped = content.lstrip()
-        if not (stripped.startswith('"""') or stripped.startswith("'''")):
+        if not (stripped.startswith(b'"""') or stripped.startswith(b"'''")):
             # Check if it starts with comments or imports before checking for docstring
             has_docstring = False
             for line in lines:
                 l = line.strip()
-                if l == '' or l.startswith('#') or l.startswith('#!/'):
+                if l == b'' or l.startswith(b'#') or l.startswith(b'#!/'):
                     continue
-                if l.startswith('"""') or l.startswith("'''"):
+                if l.startswith(b'"""') or l.startswith(b"'''"):
                     has_docstring = True
                 break
             if not has_docstring:
-                issues['major'].append({
-                    'type': 'missing_docstring',
-                    'description': 'Missing module-level docstring',
-                    'details': 'Add a docstring describing the script purpose',
-                    'points': 5
-                })
+                issues['major'].append(Issue('missing_docstring'))
 
         # Check for if __name__ == "__main__" guard
-        if 'def main' in content or 'def run' in content:
-            if '__name__' not in content:
-                issues['major'].append({
-                    'type': 'no_main_guard',
-                    'description': 'Missing `if __name__ == "__main__"` guard',
-                    'details': 'Add main guard for importability',
-                    'points': 3
-                })
+        if b'def main' in content or b'def run' in content:
+            if b'__name__' not in content:
+                issues['major'].append(Issue('no_main_guard'))
 
         return issues
 
     @staticmethod
-    def check_hardcoded_paths(content: str) -> List[int]:
-        """Detect absolute paths in scripts."""
+    def check_hardcoded_paths(content: Union[str, bytes]) -> List[int]:
+        """Detect absolute paths in scripts (ASCII patterns over raw bytes)."""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
         issues = []
-        lines = content.split('\n')
+        lines = content.split(b'\n')
 
         for i, line in enumerate(lines, 1):
             # Skip comment lines
             stripped = line.strip()
-            if stripped.startswith('#') or stripped.startswith('*') or stripped.startswith('//'):
+            if stripped.startswith(b'#') or stripped.startswith(b'*') or stripped.startswith(b'//'):
                 continue
-            if re.search(r'["\'][/\\](?:Users|home|tmp|var|etc)[/\\]', line):
+            if re.search(rb'["\'][/\\](?:Users|home|tmp|var|etc)[/\\]', line):
                 issues.append(i)
-            elif re.search(r'["\'][A-Za-z]:[/\\]', line):
-                if not re.search(r'http:|https:', line):
+            elif re.search(rb'["\'][A-Za-z]:[/\\]', line):
+                if not re.search(rb'http:|https:', line):
                     issues.append(i)
 
         return issues
@@ -297,19 +666,23 @@ class IssueDetector:
         return overflows
 
     @staticmethod
-    def check_broken_citations(content: str, bib_file: Path) -> List[str]:
-        """Check for LaTeX citation keys not in bibliography."""
-        cite_pattern = r'\\cite[a-z]*\{([^}]+)\}'
+    def check_broken_citations(content: str, bib_file: Path,
+                               bib_keys: Optional[set] = None) -> List[str]:
+        """Check for LaTeX citation keys not in bibliography.
+
+        `bib_keys` lets callers reuse an already-parsed bibliography.
+        """
+        cite_pattern = r'\\cite[a-z]*\{([^}]{1,2000})\}'
         cited_keys = set()
         for match in re.finditer(cite_pattern, content):
             keys = match.group(1).split(',')
             cited_keys.update(k.strip() for k in keys)
 
-        if not bib_file.exists():
-            return list(cited_keys)
-
-        bib_content = bib_file.read_text(encoding='utf-8')
-        bib_keys = set(re.findall(r'@\w+\{([^,]+),', bib_content))
+        if bib_keys is None:
+            if not bib_file.exists():
+                return list(cited_keys)
+            bib_content = read_source(bib_file)
+            bib_keys = parse_bib_keys(bib_content)
 
         broken = cited_keys - bib_keys
         return list(broken)
@@ -353,13 +726,15 @@ class IssueDetector:
         return issues
 
     @staticmethod
-    def check_orphan_runts(content: str) -> List[int]:
+    def check_orphan_runts(content: str, macros: Optional['MacroIndex'] = None) -> List[int]:
         """Detect orphan/runt words in Beamer frames.
 
         A runt is a single word or very short phrase (<10 chars) that
         sits alone on the final line of a paragraph or bullet point.
         Flagged only inside frames, only when the preceding line is
         substantial text (>=30 chars), indicating the word spilled over.
+        Lines opening with a preamble-defined command (`macros`) are
+        treated as structure, not prose.
         """
         issues = []
         lines = content.split('\n')
@@ -368,14 +743,7 @@ class IssueDetector:
         in_tabular = False
         in_lstlisting = False
         # LaTeX structural commands that start a line and are not prose
-        struct_re = re.compile(
-            r'^\s*\\(begin|end|item|section|subsection|frametitle'
-            r'|includegraphics|input|vspace|hspace|centering'
-            r'|column|textbf|textit|label|ref|cite|caption'
-            r'|draw|node|fill|path|coordinate'  # TikZ
-            r'|toprule|midrule|bottomrule'       # booktabs
-            r')\b'
-        )
+        struct_re = (macros or MacroIndex()).struct_re
 
         for i, line in enumerate(lines, 1):
             raw = line.split('%')[0] if '%' in line else line
@@ -445,38 +813,65 @@ class IssueDetector:
         return issues
 
     @staticmethod
-    def _parse_frames(content: str) -> List[Dict]:
+    def _match_frame_begin(stripped: str) -> Optional[Tuple[str, str]]:
+        """Split a `\\begin{frame}[opts]{Title}` line into (opts, title).
+
+        Linear-time equivalent of matching
+        `\\begin\\{frame\\}(\\[.*?\\])?(\\{(.+?)\\})?\\s*$`, which backtracks
+        quadratically on lines with many `]{` pairs. Returns None when the
+        line is not a frame opener.
+        """
+        if not stripped.startswith('\\begin{frame}'):
+            return None
+        rest = stripped[len('\\begin{frame}'):]
+        opts = ''
+        if rest.startswith('['):
+            close = rest.find(']{')
+            if rest.endswith('}') and close != -1:
+                opts, rest = rest[:close + 1], rest[close + 1:]
+            elif rest.endswith(']'):
+                return rest, ''
+            else:
+                return None
+        if not rest.strip():
+            return opts, ''
+        if rest.startswith('{') and rest.endswith('}') and len(rest) > 2:
+            return opts, rest[1:-1].strip()
+        return None
+
+    @staticmethod
+    def _parse_frames(content: str, macros: Optional['MacroIndex'] = None) -> List[Dict]:
         """Parse Beamer frames into structured dicts for rhetoric checks.
 
+        Preamble commands in `macros` are unwrapped from titles.
+
         Returns list of dicts with keys:
             index, title, title_line, start_line, end_line,
-            body, is_standout, is_title_page
+            body, options, is_standout, is_title_page
         """
         frames = []
         lines = content.split('\n')
         # Regex to strip simple LaTeX formatting commands from titles
-        strip_cmd_re = re.compile(r'\\(?:textbf|textit|emph|textrm|textsf|texttt)\{([^}]*)\}')
-        strip_color_re = re.compile(r'\\(?:color|textcolor)\{[^}]*\}\{([^}]*)\}')
+        # (argument lengths are bounded so unclosed braces cannot backtrack)
+        strip_cmd_re = re.compile(
+            r'\\(?:textbf|textit|emph|textrm|textsf|texttt)\{([^}]{0,500})\}')
+        strip_color_re = re.compile(
+            r'\\(?:color|textcolor)\{[^}]{0,100}\}\{([^}]{0,500})\}')
 
         i = 0
         while i < len(lines):
             raw = lines[i]
             stripped = raw.strip()
 
-            # Match \begin{frame} variants
-            m = re.match(r'\\begin\{frame\}(\[.*?\])?\{(.+?)\}\s*$', stripped)
-            if not m:
-                m = re.match(r'\\begin\{frame\}(\[.*?\])?\s*$', stripped)
-                if m:
-                    # Title may come from \frametitle on a subsequent line
-                    pass
-                else:
-                    i += 1
-                    continue
+            # Match \begin{frame} variants (title may instead come from
+            # \frametitle on a subsequent line)
+            m = IssueDetector._match_frame_begin(stripped)
+            if m is None:
+                i += 1
+                continue
 
             start_line = i + 1  # 1-indexed
-            opts = m.group(1) or '' if m.lastindex and m.lastindex >= 1 else ''
-            title = m.group(2).strip() if m.lastindex and m.lastindex >= 2 else ''
+            opts, title = m
             title_line = start_line if title else 0
             is_standout = 'standout' in opts
 
@@ -501,6 +896,8 @@ class IssueDetector:
             # Strip LaTeX formatting from title for clean matching
             clean_title = strip_cmd_re.sub(r'\1', title)
             clean_title = strip_color_re.sub(r'\1', clean_title)
+            if macros is not None:
+                clean_title = macros.strip_title(clean_title)
             clean_title = re.sub(r'[{}\\]', '', clean_title).strip()
 
             # Detect title page: contains \titlepage or \maketitle
@@ -515,6 +912,7 @@ class IssueDetector:
                 'start_line': start_line,
                 'end_line': end_line,
                 'body': body,
+                'options': opts,
                 'is_standout': is_standout,
                 'is_title_page': is_title_page,
             })
@@ -524,7 +922,7 @@ class IssueDetector:
         return frames
 
     @staticmethod
-    def check_label_titles(frames: List[Dict]) -> List[Dict]:
+    def check_label_titles(frames: List[Dict]) -> List['Issue']:
         """Detect slide titles that are labels instead of assertions."""
         label_words = re.compile(
             r'^(results?|methods?|methodology|data|introduction|background|'
@@ -542,21 +940,12 @@ class IssueDetector:
                 continue
             # Check the cleaned title against known label words
             if label_words.match(frame['title']):
-                issues.append({
-                    'type': 'label_title',
-                    'description': (
-                        f'Label title "{frame["title"]}" at line '
-                        f'{frame["title_line"]} (slide {frame["index"] + 1})'
-                    ),
-                    'details': 'Slide titles should be assertions, not labels. '
-                               'E.g., "Treatment increased distance by 61 miles" '
-                               'instead of "Results"',
-                    'points': 3,
-                })
+                issues.append(Issue('label_title', frame['title_line'],
+                                    (frame['title'], frame['index'] + 1)))
         return issues
 
     @staticmethod
-    def check_generic_closing(frames: List[Dict]) -> List[Dict]:
+    def check_generic_closing(frames: List[Dict]) -> List['Issue']:
         """Detect generic closing slides like 'Questions?' or 'Thank You'."""
         if len(frames) < 3:
             return []
@@ -567,20 +956,11 @@ class IssueDetector:
             re.IGNORECASE,
         )
         if generic_re.match(last['title']):
-            return [{
-                'type': 'generic_closing',
-                'description': (
-                    f'Generic closing slide "{last["title"]}" at line '
-                    f'{last["start_line"]}'
-                ),
-                'details': 'End with a takeaway, call to action, or thought-provoking '
-                           'question instead of a generic closing',
-                'points': 5,
-            }]
+            return [Issue('generic_closing', last['start_line'], (last['title'],))]
         return []
 
     @staticmethod
-    def check_slide_overload(frames: List[Dict]) -> List[Dict]:
+    def check_slide_overload(frames: List[Dict]) -> List['Issue']:
         """Detect frames with 8+ \\item entries."""
         issues = []
         for frame in frames:
@@ -588,23 +968,21 @@ class IssueDetector:
                 continue
             item_count = len(re.findall(r'\\item\b', frame['body']))
             if item_count >= 8:
-                issues.append({
-                    'type': 'slide_overload',
-                    'description': (
-                        f'Slide overload ({item_count} items) at line '
-                        f'{frame["start_line"]} (slide {frame["index"] + 1})'
-                    ),
-                    'details': f'Frame has {item_count} \\item entries. '
-                               'One idea per slide; split into multiple slides',
-                    'points': 3,
-                })
+                issues.append(Issue('slide_overload', frame['start_line'],
+                                    (item_count, frame['index'] + 1)))
         return issues
 
     @staticmethod
-    def check_box_fatigue(frames: List[Dict]) -> List[Dict]:
-        """Detect frames with 2+ colored box environments."""
+    def check_box_fatigue(frames: List[Dict],
+                          macros: Optional['MacroIndex'] = None) -> List['Issue']:
+        """Detect frames with 2+ colored box environments.
+
+        Box environments are the defaults plus any `\\newtcolorbox` (or
+        box-drawing `\\newenvironment`) found in the preamble index.
+        """
+        box_envs = (macros or MacroIndex()).box_envs
         box_re = re.compile(
-            r'\\begin\{(keybox|highlightbox|definitionbox|methodbox)\}'
+            r'\\begin\{(' + '|'.join(re.escape(env) for env in box_envs) + r')\}'
         )
         issues = []
         for frame in frames:
@@ -612,20 +990,12 @@ class IssueDetector:
                 continue
             box_count = len(box_re.findall(frame['body']))
             if box_count >= 2:
-                issues.append({
-                    'type': 'box_fatigue',
-                    'description': (
-                        f'Box fatigue ({box_count} boxes) at line '
-                        f'{frame["start_line"]} (slide {frame["index"] + 1})'
-                    ),
-                    'details': f'Frame has {box_count} colored box environments. '
-                               'Limit to one per slide to avoid visual clutter',
-                    'points': 2,
-                })
+                issues.append(Issue('box_fatigue', frame['start_line'],
+                                    (box_count, frame['index'] + 1)))
         return issues
 
     @staticmethod
-    def check_generic_opening(frames: List[Dict]) -> List[Dict]:
+    def check_generic_opening(frames: List[Dict]) -> List['Issue']:
         """Detect generic opening slides like 'Outline' or 'Agenda'."""
         if len(frames) < 4:
             return []
@@ -643,18 +1013,104 @@ class IssueDetector:
             re.IGNORECASE,
         )
         if generic_re.match(first_content['title']):
-            return [{
-                'type': 'generic_opening',
-                'description': (
-                    f'Generic opening slide "{first_content["title"]}" at line '
-                    f'{first_content["start_line"]}'
-                ),
-                'details': 'First content slide should grab attention and establish '
-                           'stakes, not list an agenda',
-                'points': 2,
-            }]
+            return [Issue('generic_opening', first_content['start_line'],
+                          (first_content['title'],))]
         return []
 
+    @staticmethod
+    def check_text_overflow(frames: List[Dict], estimates: List[Dict]) -> List['Issue']:
+        """Detect frames whose estimated content height exceeds the slide."""
+        issues = []
+        for frame, est in zip(frames, estimates):
+            if frame['is_title_page'] or not est['overflow']:
+                continue
+            fill = round(100 * est['height'] / est['available'])
+            issues.append(Issue('text_overflow', frame['start_line'],
+                                (fill, frame['index'] + 1)))
+        return issues
+
+    @staticmethod
+    def check_font_size_reduction(frames: List[Dict], estimates: List[Dict]) -> List['Issue']:
+        """Detect frames that shrink text (\\small and below, \\resizebox, shrink)."""
+        issues = []
+        for frame, est in zip(frames, estimates):
+            if frame['is_title_page'] or not est['reductions']:
+                continue
+            cmd, line = est['reductions'][0]
+            issues.append(Issue('font_size_reduction', line, (cmd, frame['index'] + 1)))
+        return issues
+
+    @staticmethod
+    def check_missing_assets(content: str, deck_dir: str, index: 'AssetIndex') -> List['Issue']:
+        """Detect \\includegraphics/\\input targets that do not resolve to a file.
+
+        Targets are searched relative to the deck directory, each
+        \\graphicspath entry and the project root, with LaTeX's extension
+        inference. `deck_dir` is the deck's directory relative to the root.
+        """
+        text = _strip_comments(content)
+        graphics_dirs = []
+        for m in _GRAPHICSPATH_RE.finditer(text):
+            for path in re.findall(r'\{([^{}]*)\}', m.group(1)):
+                graphics_dirs.append(os.path.join(deck_dir, path))
+        newlines = [m.start() for m in re.finditer('\n', text)]
+        issues = []
+        for m in _ASSET_REF_RE.finditer(text):
+            kind, target = m.group(1), m.group(2).strip()
+            if not target or '\\' in target or '#' in target:
+                continue  # macro-built paths cannot be resolved statically
+            search = [deck_dir] + (graphics_dirs if kind == 'includegraphics' else []) + ['']
+            found, suggestion = index.resolve(target, kind, search)
+            if found:
+                continue
+            line = bisect.bisect_right(newlines, m.start()) + 1
+            what = 'figure' if kind == 'includegraphics' else 'input file'
+            if suggestion:
+                issues.append(Issue('asset_case_mismatch', line, (target, what, suggestion)))
+            elif kind == 'includegraphics':
+                issues.append(Issue('missing_figure', line, (target,)))
+            else:
+                issues.append(Issue('missing_input', line, (target,)))
+        return issues
+
+    @staticmethod
+    def check_notation_consistency(index: 'NotationIndex', deck: str) -> List['Issue']:
+        """Detect math notation that differs from the rest of the lecture series."""
+        issues = []
+        for found in index.inconsistencies(deck):
+            if found['macro']:
+                issues.append(Issue('notation_macro', found['line'],
+                                    (found['form'], found['preferred'])))
+            else:
+                issues.append(Issue('notation_inconsistency', found['line'],
+                                    (found['form'], found['preferred'], found['decks'])))
+        return issues
+
+    @staticmethod
+    def check_duplicate_slides(index: 'SlideIndex', deck: str) -> Dict[str, List['Issue']]:
+        """Detect frames copied within or across decks of the series.
+
+        Diverging near-copies are major (one copy is likely stale); exact
+        copies are minor.
+        """
+        issues = {'critical': [], 'major': [], 'minor': []}
+        for dup in index.duplicates(deck):
+            args = (dup['slide'], dup['deck'], dup['other_slide'], dup['other_line'],
+                    round(dup['similarity'] * 100))
+            if dup['identical']:
+                issues['minor'].append(Issue('duplicate_slide', dup['line'], args))
+            else:
+                issues['major'].append(Issue('diverging_duplicate', dup['line'], args))
+        return issues
+
+    @staticmethod
+    def check_duplicate_code(index: 'CodeIndex', key: str) -> List['Issue']:
+        """Detect code regions copy-pasted from (or into) other scripts."""
+        return [Issue('duplicate_code', dup['first'],
+                      (dup['first'], dup['last'], dup['other'],
+                       dup['other_first'], dup['other_last']))
+                for dup in index.duplicates(key)]
+
     @staticmethod
     def check_overfull_hbox_risk(content: str) -> List[int]:
         """Detect lines in LaTeX source likely to cause overfull hbox."""
@@ -680,16 +1136,2783 @@ class IssueDetector:
         return issues
 
 
+# ==============================================================================
+# NOTATION INDEX (cross-deck math notation, updated incrementally)
+# ==============================================================================
+
+_COMMENT_RE = re.compile(r'(?<!\\)%[^\n]*')
+_MATH_ENVS = r'equation|align|gather|multline|eqnarray|displaymath|math'
+# `\\` and `\$` are consumed first so `\\[2pt]` and escaped dollars never
+# open a math span.
+_MATH_DELIM_RE = re.compile(
+    r'\\\\|\\\$|\$\$|\$|\\\[|\\\]|\\\(|\\\)'
+    r'|\\begin\{(?:' + _MATH_ENVS + r')\*?\}'
+    r'|\\end\{(?:' + _MATH_ENVS + r')\*?\}'
+)
+_MATH_CLOSERS = {'$': '$', '$$': '$$', '\\[': '\\]', '\\(': '\\)'}
+_ATOM = r'(\\[A-Za-z]+|[A-Za-z0-9])'
+_SCRIPT_RE = re.compile(
+    r'(\\[A-Za-z]+|[A-Za-z])\s*([_^])\s*(?:\{\s*' + _ATOM + r'\s*\}|' + _ATOM + r')'
+)
+_ACCENT_RE = re.compile(
+    r'\\(hat|bar|tilde|vec|dot|ddot|check|breve|widehat|widetilde)(?![A-Za-z])'
+    r'\s*(?:\{\s*' + _ATOM + r'\s*\}|' + _ATOM + r')'
+)
+_LETTER_RE = re.compile(r'\\(var)?(epsilon|phi|theta|rho)(?![A-Za-z])')
+_MACRO_DEF_RE = re.compile(
+    r'\\(?:newcommand|renewcommand|providecommand)\*?\s*\{?\s*\\([A-Za-z]+)\s*\}?'
+    r'\s*(?:\[(\d)\])?\s*(?:\[[^\]\n]{0,200}\])?\s*\{'
+)
+_ENV_DEF_RE = re.compile(
+    r'\\(?:newenvironment|renewenvironment)\*?\s*\{\s*([A-Za-z]+\*?)\s*\}'
+    r'\s*(?:\[\d\])?\s*(?:\[[^\]\n]{0,200}\])?\s*\{'
+    r'|\\(?:newtcolorbox|renewtcolorbox|NewTColorBox|DeclareTColorBox)\s*'
+    r'(?:\[[^\]\n]{0,200}\])?\s*\{\s*([A-Za-z]+\*?)\s*\}'
+)
+# Begin code of a \newenvironment that draws a coloured box
+_BOX_BODY_RE = re.compile(r'tcolorbox|tcbitemize|\\begin\{(?:alert|example)?block\}'
+                          r'|colorbox|mdframed|framed')
+_MATHOP_DEF_RE = re.compile(
+    r'\\DeclareMathOperator\*?\s*\{\s*\\([A-Za-z]+)\s*\}\s*\{([^{}]*)\}'
+)
+
+
+def _strip_comments(text: str) -> str:
+    """Drop unescaped `%` comments, keeping line structure intact."""
+    return _COMMENT_RE.sub('', text)
+
+
+def _read_braced(text: str, pos: int) -> Tuple[str, int]:
+    """Return (inner, end) for the brace group opened just before `pos`.
+
+    Unbalanced groups end at EOF, so callers never loop past the text.
+    """
+    depth = 1
+    i = pos
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return text[pos:i], i + 1
+        i += 1
+    return text[pos:], n
+
+
+def math_spans(text: str) -> List[Tuple[int, int]]:
+    """Return (start, end) offsets of inline and display math in `text`."""
+    spans = []
+    opener = None
+    closer = None
+    open_end = 0
+    for m in _MATH_DELIM_RE.finditer(text):
+        tok = m.group(0)
+        if tok in ('\\\\', '\\$'):
+            continue
+        if opener is None:
+            if tok in _MATH_CLOSERS:
+                opener, closer = tok, _MATH_CLOSERS[tok]
+            elif tok.startswith('\\begin'):
+                opener, closer = tok, '\\end' + tok[len('\\begin'):]
+            else:
+                continue
+            open_end = m.end()
+        elif tok == closer:
+            spans.append((open_end, m.start()))
+            opener = closer = None
+    return spans
+
+
+class NotationIndex:
+    """Inverted index of math notation variants across a lecture series.
+
+    Each deck contributes postings `key -> variant -> count`, where a key
+    names one piece of notation (`script:\\beta_i`, `letter:epsilon`,
+    `macro:E`) and a variant is one way of writing it (`bare`/`braced`,
+    `epsilon`/`varepsilon`, `macro`/`expanded`). Decks are re-extracted only
+    when their mtime/size and content hash change, so refreshing a full
+    series after editing one deck touches a single file.
+    """
+
+    VERSION = 2
+
+    def __init__(self, root: Path, macros: Optional[Dict[str, List[str]]] = None):
+        self.root = root
+        self.macros = MacroIndex(root).math if macros is None else macros
+        self._cache = JsonCache(root, 'notation_index', self.VERSION)
+        stored = self._cache.load()
+        macro_sig = hashlib.sha1(
+            json.dumps(self.macros, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        # A changed preamble changes what counts as `expanded`: start over
+        self.decks = stored.get('decks', {}) if stored.get('macros') == macro_sig else {}
+        self._macro_sig = macro_sig
+        self._dirty = False
+        self._postings = {}
+        self._forms = {}
+        for deck, entry in self.decks.items():
+            self._add_postings(deck, entry['uses'])
+
+    # -- extraction -----------------------------------------------------------
+
+    def extract(self, content: str) -> Dict[str, Dict[str, list]]:
+        """Return `key -> variant -> [count, first_line, form]` for one deck."""
+        text = _strip_comments(content)
+        newlines = [m.start() for m in re.finditer('\n', text)]
+        uses = {}
+
+        def record(key, variant, form, offset):
+            by_variant = uses.setdefault(key, {})
+            entry = by_variant.get(variant)
+            if entry is None:
+                line = bisect.bisect_right(newlines, offset) + 1
+                by_variant[variant] = [1, line, form]
+            else:
+                entry[0] += 1
+
+        spans = math_spans(text)
+        for start, end in spans:
+            span = text[start:end]
+            for m in _SCRIPT_RE.finditer(span):
+                base, op = m.group(1), m.group(2)
+                arg = m.group(3) or m.group(4)
+                braced = m.group(3) is not None
+                record(f'script:{base}{op}{arg}', 'braced' if braced else 'bare',
+                       f'{base}{op}{{{arg}}}' if braced else f'{base}{op}{arg}',
+                       start + m.start())
+            for m in _ACCENT_RE.finditer(span):
+                acc = m.group(1)
+                arg = m.group(2) or m.group(3)
+                braced = m.group(2) is not None
+                sep = '' if arg.startswith('\\') else ' '
+                record(f'accent:{acc} {arg}', 'braced' if braced else 'bare',
+                       f'\\{acc}{{{arg}}}' if braced else f'\\{acc}{sep}{arg}',
+                       start + m.start())
+            for m in _LETTER_RE.finditer(span):
+                variant = (m.group(1) or '') + m.group(2)
+                record(f'letter:{m.group(2)}', variant, f'\\{variant}',
+                       start + m.start())
+
+        for name, expansions in self.macros.items():
+            for m in re.finditer(r'\\' + name + r'(?![A-Za-z])', text):
+                record(f'macro:{name}', 'macro', f'\\{name}', m.start())
+            # Bodies are only notation inside math: `\course` -> "Development
+            # Economics" in prose is not an expanded use of the macro
+            for body in expansions:
+                for start, end in spans:
+                    pos = text.find(body, start, end)
+                    while pos != -1:
+                        record(f'macro:{name}', 'expanded', body, pos)
+                        pos = text.find(body, pos + len(body), end)
+        return uses
+
+    # -- index maintenance ----------------------------------------------------
+
+    def _add_postings(self, deck: str, uses: Dict) -> None:
+        for key, variants in uses.items():
+            by_variant = self._postings.setdefault(key, {})
+            for variant, (count, _line, form) in variants.items():
+                by_variant.setdefault(variant, {})[deck] = count
+                self._forms.setdefault((key, variant), form)
+
+    def _remove_postings(self, deck: str) -> None:
+        entry = self.decks.get(deck)
+        if not entry:
+            return
+        for key, variants in entry['uses'].items():
+            by_variant = self._postings.get(key, {})
+            for variant in variants:
+                decks = by_variant.get(variant, {})
+                decks.pop(deck, None)
+                if not decks:
+                    by_variant.pop(variant, None)
+                    self._forms.pop((key, variant), None)
+            if not by_variant:
+                self._postings.pop(key, None)
+
+    def update_deck(self, deck: str, content: str, signature: Optional[List[int]]) -> None:
+        """Index `content` as `deck`, skipping work if its hash is unchanged."""
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        entry = self.decks.get(deck)
+        if entry and entry['sha1'] == digest:
+            if entry['sig'] != signature:
+                entry['sig'] = signature
+                self._dirty = True
+            return
+        self._remove_postings(deck)
+        uses = self.extract(content)
+        self.decks[deck] = {'sig': signature, 'sha1': digest, 'uses': uses}
+        self._add_postings(deck, uses)
+        self._dirty = True
+
+    def restore_deck(self, deck: str, entry: Optional[Dict]) -> None:
+        """Put back `deck` as `entry` (None drops it) once a buffer has been scored."""
+        self._remove_postings(deck)
+        if entry is None:
+            self.decks.pop(deck, None)
+        else:
+            self.decks[deck] = entry
+            self._add_postings(deck, entry['uses'])
+
+    def refresh(self, directory: Path, skip: Optional[str] = None) -> None:
+        """Bring every `*.tex` deck in `directory` up to date and drop deleted ones.
+
+        `skip` names a deck just indexed from memory (e.g. an unsaved buffer)
+        that must not be overwritten by its on-disk version.
+        """
+        seen = {skip}
+        for path in sorted(directory.glob('*.tex')):
+            deck = relative_key(path, self.root)
+            seen.add(deck)
+            if deck == skip:
+                continue
+            signature = file_signature(path)
+            entry = self.decks.get(deck)
+            if entry and entry['sig'] == signature:
+                continue
+            try:
+                content = read_source(path)
+            except OSError:
+                continue
+            self.update_deck(deck, content, signature)
+        # Decks elsewhere in the series are kept until their file is deleted
+        for deck in list(self.decks):
+            if deck not in seen and not (self.root / deck).exists():
+                self._remove_postings(deck)
+                del self.decks[deck]
+                self._dirty = True
+
+    def save(self) -> None:
+        if self._dirty:
+            self._cache.save({'macros': self._macro_sig, 'decks': self.decks})
+            self._dirty = False
+
+    # -- queries --------------------------------------------------------------
+
+    def preferred_variant(self, key: str) -> str:
+        """Series-wide convention for `key`: most decks, then most uses."""
+        if key.startswith('macro:'):
+            return 'macro'
+        variants = self._postings.get(key, {})
+        return min(variants, key=lambda v: (-len(variants[v]),
+                                            -sum(variants[v].values()), v))
+
+    def inconsistencies(self, deck: str) -> List[Dict]:
+        """Notation in `deck` that departs from the series convention."""
+        entry = self.decks.get(deck)
+        if not entry:
+            return []
+        found = []
+        for key, variants in entry['uses'].items():
+            if key.startswith('macro:'):
+                if 'expanded' not in variants:
+                    continue
+            elif len(self._postings.get(key, {})) < 2:
+                continue
+            preferred = self.preferred_variant(key)
+            for variant, (_count, line, form) in sorted(variants.items()):
+                if variant == preferred:
+                    continue
+                found.append({
+                    'line': line,
+                    'form': form,
+                    'preferred': self._forms.get((key, preferred), f'\\{key[6:]}'),
+                    'decks': len(self._postings.get(key, {}).get(preferred, {})),
+                    'macro': key.startswith('macro:'),
+                })
+                break
+        return sorted(found, key=lambda f: f['line'])
+
+
+# ==============================================================================
+# PREAMBLE MACRO INDEX (custom commands and environments, cached)
+# ==============================================================================
+
+# Colored box environments recognized even without a preamble
+DEFAULT_BOX_ENVS = ('keybox', 'highlightbox', 'definitionbox', 'methodbox')
+# Built-in commands that start a non-prose line (see check_orphan_runts)
+STRUCT_COMMANDS = (
+    'begin', 'end', 'item', 'section', 'subsection', 'frametitle',
+    'includegraphics', 'input', 'vspace', 'hspace', 'centering',
+    'column', 'textbf', 'textit', 'label', 'ref', 'cite', 'caption',
+    'draw', 'node', 'fill', 'path', 'coordinate',  # TikZ
+    'toprule', 'midrule', 'bottomrule',            # booktabs
+)
+
+
+class MacroIndex:
+    """`\\newcommand`/`\\newenvironment`/`\\newtcolorbox` definitions of a project.
+
+    Built from `preambles/*.tex` and cached in `.claude/state/quality_score/`
+    keyed by the preambles' mtime/size, so a run re-reads them only after
+    an edit. `commands` maps names to argument counts, `environments` maps
+    names to `'box'` or `'env'`, and `math` holds the zero-argument macros
+    used by the notation index. Decks with definitions of their own get a
+    merged copy from `for_document`.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root: Optional[Path] = None):
+        self.commands: Dict[str, int] = {}
+        self.environments: Dict[str, str] = {}
+        self.math: Dict[str, List[str]] = {}
+        self._struct_re = None
+        self._title_re = None
+        self.root = root
+        self.checked = time.monotonic()
+        if root is None:
+            return
+        files, sigs = self._preambles()
+        self._sigs = sigs
+        cache = JsonCache(root, 'macro_index', self.VERSION)
+        stored = cache.load()
+        if stored.get('files') == sigs:
+            self.commands = stored['commands']
+            self.environments = stored['environments']
+            self.math = stored['math']
+            return
+        for path in files:
+            try:
+                self.add_definitions(read_source(path))
+            except OSError:
+                continue
+        cache.save({'files': sigs, 'commands': self.commands,
+                    'environments': self.environments, 'math': self.math})
+
+    def _preambles(self) -> Tuple[List[Path], Dict[str, Optional[List[int]]]]:
+        files = sorted((self.root / 'preambles').glob('*.tex'))
+        return files, {relative_key(path, self.root): file_signature(path) for path in files}
+
+    def current(self) -> bool:
+        """False once a preamble was edited, added or removed since the build.
+
+        Checked at most every INDEX_RECHECK_SECONDS.
+        """
+        if self.root is None or time.monotonic() - self.checked < INDEX_RECHECK_SECONDS:
+            return True
+        self.checked = time.monotonic()
+        return self._preambles()[1] == self._sigs
+
+    def add_definitions(self, text: str) -> None:
+        """Record the definitions found in LaTeX source `text`."""
+        text = _strip_comments(text)
+        for m in _MACRO_DEF_RE.finditer(text):
+            name, nargs = m.group(1), int(m.group(2) or 0)
+            self.commands[name] = nargs
+            body, _ = _read_braced(text, m.end())
+            body = body.strip()
+            if not nargs and '#' not in body and len(body) >= 3:
+                self.math[name] = [body]
+        for m in _MATHOP_DEF_RE.finditer(text):
+            self.commands[m.group(1)] = 0
+            name = m.group(2).strip()
+            if name:
+                self.math[m.group(1)] = [f'\\operatorname{{{name}}}',
+                                         f'\\mathrm{{{name}}}', f'\\text{{{name}}}']
+        for m in _ENV_DEF_RE.finditer(text):
+            if m.group(2):
+                self.environments[m.group(2)] = 'box'
+                continue
+            begin, _ = _read_braced(text, m.end())
+            self.environments[m.group(1)] = 'box' if _BOX_BODY_RE.search(begin) else 'env'
+        self._struct_re = self._title_re = None
+
+    def for_document(self, content: str) -> 'MacroIndex':
+        """This index plus definitions in `content`'s own preamble, if any."""
+        head = content.split('\\begin{document}', 1)[0]
+        if not re.search(r'\\(?:new|renew|provide)(?:command|environment|tcolorbox)'
+                         r'|\\DeclareMathOperator', head):
+            return self
+        merged = MacroIndex()
+        merged.commands = dict(self.commands)
+        merged.environments = dict(self.environments)
+        merged.math = dict(self.math)
+        merged.add_definitions(head)
+        return merged
+
+    @property
+    def box_envs(self) -> List[str]:
+        return sorted(set(DEFAULT_BOX_ENVS)
+                      | {name for name, kind in self.environments.items() if kind == 'box'})
+
+    @property
+    def struct_re(self):
+        """Matches a line starting with a structural or preamble-defined command."""
+        if self._struct_re is None:
+            names = sorted(set(STRUCT_COMMANDS) | set(self.commands),
+                           key=len, reverse=True)
+            self._struct_re = re.compile(r'^\s*\\(' + '|'.join(names) + r')\b')
+        return self._struct_re
+
+    def strip_title(self, title: str) -> str:
+        """Replace preamble commands in a title by their last argument.
+
+        `\\hl{Results}` becomes `Results`; argument-less macros vanish.
+        """
+        if not self.commands:
+            return title
+        if self._title_re is None:
+            names = sorted(self.commands, key=len, reverse=True)
+            self._title_re = re.compile(
+                r'\\(' + '|'.join(names) + r')(?![A-Za-z])((?:\s*\{[^{}]{0,500}\})*)')
+
+        def expand(m):
+            nargs = self.commands[m.group(1)]
+            if not nargs:
+                return m.group(2)
+            groups = re.findall(r'\s*\{[^{}]*\}', m.group(2))
+            args, rest = groups[:nargs], groups[nargs:]
+            return (args[-1].strip()[1:-1] if args else '') + ''.join(rest)
+
+        return self._title_re.sub(expand, title)
+
+
+# ==============================================================================
+# ASSET INDEX (figures/ and project/ listings, cached with mtime invalidation)
+# ==============================================================================
+
+GRAPHICS_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.eps', '.mps', '.jbig2')
+_ASSET_REF_RE = re.compile(
+    r'\\(includegraphics|input|include)\*?(?:\[[^\]]{0,200}\])?\s*\{([^{}]{1,300})\}'
+)
+_GRAPHICSPATH_RE = re.compile(r'\\graphicspath\s*\{((?:\s*\{[^{}]{0,300}\})+)\s*\}')
+
+
+class AssetIndex:
+    """Listing of every file under the project's `figures/` and `project/`.
+
+    Built once per session. Directory listings are cached on disk with
+    their mtime: a directory's mtime changes whenever entries are added,
+    removed or renamed, so a warm run costs one stat per directory instead
+    of one per reference. Symlinked directories (the `project/` Dropbox
+    link) are followed once. Afterwards a lookup re-stats only the
+    directories on its own path (each at most every INDEX_RECHECK_SECONDS),
+    so long-lived sessions see figure changes without re-stat'ing the tree.
+    """
+
+    VERSION = 1
+    ROOTS = ('figures', 'project')
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._cache = JsonCache(root, 'asset_index', self.VERSION)
+        stored = self._cache.load()
+        self.dirs = {}
+        dirty = False
+        visited = set()
+        stack = [top for top in self.ROOTS]
+        while stack:
+            rel = stack.pop()
+            try:
+                st = os.stat(root / rel)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            entry = stored.get(rel)
+            if not entry or entry['mtime'] != st.st_mtime_ns:
+                entry = self._list_dir(rel, st.st_mtime_ns)
+                if entry is None:
+                    continue
+                dirty = True
+            self.dirs[rel] = entry
+            stack.extend(f'{rel}/{name}' for name in entry['dirs'])
+        if dirty or set(stored) != set(self.dirs):
+            self._cache.save(self.dirs)
+
+        self.files = set()
+        self._lower = {}
+        for rel, entry in self.dirs.items():
+            self._add_files(rel, entry)
+        self._outside = {}
+        self._checked = dict.fromkeys(self.dirs, time.monotonic())
+
+    def _list_dir(self, rel: str, mtime: int) -> Optional[Dict]:
+        entry = {'mtime': mtime, 'files': [], 'dirs': []}
+        try:
+            with os.scandir(self.root / rel) as entries:
+                for item in entries:
+                    try:
+                        is_dir = item.is_dir()
+                    except OSError:
+                        continue
+                    entry['dirs' if is_dir else 'files'].append(item.name)
+        except OSError:
+            return None
+        return entry
+
+    def _add_files(self, rel: str, entry: Dict) -> None:
+        for name in entry['files']:
+            path = f'{rel}/{name}'
+            self.files.add(path)
+            self._lower.setdefault(path.lower(), path)
+
+    def _remove_files(self, rel: str, entry: Dict) -> None:
+        for name in entry['files']:
+            path = f'{rel}/{name}'
+            self.files.discard(path)
+            if self._lower.get(path.lower()) == path:
+                del self._lower[path.lower()]
+
+    def _forget(self, rel: str) -> None:
+        """Drop directory `rel` and everything indexed below it."""
+        for directory in [d for d in self.dirs if d == rel or d.startswith(rel + '/')]:
+            self._remove_files(directory, self.dirs.pop(directory))
+
+    def _revalidate(self, rel: str) -> None:
+        """Re-stat the directories leading to `rel`, re-listing changed ones."""
+        now = time.monotonic()
+        parts = rel.split('/')[:-1]
+        for depth in range(1, len(parts) + 1):
+            directory = '/'.join(parts[:depth])
+            if now - self._checked.get(directory, float('-inf')) < INDEX_RECHECK_SECONDS:
+                continue
+            self._checked[directory] = now
+            try:
+                mtime = os.stat(self.root / directory).st_mtime_ns
+            except OSError:
+                self._forget(directory)
+                return
+            entry = self.dirs.get(directory)
+            if entry is not None and entry['mtime'] == mtime:
+                continue
+            listing = self._list_dir(directory, mtime)
+            if listing is None:
+                self._forget(directory)
+                return
+            # Only this listing changed; subdirectories keep their own entries
+            if entry is not None:
+                self._remove_files(directory, entry)
+            self.dirs[directory] = listing
+            self._add_files(directory, listing)
+
+    def _indexed(self, rel: str) -> bool:
+        return rel.split('/', 1)[0] in self.ROOTS
+
+    def exists(self, rel: str) -> bool:
+        """Whether root-relative posix path `rel` is a file."""
+        if self._indexed(rel):
+            self._revalidate(rel)
+            return rel in self.files
+        now = time.monotonic()
+        cached = self._outside.get(rel)
+        if cached is None or now - cached[1] >= INDEX_RECHECK_SECONDS:
+            cached = self._outside[rel] = ((self.root / rel).is_file(), now)
+        return cached[0]
+
+    def case_mismatch(self, rel: str) -> Optional[str]:
+        """Actual spelling of `rel` if it exists only with different case."""
+        actual = self._lower.get(rel.lower())
+        return actual if actual and actual != rel else None
+
+    def resolve(self, target: str, kind: str, search_dirs: List[str]) -> Tuple[Optional[str], Optional[str]]:
+        """Resolve a `\\includegraphics`/`\\input` target the way LaTeX would.
+
+        Returns (found path, None) or (None, case-mismatched suggestion).
+        """
+        name = target.strip()
+        if kind == 'includegraphics':
+            has_ext = os.path.splitext(name)[1].lower() in GRAPHICS_EXTENSIONS
+            candidates = [name] if has_ext else [name + ext for ext in GRAPHICS_EXTENSIONS]
+        else:
+            candidates = [name] if name.endswith('.tex') else [name + '.tex', name]
+        suggestion = None
+        for base in search_dirs:
+            for candidate in candidates:
+                rel = os.path.normpath(os.path.join(base, candidate)).replace(os.sep, '/')
+                if rel.startswith('../'):
+                    continue
+                if self.exists(rel):
+                    return rel, None
+                suggestion = suggestion or self.case_mismatch(rel)
+        return None, suggestion
+
+# ==============================================================================
+# LAYOUT ESTIMATOR (approximate frame geometry without compiling)
+# ==============================================================================
+
+PT_PER_UNIT = {'pt': 1.0, 'bp': 1.00375, 'mm': 2.84528, 'cm': 28.4528,
+               'in': 72.27, 'em': 11.0, 'ex': 4.8}
+
+FONT_SIZES = {  # beamer 11pt base
+    'tiny': 6.0, 'scriptsize': 8.0, 'footnotesize': 9.0, 'small': 10.0,
+    'normalsize': 11.0, 'large': 12.0, 'Large': 14.4, 'LARGE': 17.28,
+    'huge': 20.74, 'Huge': 24.88,
+}
+REDUCED_SIZES = ('tiny', 'scriptsize', 'footnotesize', 'small')
+
+
+def _char_widths(default: float, narrow: float, wide: float, upper: float,
+                 digit: float, space: float) -> Dict[str, float]:
+    """Advance widths (em) for printable ASCII in one font family."""
+    widths = {chr(c): default for c in range(32, 127)}
+    widths.update({c: upper for c in 'ABCDEFGHIJKLNOPQRSTUVXYZ'})
+    widths.update({c: digit for c in '0123456789'})
+    widths.update({c: narrow for c in "ijlft.,;:!|'`()[]/-"})
+    widths.update({c: wide for c in 'mwMW@%'})
+    widths[' '] = space
+    return widths
+
+
+# Averages measured from Fira Sans (metropolis), CM Sans and CM Typewriter
+CHAR_WIDTHS = {
+    'sans': _char_widths(0.50, 0.27, 0.82, 0.62, 0.55, 0.27),
+    'serif': _char_widths(0.47, 0.28, 0.80, 0.68, 0.50, 0.33),
+    'mono': _char_widths(0.525, 0.525, 0.525, 0.525, 0.525, 0.525),
+}
+
+# Slide geometry in pt: (paper width, paper height) per aspect ratio
+PAPER_SIZES = {
+    '43': (364.19, 273.14), '169': (455.24, 256.07), '1610': (455.24, 284.52),
+    '149': (398.34, 256.07), '141': (398.34, 284.52), '54': (355.65, 284.52),
+    '32': (384.11, 256.07),
+}
+FRAMETITLE_HEIGHT = 28.0
+FOOTLINE_HEIGHT = 12.0
+VERTICAL_PADDING = 12.0
+TEXT_MARGINS = 56.9  # 1cm each side
+
+BOX_ENVS = {'keybox', 'highlightbox', 'definitionbox', 'methodbox', 'block',
+            'alertblock', 'exampleblock', 'tcolorbox'}
+TITLED_BOX_ENVS = {'definitionbox', 'block', 'alertblock', 'exampleblock'}
+LIST_ENVS = {'itemize', 'enumerate', 'description'}
+DISPLAY_MATH_ENVS = {'equation', 'equation*', 'align', 'align*', 'gather',
+                     'gather*', 'multline', 'multline*', 'eqnarray',
+                     'eqnarray*', 'displaymath'}
+TABLE_ENVS = {'tabular', 'tabular*', 'tabularx', 'tabbing'}
+VERBATIM_ENVS = {'lstlisting', 'verbatim', 'semiverbatim'}
+
+# Optional-argument lengths are bounded: an unbounded `[^\]]*` rescans to
+# the end of the line for every `\item[` on it.
+_LAYOUT_TOKEN_RE = re.compile(
+    r'\\begin\{([A-Za-z]+\*?)\}(?:\[[^\]\n]{0,200}\])?(?:\{([^{}\n]{0,200})\})?'
+    r'|\\end\{([A-Za-z]+\*?)\}'
+    r'|\\item\b(?:\[[^\]\n]{0,200}\])?'
+    r'|\\(' + '|'.join(FONT_SIZES) + r')(?![A-Za-z])'
+    r'|\\includegraphics(?:\[([^\]\n]{0,200})\])?'
+    r'|\\vspace\*?\{([^{}\n]{0,100})\}'
+    r'|\\(resizebox|scalebox)(?![A-Za-z])'
+    r'|\\\\(?:\[([^\]\n]{0,100})\])?'
+    r'|\\(framesubtitle|titlepage|maketitle)(?![A-Za-z])'
+    r'|\\\[|\$\$'
+    r'|\n[ \t]*\n'
+)
+_VISIBLE_DROP_RE = re.compile(
+    r'\\(?:textcolor|color|href|label|ref|cite[a-z]*|pause|only|uncover|onslide)'
+    r'(?:<[^>\n]{0,50}>)?(?:\{[^{}\n]{0,200}\})?(?=\{)'
+    r'|\\[A-Za-z]+\*?(?:<[^>\n]{0,50}>)?(?:\[[^\]\n]{0,200}\])?|[{}$&~^_]'
+)
+_NUMBER = r'-?(?:\d+(?:\.\d*)?|\.\d+)'  # unambiguous: no \d*\.?\d+ backtracking
+_DIMEN_RE = re.compile(
+    r'(' + _NUMBER + r')?\s*\\?(pt|bp|mm|cm|in|em|ex|textheight|textwidth|linewidth'
+    r'|columnwidth|paperheight|paperwidth)'
+)
+_TIKZ_COORD_RE = re.compile(r'\(\s*(' + _NUMBER + r')\s*,\s*(' + _NUMBER + r')\s*\)')
+_TIKZ_SCALE_RE = re.compile(r'(?:^|[,\[\s])(?:y?scale)\s*=\s*(' + _NUMBER + r')')
+# Overlay alternatives occupy the same space on successive slides
+_OVERLAY_RE = re.compile(r'\\(only|alt)\s*<[^>\n]{0,50}>\s*\{'
+                         r'|\\begin\{(overprint|onlyenv)\}(?:<[^>\n]{0,50}>)?')
+_NEXT_ONLY_RE = re.compile(r'\s*\\only\s*<[^>\n]{0,50}>\s*\{')
+_NEXT_ONLYENV_RE = re.compile(r'\s*\\begin\{onlyenv\}(?:<[^>\n]{0,50}>)?')
+_ONSLIDE_SPLIT_RE = re.compile(r'\\onslide\s*(?:<[^>\n]{0,50}>)?')
+# Overlay groups nested deeper than this are measured as written, so deeply
+# nested input is rescanned a bounded number of times, not once per level
+OVERLAY_MAX_DEPTH = 6
+
+
+class LayoutEstimator:
+    """Predict the rendered height of a Beamer frame from its source.
+
+    Works on `IssueDetector._parse_frames` output using per-font character
+    width tables, greedy line wrapping and fixed heights for lists, boxes,
+    display math, tables, listings, graphics and TikZ pictures. A frame is
+    predicted to overflow when its estimated height exceeds the available
+    text height times `ratio`. Overlay alternatives (`\\only` runs,
+    `\\alt`, `overprint`, `onlyenv` runs) share one slot: only the tallest
+    counts.
+
+    The default `ratio` of 1.0 separates the clear-cut labelled frames in
+    `tests/fixtures/layout_samples.tex`; borderline frames need a project
+    ratio from `--calibrate-layout` on frames labelled from compile logs.
+    """
+
+    def __init__(self, aspect: str = '43', base_size: float = 11.0,
+                 font: str = 'sans', ratio: float = 1.0):
+        self.paper_width, self.paper_height = PAPER_SIZES.get(aspect, PAPER_SIZES['43'])
+        self.scale = base_size / 11.0
+        self.widths = CHAR_WIDTHS.get(font, CHAR_WIDTHS['sans'])
+        self.ratio = ratio
+        self.text_width = self.paper_width - TEXT_MARGINS
+
+    @classmethod
+    def from_document(cls, content: str, ratio: float = 1.0) -> 'LayoutEstimator':
+        """Read aspect ratio, base font size and font family from the preamble."""
+        m = re.search(r'\\documentclass\s*\[([^\]]*)\]\s*\{beamer\}', content)
+        opts = m.group(1) if m else ''
+        aspect = re.search(r'aspectratio\s*=\s*(\d+)', opts)
+        size = re.search(r'\b(8|9|10|11|12|14|17|20)pt\b', opts)
+        serif = re.search(r'\\usefonttheme\s*(?:\[[^\]]*\])?\s*\{serif\}', content)
+        return cls(aspect=aspect.group(1) if aspect else '43',
+                   base_size=float(size.group(1)) if size else 11.0,
+                   font='serif' if serif else 'sans', ratio=ratio)
+
+    # -- primitives -----------------------------------------------------------
+
+    def text_width_em(self, text: str) -> float:
+        widths = self.widths
+        return sum(widths.get(c, 0.55) for c in text)
+
+    @staticmethod
+    def baseline(size: float) -> float:
+        return size * 1.22
+
+    def dimen(self, spec: str, width: float, avail: float) -> Optional[float]:
+        """Convert a LaTeX length like `0.5\\textwidth` or `3cm` to pt."""
+        m = _DIMEN_RE.search(spec)
+        if not m:
+            return None
+        factor = float(m.group(1)) if m.group(1) else 1.0
+        unit = m.group(2)
+        if unit in ('textheight', 'paperheight'):
+            return factor * (avail if unit == 'textheight' else self.paper_height)
+        if unit in ('textwidth', 'linewidth', 'columnwidth', 'paperwidth'):
+            return factor * (width if unit != 'paperwidth' else self.paper_width)
+        return factor * PT_PER_UNIT[unit] * (self.scale if unit in ('em', 'ex') else 1)
+
+    def available_height(self, frame: Dict) -> float:
+        opts = frame.get('options', '')
+        height = self.paper_height - FOOTLINE_HEIGHT - VERTICAL_PADDING
+        if 'plain' not in opts:
+            height -= FRAMETITLE_HEIGHT
+        return height
+
+    # -- frame model ----------------------------------------------------------
+
+    def estimate(self, frame: Dict) -> Dict:
+        """Return height, available height and size reductions for one frame.
+
+        `reductions` lists (command, line) pairs for `\\small`-and-below,
+        `\\resizebox`/`\\scalebox` and the `shrink` frame option.
+        """
+        body, hidden = self._collapse_overlays(_strip_comments(frame['body']), frame, 0)
+        result = self._estimate_body(dict(frame, body=body))
+        result['reductions'] = sorted(result['reductions'] + hidden, key=lambda r: r[1])
+        return result
+
+    def _collapse_overlays(self, body: str, frame: Dict, line_offset: int,
+                           depth: int = 0) -> Tuple[str, List[Tuple[str, int]]]:
+        """Replace each group of overlay alternatives with its tallest member.
+
+        Newlines are kept so line numbers after a group do not move; size
+        reductions inside the dropped alternatives are returned separately.
+        An unbalanced group ends the collapsing (the rest is left as is), and
+        groups below OVERLAY_MAX_DEPTH levels of nesting are left as written.
+        """
+        out = []
+        hidden = []
+        newlines = None
+        pos = 0
+        while True:
+            m = _OVERLAY_RE.search(body, pos)
+            if not m:
+                break
+            alternatives = []          # (start offset, text)
+            if m.group(1):             # \only<...>{A}\only<...>{B}..., \alt<...>{A}{B}
+                end = m.end()
+                count = 2 if m.group(1) == 'alt' else 1
+                balanced = True
+                while True:
+                    for i in range(count):
+                        if i:
+                            if not body.startswith('{', end):
+                                break
+                            end += 1
+                        inner, close = _read_braced(body, end)
+                        if close == len(body) and not body.endswith('}'):
+                            balanced = False
+                            break
+                        alternatives.append((end, inner))
+                        end = close
+                    if not balanced or m.group(1) == 'alt':
+                        break
+                    nxt = _NEXT_ONLY_RE.match(body, end)
+                    if not nxt:
+                        break
+                    end = nxt.end()
+                if not balanced:
+                    break
+            elif m.group(2) == 'overprint':
+                close = body.find('\\end{overprint}', m.end())
+                if close == -1:
+                    break
+                start = m.end()
+                for sep in _ONSLIDE_SPLIT_RE.finditer(body, start, close):
+                    alternatives.append((start, body[start:sep.start()]))
+                    start = sep.end()
+                alternatives.append((start, body[start:close]))
+                end = close + len('\\end{overprint}')
+            else:                      # \begin{onlyenv}<...> ... \end{onlyenv} runs
+                end = m.end()
+                balanced = True
+                while True:
+                    close = body.find('\\end{onlyenv}', end)
+                    if close == -1:
+                        balanced = False
+                        break
+                    alternatives.append((end, body[end:close]))
+                    end = close + len('\\end{onlyenv}')
+                    nxt = _NEXT_ONLYENV_RE.match(body, end)
+                    if not nxt:
+                        break
+                    end = nxt.end()
+                if not balanced:
+                    break
+
+            if newlines is None:
+                newlines = [nl.start() for nl in re.finditer('\n', body)]
+            measured = []              # (height, collapsed text, reductions, nested hidden)
+            for start, text in alternatives:
+                first = line_offset + bisect.bisect_left(newlines, start)
+                nested = []
+                if depth + 1 < OVERLAY_MAX_DEPTH:
+                    text, nested = self._collapse_overlays(text, frame, first, depth + 1)
+                est = self._estimate_body(dict(frame, body=text, options='',
+                                               start_line=frame['start_line'] + first))
+                measured.append((est['height'], text, est['reductions'], nested))
+            tallest = max(range(len(measured)), key=lambda i: measured[i][0])
+            for i, (_height, _text, reductions, nested) in enumerate(measured):
+                # The tallest stays in the body, so its own reductions are found there
+                hidden.extend(nested if i == tallest else reductions + nested)
+            text = measured[tallest][1]
+            gap = body.count('\n', m.start(), end) - text.count('\n')
+            out.append(body[pos:m.start()])
+            out.append(text + '\n' * max(0, gap))
+            pos = end
+        out.append(body[pos:])
+        return ''.join(out), hidden
+
+    def _estimate_body(self, frame: Dict) -> Dict:
+        """`estimate` for a body whose overlay alternatives are already collapsed."""
+        body = frame['body']
+        avail = self.available_height(frame)
+        size = FONT_SIZES['normalsize'] * self.scale
+        width = self.text_width
+        indent = 0.0
+        stack = []          # (env, saved size, saved indent)
+        columns = None      # finished column heights inside \begin{columns}
+        column_height = 0.0
+        total = 0.0
+        para = []
+        reductions = []
+        if re.search(r'\bshrink\b', frame.get('options', '')):
+            reductions.append(('shrink', frame['start_line']))
+        line_offsets = [m.start() for m in re.finditer('\n', body)]
+
+        def line_of(pos):
+            return frame['start_line'] + 1 + bisect.bisect_right(line_offsets, pos)
+
+        def add(h):
+            nonlocal total, column_height
+            if columns is not None:
+                column_height += h
+            else:
+                total += h
+
+        def flush():
+            text = ' '.join(para).strip()
+            para.clear()
+            if not text:
+                return
+            visible = _VISIBLE_DROP_RE.sub('', text)
+            if not visible.strip():
+                return
+            line_width = max(width - indent, 40.0)
+            lines = -(-self.text_width_em(visible) * size // line_width)
+            add(max(1, lines) * self.baseline(size))
+
+        pos = 0
+        n = len(body)
+        while pos < n:
+            m = _LAYOUT_TOKEN_RE.search(body, pos)
+            if not m:
+                para.append(body[pos:].replace('\n', ' '))
+                break
+            para.append(body[pos:m.start()].replace('\n', ' '))
+            pos = m.end()
+            tok = m.group(0)
+
+            if m.group(1):                                   # \begin{env}
+                env = m.group(1)
+                end_tok = f'\\end{{{env}}}'
+                if env in DISPLAY_MATH_ENVS or env in TABLE_ENVS or env in VERBATIM_ENVS \
+                        or env == 'tikzpicture':
+                    flush()
+                    end = body.find(end_tok, pos)
+                    end = n if end == -1 else end
+                    add(self._block_height(env, m.group(2) or '', body[pos:end], size, avail))
+                    pos = min(n, end + len(end_tok))
+                    continue
+                stack.append((env, size, indent, width))
+                if env in LIST_ENVS:
+                    flush()
+                    add(3.0)
+                    indent += 1.6 * size
+                elif env in BOX_ENVS:
+                    flush()
+                    add(10.0 + (self.baseline(size) if env in TITLED_BOX_ENVS
+                                and (m.group(2) or env == 'definitionbox') else 0.0))
+                    indent += 14.0
+                elif env == 'columns':
+                    flush()
+                    columns = []
+                elif env == 'column' and columns is not None:
+                    flush()
+                    column_height = 0.0
+                    frac = self.dimen(m.group(2) or '', self.text_width, avail)
+                    width = indent + (frac if frac else self.text_width / 2)
+                elif env == 'minipage':
+                    frac = self.dimen(m.group(2) or '', width - indent, avail)
+                    if frac:
+                        width = indent + frac
+            elif m.group(3):                                 # \end{env}
+                env = m.group(3)
+                flush()
+                while stack:
+                    opened, size, indent, width = stack.pop()
+                    if opened == env:
+                        break
+                if env in LIST_ENVS:
+                    add(3.0)
+                elif env in BOX_ENVS:
+                    add(12.0)
+                elif env == 'column' and columns is not None:
+                    columns.append(column_height)
+                    column_height = 0.0
+                elif env == 'columns' and columns is not None:
+                    finished = max(columns + [column_height])
+                    columns = None
+                    add(finished)
+            elif tok.startswith('\\item'):
+                flush()
+                add(3.0)
+            elif m.group(4):                                 # size switch
+                flush()
+                size = FONT_SIZES[m.group(4)] * self.scale
+                if m.group(4) in REDUCED_SIZES:
+                    reductions.append((f'\\{m.group(4)}', line_of(m.start())))
+            elif tok.startswith('\\includegraphics'):
+                flush()
+                add(self._graphic_height(m.group(5) or '', width - indent, avail))
+            elif m.group(6) is not None:                     # \vspace
+                flush()
+                add(self.dimen(m.group(6), width, avail) or 0.0)
+            elif m.group(7):                                 # \resizebox / \scalebox
+                reductions.append((f'\\{m.group(7)}', line_of(m.start())))
+            elif tok.startswith('\\\\'):
+                flush()
+                if m.group(8):
+                    add(self.dimen(m.group(8), width, avail) or 0.0)
+            elif m.group(9) == 'framesubtitle':
+                avail -= self.baseline(size)
+            elif m.group(9):                                 # title page
+                return {'height': 0.0, 'available': avail, 'overflow': False,
+                        'reductions': reductions}
+            elif tok in ('\\[', '$$'):
+                flush()
+                end_tok = '\\]' if tok == '\\[' else '$$'
+                end = body.find(end_tok, pos)
+                end = n if end == -1 else end
+                add(self._block_height('equation', '', body[pos:end], size, avail))
+                pos = min(n, end + len(end_tok))
+            else:                                            # blank line
+                flush()
+        flush()
+        if columns is not None:
+            total += max(columns + [column_height])
+        overflow = total > avail * self.ratio and 'allowframebreaks' not in frame.get('options', '')
+        return {'height': total, 'available': avail, 'overflow': overflow,
+                'reductions': reductions}
+
+    def _block_height(self, env: str, arg: str, inner: str, size: float,
+                      avail: float) -> float:
+        """Height of an opaque block (display math, table, listing, TikZ)."""
+        base = self.baseline(size)
+        if env in DISPLAY_MATH_ENVS:
+            rows = inner.count('\\\\') + (0 if inner.rstrip().endswith('\\\\') else 1)
+            tall = 0.6 * base if re.search(r'\\(?:d?frac|sum|prod|int)\b', inner) else 0.0
+            return rows * (base + tall) + 12.0
+        if env in TABLE_ENVS:
+            rows = max(1, inner.count('\\\\'))
+            rules = len(re.findall(r'\\(?:top|mid|bottom|h)rule\b|\\hline\b', inner))
+            return rows * base * 1.1 + rules * 3.0
+        if env in VERBATIM_ENVS:
+            lines = inner.strip('\n').count('\n') + 1
+            listing_size = FONT_SIZES['scriptsize'] * self.scale if env == 'lstlisting' else size
+            return lines * self.baseline(listing_size) + 8.0
+        # tikzpicture: extent of explicit coordinates (default unit cm)
+        ys = [float(y) for _x, y in _TIKZ_COORD_RE.findall(inner)]
+        scale = _TIKZ_SCALE_RE.search(arg) or _TIKZ_SCALE_RE.search(inner[:200])
+        factor = float(scale.group(1)) if scale else 1.0
+        if not ys:
+            return 3.0 * PT_PER_UNIT['cm']
+        return (max(ys) - min(ys) + 0.6) * PT_PER_UNIT['cm'] * factor
+
+    def _graphic_height(self, opts: str, width: float, avail: float) -> float:
+        for key in ('height', 'totalheight'):
+            m = re.search(key + r'\s*=\s*([^,\]]+)', opts)
+            if m:
+                h = self.dimen(m.group(1), width, avail)
+                if h:
+                    return h
+        m = re.search(r'width\s*=\s*([^,\]]+)', opts)
+        if m:
+            w = self.dimen(m.group(1), width, avail)
+            if w:
+                return w * 0.75  # typical 4:3 figure
+        m = re.search(r'scale\s*=\s*([\d.]+)', opts)
+        if m:
+            return min(avail, float(m.group(1)) * avail)
+        return 0.6 * avail
+
+
+def calibrate_layout(samples: Iterable[Tuple[float, bool]]) -> float:
+    """Pick the fill-ratio threshold that best separates labelled frames.
+
+    `samples` are (estimated height / available height, overflowed) pairs,
+    e.g. frames whose compile logs reported `Overfull \\vbox`. Ties go to
+    the higher threshold to keep false positives down.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return 1.0
+    fills = [fill for fill, _ in samples]
+    candidates = {1.0}
+    candidates.update((a + b) / 2 for a, b in zip(fills, fills[1:]))
+    candidates.update((fills[0] - 0.01, fills[-1] + 0.01))
+    best = max(candidates, key=lambda t: (
+        sum((fill > t) == overflowed for fill, overflowed in samples), t))
+    return round(best, 3)
+
+
+def layout_ratio_for(root: Path) -> float:
+    """Calibrated overflow threshold for a project.
+
+    Falls back to 1.0 (checked only against clear-cut sample frames) until
+    `--calibrate-layout` has been run on frames labelled from compile logs.
+    """
+    return JsonCache(root, 'layout_calibration', 1).load().get('ratio', 1.0)
+
+
+# ==============================================================================
+# NEAR-DUPLICATE SLIDES (MinHash signatures + LSH, cached per frame hash)
+# ==============================================================================
+
+MINHASH_PERM = 64
+LSH_BANDS, LSH_ROWS = 16, 4  # 16 x 4 = MINHASH_PERM; candidate threshold ~0.5
+DUPLICATE_SIMILARITY = 0.8   # estimated Jaccard needed to report a pair
+MIN_SHINGLES = 8             # frames shorter than this are too generic to compare
+_DUP_TOKEN_RE = re.compile(r'\\[A-Za-z]+|[A-Za-z0-9]+')
+_DENSIFY_STEP = 1 << 58
+
+
+def shingle_hashes(tokens: List[str], k: int = 3) -> set:
+    """64-bit hashes of the k-token shingles of `tokens`."""
+    if len(tokens) < k:
+        return set()
+    return {int.from_bytes(hashlib.blake2b(' '.join(tokens[i:i + k]).encode('utf-8'),
+                                           digest_size=8).digest(), 'big')
+            for i in range(len(tokens) - k + 1)}
+
+
+def minhash_signature(hashes: Iterable[int], num_perm: int = MINHASH_PERM) -> List[int]:
+    """One-permutation MinHash: each hash is binned once, O(n) per set.
+
+    Empty bins borrow the value of the next filled bin (rotation
+    densification, offset by the distance) so sparse sets still give
+    comparable signatures. Returns [] for an empty set.
+    """
+    bins = [None] * num_perm
+    for h in hashes:
+        b, v = h % num_perm, h // num_perm
+        if bins[b] is None or v < bins[b]:
+            bins[b] = v
+    filled = [i for i, v in enumerate(bins) if v is not None]
+    if not filled:
+        return []
+    signature = []
+    for i, v in enumerate(bins):
+        if v is None:
+            pos = bisect.bisect_right(filled, i)
+            j = filled[pos] if pos < len(filled) else filled[0]
+            v = bins[j] + ((j - i) % num_perm) * _DENSIFY_STEP
+        signature.append(v)
+    return signature
+
+
+def signature_similarity(a: List[int], b: List[int]) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    if not a or len(a) != len(b):
+        return 0.0
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def lsh_bands(signature: List[int]) -> List[str]:
+    """Bucket keys of `signature`, one per LSH band."""
+    return [f'{band}:' + ','.join(map(str, signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]))
+            for band in range(LSH_BANDS)]
+
+
+class SlideIndex:
+    """MinHash signatures of every frame in a lecture series, with LSH buckets.
+
+    Frames are shingled on their title and body (comments stripped,
+    tokens lower-cased). Each distinct frame text is signed once and
+    cached under its hash, so after editing one deck only its changed
+    frames are re-signed. Candidates come from LSH buckets (frames sharing
+    a band), so near-duplicates within and across decks are found in
+    roughly linear time instead of comparing every pair of frames.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._cache = JsonCache(root, 'slide_index', self.VERSION)
+        stored = self._cache.load()
+        self.decks = stored.get('decks', {})
+        self.signatures = stored.get('signatures', {})
+        self._dirty = False
+        self._buckets = None
+
+    def update_deck(self, deck: str, content: str, signature: Optional[List[int]]) -> None:
+        """Index the frames of `content` as `deck`, skipping work if unchanged."""
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        entry = self.decks.get(deck)
+        if entry and entry['sha1'] == digest:
+            if entry['sig'] != signature:
+                entry['sig'] = signature
+                self._dirty = True
+            return
+        frames = []
+        for frame in IssueDetector._parse_frames(content):
+            if frame['is_title_page'] or frame['is_standout']:
+                continue
+            tokens = _DUP_TOKEN_RE.findall(
+                _strip_comments(frame['title'] + '\n' + frame['body']).lower())
+            frame_hash = hashlib.sha1(' '.join(tokens).encode('utf-8')).hexdigest()[:16]
+            if frame_hash not in self.signatures:
+                shingles = shingle_hashes(tokens)
+                self.signatures[frame_hash] = (minhash_signature(shingles)
+                                               if len(shingles) >= MIN_SHINGLES else [])
+            frames.append([frame_hash, frame['start_line'], frame['index'] + 1])
+        self.decks[deck] = {'sig': signature, 'sha1': digest, 'frames': frames}
+        self._buckets = None
+        self._dirty = True
+
+    def restore_deck(self, deck: str, entry: Optional[Dict]) -> None:
+        """Put back `deck` as `entry` (None drops it) once a buffer has been scored."""
+        if entry is None:
+            self.decks.pop(deck, None)
+        else:
+            self.decks[deck] = entry
+        self._buckets = None
+
+    def refresh(self, directory: Path, skip: Optional[str] = None) -> None:
+        """Bring every `*.tex` deck in `directory` up to date and drop deleted ones."""
+        seen = {skip}
+        for path in sorted(directory.glob('*.tex')):
+            deck = relative_key(path, self.root)
+            seen.add(deck)
+            if deck == skip:
+                continue
+            signature = file_signature(path)
+            entry = self.decks.get(deck)
+            if entry and entry['sig'] == signature:
+                continue
+            try:
+                content = read_source(path)
+            except OSError:
+                continue
+            self.update_deck(deck, content, signature)
+        # Decks elsewhere in the series are kept until their file is deleted
+        for deck in list(self.decks):
+            if deck not in seen and not (self.root / deck).exists():
+                del self.decks[deck]
+                self._buckets = None
+                self._dirty = True
+
+    def save(self) -> None:
+        if self._dirty:
+            used = {frame[0] for entry in self.decks.values() for frame in entry['frames']}
+            self.signatures = {h: sig for h, sig in self.signatures.items() if h in used}
+            self._cache.save({'decks': self.decks, 'signatures': self.signatures})
+            self._dirty = False
+
+    def _bucket_index(self) -> Dict[str, List[Tuple[str, int]]]:
+        if self._buckets is None:
+            self._buckets = {}
+            for deck, entry in self.decks.items():
+                for pos, frame in enumerate(entry['frames']):
+                    signature = self.signatures.get(frame[0])
+                    if signature:
+                        for key in lsh_bands(signature):
+                            self._buckets.setdefault(key, []).append((deck, pos))
+        return self._buckets
+
+    def duplicates(self, deck: str) -> List[Dict]:
+        """Best near-duplicate (if any) of each frame in `deck`, in slide order."""
+        entry = self.decks.get(deck)
+        if not entry:
+            return []
+        buckets = self._bucket_index()
+        found = []
+        for pos, (frame_hash, line, slide) in enumerate(entry['frames']):
+            signature = self.signatures.get(frame_hash)
+            if not signature:
+                continue
+            best = None
+            seen = {(deck, pos)}
+            for key in lsh_bands(signature):
+                for other in buckets.get(key, ()):
+                    if other in seen:
+                        continue
+                    seen.add(other)
+                    other_hash, other_line, other_slide = self.decks[other[0]]['frames'][other[1]]
+                    similarity = (1.0 if other_hash == frame_hash else
+                                  signature_similarity(signature, self.signatures[other_hash]))
+                    rank = (similarity, other_hash == frame_hash, other[0] != deck,
+                            other[0], -other_line)
+                    if similarity >= DUPLICATE_SIMILARITY and (best is None or rank > best[0]):
+                        best = (rank, {'line': line, 'slide': slide, 'deck': other[0],
+                                       'other_line': other_line, 'other_slide': other_slide,
+                                       'similarity': similarity,
+                                       'identical': other_hash == frame_hash})
+            if best:
+                found.append(best[1])
+        return found
+
+
+# ==============================================================================
+# NEAR-DUPLICATE CODE (winnowed fingerprints of normalized tokens)
+# ==============================================================================
+
+CODE_DIRS = {'python': (Path('scripts') / 'python', '*.py'),
+             'stata': (Path('scripts') / 'stata', '*.do')}
+CODE_KGRAM = 15          # tokens per fingerprinted k-gram
+CODE_WINDOW = 8          # winnowing window: any shared run of 22+ tokens is caught
+MIN_CODE_MATCHES = 3     # fingerprints a duplicated region must share
+MIN_CODE_LINES = 6       # lines a duplicated region must span on both sides
+CODE_COMMON_FILES = 10   # fingerprints in more scripts than this are boilerplate
+# Strings and comments are matched first so their contents never become tokens
+_CODE_TOKEN_RES = {
+    'python': re.compile(
+        r'(?P<skip>#[^\n]*)'
+        r'|(?P<str>"""[\s\S]*?(?:"""|\Z)|\'\'\'[\s\S]*?(?:\'\'\'|\Z)'
+        r'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+        r'|(?P<tok>[A-Za-z_]\w*|\d+(?:\.\d*)?|\n|[^\s\w])'),
+    'stata': re.compile(
+        r'(?P<skip>//[^\n]*|/\*[\s\S]*?(?:\*/|\Z)|^[ \t]*\*[^\n]*)'
+        r'|(?P<str>"[^"\n]*")'
+        r'|(?P<tok>[A-Za-z_]\w*|\d+(?:\.\d*)?|\n|[^\s\w])', re.MULTILINE),
+}
+_CODE_KEYWORDS = {
+    'python': {'and', 'as', 'assert', 'async', 'await', 'break', 'class', 'continue',
+               'def', 'del', 'elif', 'else', 'except', 'finally', 'for', 'from',
+               'global', 'if', 'import', 'in', 'is', 'lambda', 'nonlocal', 'not',
+               'or', 'pass', 'raise', 'return', 'try', 'while', 'with', 'yield',
+               'None', 'True', 'False', 'self'},
+    'stata': {'if', 'in', 'using', 'by', 'bysort', 'foreach', 'forvalues', 'while',
+              'else', 'quietly', 'capture', 'noisily', 'of', 'local', 'global'},
+}
+
+
+def code_tokens(text: str, lang: str) -> List[Tuple[str, int]]:
+    """Normalized (token, line) pairs of a Python or Stata source.
+
+    Comments are dropped, literals become `<str>`/`<num>`, and
+    identifiers become `V` unless they are keywords, called (`name(`),
+    attributes (`.name`) or, in Stata, the command word opening a line,
+    so renamed variables still match while the code's structure is kept.
+    """
+    raw = []
+    line = 1
+    line_start = True
+    for m in _CODE_TOKEN_RES[lang].finditer(text):
+        tok = m.group(0)
+        if tok == '\n':
+            line += 1
+            line_start = True
+            continue
+        if m.lastgroup == 'str':
+            raw.append(('<str>', line, False))
+        elif m.lastgroup == 'tok':
+            if tok[0].isdigit():
+                raw.append(('<num>', line, False))
+            else:
+                raw.append((tok, line, line_start and tok[0].isalpha()))
+        if m.lastgroup != 'skip':
+            line_start = False
+        line += tok.count('\n')
+    keywords = _CODE_KEYWORDS[lang]
+    tokens = []
+    for i, (tok, line, opens_line) in enumerate(raw):
+        if tok[0].isalpha() or tok[0] == '_':
+            keep = (tok in keywords
+                    or (i + 1 < len(raw) and raw[i + 1][0] == '(')
+                    or (i > 0 and raw[i - 1][0] == '.')
+                    or (lang == 'stata' and opens_line))
+            tok = tok if keep else 'V'
+        tokens.append((tok, line))
+    return tokens
+
+
+def winnow(tokens: List[Tuple[str, int]], k: int = CODE_KGRAM,
+           window: int = CODE_WINDOW) -> List[List[int]]:
+    """Winnowed k-gram fingerprints as [hash, first line, last line].
+
+    The minimum hash of each window of `window` consecutive k-grams is
+    kept (rightmost on ties), so every shared run of k + window - 1
+    tokens yields at least one common fingerprint.
+    """
+    grams = []
+    for i in range(len(tokens) - k + 1):
+        key = ' '.join(tok for tok, _ in tokens[i:i + k])
+        grams.append((int.from_bytes(hashlib.blake2b(key.encode('utf-8'),
+                                                     digest_size=8).digest(), 'big'),
+                      tokens[i][1], tokens[i + k - 1][1]))
+    fingerprints = []
+    last = -1
+    for start in range(max(0, len(grams) - window + 1)):
+        best = start
+        for pos in range(start + 1, start + window):
+            if grams[pos][0] <= grams[best][0]:
+                best = pos
+        if best != last:
+            fingerprints.append(list(grams[best]))
+            last = best
+    return fingerprints
+
+
+def merge_line_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Union of inclusive line ranges, sorted and with touching ranges joined."""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def line_range_touches(ranges: List[Tuple[int, int]], first: int, last: int) -> bool:
+    """Whether [first, last] overlaps one of the merged `ranges`."""
+    pos = bisect.bisect_right(ranges, (last, float('inf'))) - 1
+    return pos >= 0 and ranges[pos][1] >= first
+
+
+def merge_code_regions(regions: List[List[int]]) -> List[List[int]]:
+    """Merge [first, last, other_first, other_last, hits] regions touching on both sides.
+
+    Passes repeat until stable, since two regions may only come to touch
+    after each has absorbed other hits.
+    """
+    while True:
+        merged = []
+        for region in sorted(regions):
+            for target in reversed(merged):
+                if target[1] + 1 < region[0]:
+                    continue
+                if target[2] <= region[3] + 1 and region[2] <= target[3] + 1:
+                    target[1] = max(target[1], region[1])
+                    target[2] = min(target[2], region[2])
+                    target[3] = max(target[3], region[3])
+                    target[4] += region[4]
+                    break
+            else:
+                merged.append(list(region))
+        if len(merged) == len(regions):
+            return merged
+        regions = merged
+
+
+class CodeIndex:
+    """Winnowed fingerprints of every script under scripts/python and scripts/stata.
+
+    Scripts are re-fingerprinted only when their mtime/size and content
+    hash change; fingerprints live in `.claude/state/quality_score/`.
+    An inverted index from fingerprint to locations turns the duplicate
+    search for one script into lookups instead of pairwise comparisons.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._cache = JsonCache(root, 'code_index', self.VERSION)
+        self.scripts = self._cache.load().get('scripts', {})
+        self._dirty = False
+        self._postings = None
+        self._runs = {}
+        self._scanned = None
+
+    def update_script(self, key: str, lang: str, content: str,
+                      signature: Optional[List[int]]) -> None:
+        """Fingerprint `content` as `key`, skipping work if its hash is unchanged."""
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        entry = self.scripts.get(key)
+        if entry and entry['sha1'] == digest:
+            if entry['sig'] != signature:
+                entry['sig'] = signature
+                self._dirty = True
+            return
+        self.scripts[key] = {'sig': signature, 'sha1': digest,
+                             'fps': winnow(code_tokens(content, lang))}
+        self._postings = None
+        self._dirty = True
+
+    def restore_script(self, key: str, entry: Optional[Dict]) -> None:
+        """Put back `key` as `entry` (None drops it) once a buffer has been scored."""
+        if entry is None:
+            self.scripts.pop(key, None)
+        else:
+            self.scripts[key] = entry
+        self._postings = None
+
+    def refresh(self, skip: Optional[str] = None) -> None:
+        """Bring every script under CODE_DIRS up to date and drop deleted ones.
+
+        The tree is walked at most every INDEX_RECHECK_SECONDS; scripts
+        scored in between are kept current through `update_script`.
+        """
+        now = time.monotonic()
+        if self._scanned is not None and now - self._scanned < INDEX_RECHECK_SECONDS:
+            return
+        self._scanned = now
+        seen = {skip}
+        for lang, (directory, pattern) in CODE_DIRS.items():
+            for path in sorted((self.root / directory).rglob(pattern)):
+                key = relative_key(path, self.root)
+                seen.add(key)
+                if key == skip:
+                    continue
+                signature = file_signature(path)
+                entry = self.scripts.get(key)
+                if entry and entry['sig'] == signature:
+                    continue
+                try:
+                    content = read_source(path)
+                except OSError:
+                    continue
+                self.update_script(key, lang, content, signature)
+        for key in list(self.scripts):
+            if key not in seen and not (self.root / key).exists():
+                del self.scripts[key]
+                self._postings = None
+                self._dirty = True
+
+    def save(self) -> None:
+        if self._dirty:
+            self._cache.save({'scripts': self.scripts})
+            self._dirty = False
+
+    def _postings_index(self) -> Dict[int, List[Tuple[str, int, int]]]:
+        """Fingerprint -> locations, without boilerplate shared by too many scripts.
+
+        Also finds each script's repetitive runs (`self._runs`): line
+        ranges where a fingerprint recurs overlapping its previous
+        occurrence, as in a block of near-identical lines.
+        """
+        if self._postings is None:
+            postings = {}
+            self._runs = {}
+            for key, entry in self.scripts.items():
+                last_seen = {}
+                repeated = []
+                for h, first, last in entry['fps']:
+                    postings.setdefault(h, []).append((key, first, last))
+                    previous = last_seen.get(h)
+                    if previous and previous[1] >= first:
+                        repeated.append((previous[0], last))
+                    last_seen[h] = (first, last)
+                self._runs[key] = merge_line_ranges(repeated)
+            self._postings = {h: places for h, places in postings.items()
+                              if len({place[0] for place in places}) <= CODE_COMMON_FILES}
+        return self._postings
+
+    def duplicates(self, key: str) -> List[Dict]:
+        """Regions of `key` duplicated elsewhere, one per copied region pair.
+
+        Fingerprints touching a repetitive run on either side are ignored:
+        a column of similar lines is not copy-paste. Remaining hits are
+        merged per other script into maximal regions (hits join when they
+        touch on both sides). Within one script each pair is reported
+        once, on the later copy, and only if the two copies do not overlap.
+        """
+        entry = self.scripts.get(key)
+        if not entry:
+            return []
+        postings = self._postings_index()
+        runs = self._runs
+        matches = {}
+        for h, first, last in entry['fps']:
+            if line_range_touches(runs[key], first, last):
+                continue
+            for other, other_first, other_last in postings.get(h, ()):
+                if other == key and other_last >= first:
+                    continue
+                if line_range_touches(runs[other], other_first, other_last):
+                    continue
+                matches.setdefault(other, []).append([first, last, other_first, other_last, 1])
+        found = []
+        for other, hits in sorted(matches.items()):
+            covered = -1
+            regions = sorted(merge_code_regions(hits), key=lambda r: (r[0], -r[1]))
+            for first, last, other_first, other_last, count in regions:
+                if (count < MIN_CODE_MATCHES or last <= covered
+                        or min(last - first, other_last - other_first) + 1 < MIN_CODE_LINES
+                        or (other == key and other_last >= first)):
+                    continue
+                # One report per region of `key`, even if `other` holds several copies
+                covered = last
+                found.append({'first': first, 'last': last, 'other': other,
+                              'other_first': other_first, 'other_last': other_last})
+        return sorted(found, key=lambda dup: (dup['first'], dup['other']))
+
+
+# ==============================================================================
+# STATA LOG ANALYSIS (streamed .smcl/.log scanning)
+# ==============================================================================
+
+STATA_LOG_DIR = Path('scripts') / 'stata' / 'logs'
+# Logs are read in blocks of this size; lines longer than LOG_LINE_BYTES are
+# truncated, so memory stays bounded even for multi-GB bootstrap logs.
+LOG_BLOCK_BYTES = 1 << 20
+LOG_LINE_BYTES = 64 * 1024
+
+_LOG_USING_RE = re.compile(
+    rb'^[ \t]*(?:cap(?:ture)?[ \t]+)?(?:qui(?:etly)?[ \t]+)?(?:cmd)?log[ \t]+using[ \t]+'
+    rb'(?:"([^"\n]{1,500})"|([^\s,"]{1,500}))', re.MULTILINE | re.IGNORECASE)
+# `{err}`, `{bf:text}`, `{search r(111), local:r(111);}` -> '', 'text', 'r(111);'
+_SMCL_TAG_RE = re.compile(rb'\{[A-Za-z_]{1,20}(?:[ \t][^:{}\n]{0,200})?(?::([^{}\n]{0,500}))?\}')
+_LOG_COMMAND_RE = re.compile(rb'^[ \t]{0,10}(?:\d{1,6})?\.[ \t](.{1,500})')
+# Candidate lines are located with C-level scans, never a per-line Python loop:
+# echoed commands (`. cmd`, `{com}. cmd`, `  2. cmd`) by one anchored regex and
+# events by substring search.
+_LOG_COMMAND_START_RE = re.compile(rb'\n[ \t]{0,10}(?:\{com\}[ \t]{0,4})?\d{0,6}\.[ \t]')
+_LOG_EVENT_MARKERS = (b'r(', b'onverge', b'deleted)')
+_STATA_ERROR_RE = re.compile(rb'^r\((\d{1,4})\);')
+_DROPPED_RE = re.compile(rb'\(([\d,]{1,20}) observations? deleted\)')
+_CONVERGENCE_RE = re.compile(
+    rb'convergence not achieved|failed to converge|did not converge', re.IGNORECASE)
+
+
+def find_stata_logs(do_file: Path, content: bytes, root: Path) -> List[Path]:
+    """Logs written by `do_file`, newest first, skipping any older than it.
+
+    Targets of its `log using` lines (relative to the project root or the
+    do-file) are tried first, then `scripts/stata/logs/<stem>.smcl|.log`.
+    Targets built from macros cannot be resolved and are ignored.
+    """
+    candidates = []
+    for m in _LOG_USING_RE.finditer(content):
+        target = decode_source(m.group(1) or m.group(2))
+        if '$' in target or '`' in target:
+            continue
+        path = Path(target)
+        if not path.suffix:
+            path = path.with_suffix('.smcl')  # Stata's default log format
+        candidates.extend([path] if path.is_absolute() else [root / path, do_file.parent / path])
+    for suffix in ('.smcl', '.log'):
+        candidates.append(root / STATA_LOG_DIR / f'{do_file.stem}{suffix}')
+
+    try:
+        do_mtime = do_file.stat().st_mtime_ns
+    except OSError:
+        return []
+    logs = {}
+    for path in candidates:
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            continue
+        if mtime >= do_mtime:
+            logs.setdefault(path.resolve(), mtime)
+    return sorted(logs, key=logs.get, reverse=True)
+
+
+def _normalize_command(line: bytes) -> bytes:
+    return b' '.join(line.split())
+
+
+class StataLogScanner:
+    """Map events in a Stata log back to the lines of the do-file that ran.
+
+    The log is streamed in fixed-size blocks; only lines that may hold a
+    command or event are examined, SMCL tags are stripped from those, and
+    only the spans quoted in issues are decoded. Each echoed command
+    (`. cmd`, or `  2. cmd` inside loops) is matched to the next do-file
+    line with the same normalized text, so repeated commands map in order.
+    Repeated events on the same command (e.g. a warning in every bootstrap
+    replication) are reported once.
+    """
+
+    def __init__(self, do_content: bytes):
+        self.commands = {}
+        for lineno, line in enumerate(do_content.split(b'\n'), 1):
+            norm = _normalize_command(line)
+            if norm and not norm.startswith((b'*', b'//')):
+                self.commands.setdefault(norm, []).append(lineno)
+
+    def _locate(self, command: bytes, cursor: int) -> int:
+        """First do-file line running `command` after `cursor` (else its first use, or 0)."""
+        lines = self.commands.get(_normalize_command(command))
+        if not lines:
+            return 0
+        pos = bisect.bisect_right(lines, cursor)
+        return lines[pos] if pos < len(lines) else lines[0]
+
+    def _candidates(self, block: bytes) -> List[int]:
+        """Start offsets of lines in `block` that may hold a command or event."""
+        starts = {m.start() + 1 for m in _LOG_COMMAND_START_RE.finditer(block)}
+        for marker in _LOG_EVENT_MARKERS:
+            pos = block.find(marker)
+            while pos != -1:
+                starts.add(block.rfind(b'\n', 0, pos) + 1)
+                pos = block.find(marker, pos + 1)
+        return sorted(starts)
+
+    @staticmethod
+    def _clean(line: bytes) -> bytes:
+        return _SMCL_TAG_RE.sub(lambda m: m.group(1) or b'', line[:LOG_LINE_BYTES]).strip()
+
+    def _previous(self, block: bytes, start: int, tail: bytes) -> bytes:
+        """Nearest non-blank line before offset `start` (the error message)."""
+        end = start - 1
+        for _ in range(3):
+            if end <= 0:
+                return self._clean(tail)
+            begin = block.rfind(b'\n', 0, end) + 1
+            text = self._clean(block[begin:end])
+            if text:
+                return text
+            end = begin - 1
+        return b''
+
+    def scan(self, log_path: Path, log_key: str) -> Dict[str, List[Issue]]:
+        errors = {}
+        warnings = {}
+        dropped = {}
+        command = b''
+        do_line = cursor = 0
+        carry = b'\n'   # lets the first line match like any other line start
+        line_base = 0   # lines completed before the current block, minus the virtual one
+        tail = b''
+        with open(log_path, 'rb') as f:
+            while True:
+                data = f.read(LOG_BLOCK_BYTES)
+                if not data and not carry:
+                    break
+                block = carry + data if data else carry + b'\n'
+                cut = block.rfind(b'\n') + 1
+                block, carry = block[:cut], block[cut:]
+                if len(carry) > LOG_LINE_BYTES:
+                    carry = carry[:LOG_LINE_BYTES]
+                counted = 0
+                log_line = line_base
+                for start in self._candidates(block):
+                    log_line += block.count(b'\n', counted, start)
+                    counted = start
+                    end = block.find(b'\n', start)
+                    text = self._clean(block[start:end])
+                    if not text:
+                        continue
+                    m = _LOG_COMMAND_RE.match(text)
+                    if m:
+                        command = m.group(1)
+                        located = self._locate(command, cursor)
+                        if located:
+                            do_line = cursor = located
+                        else:
+                            do_line = 0
+                        continue
+                    shown = decode_source(command[:80]) if command else '(unknown)'
+                    m = _STATA_ERROR_RE.match(text)
+                    if m:
+                        key = (do_line, command, m.group(1))
+                        if key not in errors:
+                            message = self._previous(block, start, tail)
+                            errors[key] = Issue('stata_runtime_error', do_line,
+                                                (m.group(1).decode('ascii'), shown,
+                                                 decode_source(message[:200]), log_key, log_line))
+                    elif _CONVERGENCE_RE.search(text):
+                        if (do_line, command) not in warnings:
+                            warnings[(do_line, command)] = Issue(
+                                'convergence_warning', do_line,
+                                (shown, decode_source(text[:200]), log_key, log_line))
+                    else:
+                        m = _DROPPED_RE.search(text)
+                        if m:
+                            count = int(m.group(1).replace(b',', b''))
+                            first = dropped.get((do_line, command))
+                            dropped[(do_line, command)] = (count + (first[0] if first else 0),
+                                                           first[1] if first else log_line)
+                line_base += block.count(b'\n')
+                tail = block[block.rfind(b'\n', 0, len(block) - 1) + 1:]
+                if not data:
+                    break
+        minor = [Issue('dropped_observations', line, (f'{count:,}', decode_source(cmd[:80]),
+                                                      log_key, log_line))
+                 for (line, cmd), (count, log_line) in dropped.items()]
+        return {'critical': list(errors.values()), 'major': list(warnings.values()),
+                'minor': minor}
+
+
+# ==============================================================================
+# STATA PIPELINE (master do-file call graph, inherited settings, cached nodes)
+# ==============================================================================
+
+# Settings a callee inherits from whoever ran before it
+STATA_INHERITED = ('clear', 'seed', 'log')
+# Comments are blanked (newlines kept) so line numbers survive parsing
+_STATA_COMMENT_RE = re.compile(
+    rb'/\*[\s\S]*?(?:\*/|\Z)|(?:^|(?<=[ \t]))//[^\n]*|^[ \t]*\*[^\n]*', re.MULTILINE)
+_STATA_ARG = rb'`"[^\n]*?"\'|"[^"\n]*"|[^\s,]+'
+_STATA_STATEMENT_RE = re.compile(
+    rb'[ \t]*(?:(?:quietly|qui|capture|cap|noisily|noi)\b[ \t]*:?[ \t]*)*(?:'
+    rb'(?P<call>do|run|include)[ \t]+(?P<target>' + _STATA_ARG + rb')'
+    rb'|(?:cd|chdir)[ \t]+(?P<cd>' + _STATA_ARG + rb')'
+    rb'|gl(?:o|ob|oba|obal)?[ \t]+(?P<global>[A-Za-z_]\w*)[ \t]*(?:=[ \t]*)?(?P<value>[^\n]*)'
+    rb'|(?P<clear>clear[ \t]+(?:all\b|\*))'
+    rb'|(?P<seed>set[ \t]+seed\b)'
+    rb'|(?P<log>(?:cmd)?log[ \t]+using\b))')
+_STATA_GLOBAL_USE_RE = re.compile(rb'\$\{?([A-Za-z_]\w*)')
+_GLOBAL_REF_RE = re.compile(r'\$\{([A-Za-z_]\w*)\}|\$([A-Za-z_]\w*)')
+# Globals Stata itself maintains ($S_DATE, $S_FN, ...) and function keys
+_SYSTEM_GLOBAL_RE = re.compile(r'S_|F\d+$')
+
+
+def _stata_unquote(raw: bytes) -> str:
+    """Text of a Stata argument: `"..."' and "..." quotes removed."""
+    text = decode_source(raw).strip()
+    if text.startswith('`"') and text.endswith('"\''):
+        return text[2:-2]
+    if text.startswith('"'):
+        return text[1:].split('"', 1)[0]
+    return text
+
+
+def expand_globals(text: str, globals_: Dict[str, str]) -> str:
+    """Substitute known `$name`/`${name}` references; unknown ones are left."""
+    return _GLOBAL_REF_RE.sub(lambda m: globals_.get(m.group(1) or m.group(2), m.group(0)),
+                              text)
+
+
+def stata_pipeline_events(content: bytes) -> List[list]:
+    """Statements a pipeline walk needs, in execution order.
+
+    Each is [line, kind, name, value] with kind one of `use` (a global
+    is read), `global`, `cd`, `call` (name is do/run/include), `clear`,
+    `seed` or `log`. Reads on a line come before its definition or call.
+    """
+    code = _STATA_COMMENT_RE.sub(lambda m: re.sub(rb'[^\n]', b' ', m.group(0)), content)
+    events = []
+    for lineno, line in enumerate(code.split(b'\n'), 1):
+        for m in _STATA_GLOBAL_USE_RE.finditer(line):
+            events.append([lineno, 'use', m.group(1).decode('ascii'), ''])
+        m = _STATA_STATEMENT_RE.match(line)
+        if not m:
+            continue
+        if m.group('call'):
+            events.append([lineno, 'call', m.group('call').decode('ascii'),
+                           _stata_unquote(m.group('target'))])
+        elif m.group('cd'):
+            events.append([lineno, 'cd', '', _stata_unquote(m.group('cd'))])
+        elif m.group('global'):
+            events.append([lineno, 'global', m.group('global').decode('ascii'),
+                           _stata_unquote(m.group('value'))])
+        else:
+            events.append([lineno, m.lastgroup, '', ''])
+    return events
+
+
+class StataPipeline:
+    """Call graph of a master do-file and what each callee inherits.
+
+    Walking from the master in execution order, `do`/`run`/`include`
+    targets are resolved after expanding global macros (against the last
+    `cd`, the caller's directory, then the project root). Globals, `cd`,
+    `clear all`, `set seed` and `log using` carry into callees and, as in
+    Stata, persist after they return. A do-file called from several
+    places inherits only what every call site guarantees.
+
+    Parsed statements and per-file reports are cached in
+    `.claude/state/quality_score/`. A report is reused while the file,
+    its inherited settings, its pipeline issues (which cover what its
+    callees define) and the scoring options are unchanged, so an edit
+    re-analyzes the edited file plus the callers and callees it affects.
+    """
+
+    VERSION = 1
+
+    def __init__(self, master: Path, root: Path):
+        self.master = master
+        self.root = root
+        self._cache = JsonCache(root, 'stata_pipeline', self.VERSION)
+        data = self._cache.load()
+        self._facts = data.get('facts', {})
+        self._reports = data.get('reports', {})
+        self._dirty = False
+        self._exits = {}
+        self.order: List[str] = []
+        self.paths: Dict[str, Path] = {}
+        self.depth: Dict[str, int] = {}
+        self.calls: Dict[str, List[str]] = {}
+        self.inherited: Dict[str, Dict[str, bool]] = {}
+        self.issues: Dict[str, set] = {}
+
+    def events(self, path: Path, key: str) -> List[list]:
+        """Statements of `path`, re-parsed only when its mtime/size and hash change."""
+        signature = file_signature(path)
+        entry = self._facts.get(key)
+        if entry and entry['sig'] == signature:
+            return entry['events']
+        content = path.read_bytes()
+        digest = hashlib.sha1(content).hexdigest()
+        if not entry or entry['sha1'] != digest:
+            entry = self._facts[key] = {'sha1': digest,
+                                        'events': stata_pipeline_events(content)}
+        entry['sig'] = signature
+        self._dirty = True
+        return entry['events']
+
+    def build(self) -> 'StataPipeline':
+        state = {name: False for name in STATA_INHERITED}
+        state.update(globals={}, cwd=None)
+        self._visit(self.master, state, ())
+        return self
+
+    def _resolve(self, target: str, caller: Path, cwd: Optional[str]) -> Optional[Path]:
+        path = Path(target)
+        if not path.suffix:
+            path = path.with_suffix('.do')  # Stata's default for do/run/include
+        if path.is_absolute():
+            candidates = [path]
+        else:
+            candidates = [Path(base) / path for base in (cwd, caller.parent, self.root) if base]
+        return next((c for c in candidates if c.is_file()), None)
+
+    def _visit(self, path: Path, state: Dict, stack: Tuple[str, ...]) -> Dict:
+        """Walk `path` from `state`; returns the state after it has run."""
+        key = relative_key(path, self.root)
+        flags = {name: state[name] for name in STATA_INHERITED}
+        if key in self.inherited:
+            seen = self.inherited[key]
+            for name in STATA_INHERITED:
+                seen[name] = seen[name] and flags[name]
+        else:
+            self.order.append(key)
+            self.paths[key] = path
+            self.depth[key] = len(stack)
+            self.calls[key] = []
+            self.issues[key] = set()
+            self.inherited[key] = flags
+        memo = (key, json.dumps(state, sort_keys=True))
+        if memo in self._exits:
+            return self._exits[memo]
+
+        state = dict(state, globals=dict(state['globals']))
+        issues = self.issues[key]
+        for line, kind, name, value in self.events(path, key):
+            if kind == 'use':
+                if name not in state['globals'] and not _SYSTEM_GLOBAL_RE.match(name):
+                    issues.add(('undefined_global', line, (name,)))
+            elif kind == 'global':
+                state['globals'][name] = expand_globals(value, state['globals'])
+            elif kind == 'cd':
+                target = expand_globals(value, state['globals'])
+                if '$' not in target and '`' not in target:
+                    base = Path(state['cwd'] or path.parent)
+                    state['cwd'] = str(base / target)
+            elif kind == 'call':
+                target = expand_globals(value, state['globals'])
+                if '$' in target or '`' in target:
+                    continue  # built from locals, or an undefined global flagged above
+                child = self._resolve(target, path, state['cwd'])
+                if child is None:
+                    issues.add(('missing_do_file', line, (target,)))
+                    continue
+                child_key = relative_key(child, self.root)
+                if child_key not in self.calls[key]:
+                    self.calls[key].append(child_key)
+                if child_key in stack or child_key == key:
+                    continue  # recursive call: walk each do-file once per chain
+                state = self._visit(child, state, stack + (key,))
+            else:
+                state[kind] = True
+        self._exits[memo] = state
+        return state
+
+    def node_issues(self, key: str) -> List['Issue']:
+        return [Issue(code, line, args) for code, line, args in sorted(self.issues[key])]
+
+    def score(self, session: 'ScoringSession', verbose: bool = False,
+              budget_ms: Optional[float] = None, stata_logs: bool = False,
+              external: Optional['ExternalCheckRunner'] = None) -> Dict:
+        """Score every do-file in call order; the pipeline gets the lowest score."""
+        options = [budget_ms, stata_logs, sorted(external.names) if external else []]
+        code_index = session.code_index(self.root)
+        code_index.refresh()
+        files = []
+        for key in self.order:
+            path = self.paths[key]
+            issues = self.node_issues(key)
+            inputs = [self._facts[key]['sha1'], self.inherited[key],
+                      [[i.code, i.line, list(i.args)] for i in issues], options,
+                      code_index.duplicates(key)]
+            if stata_logs:
+                logs = find_stata_logs(path, path.read_bytes(), self.root)
+                inputs.append(file_signature(logs[0]) if logs else None)
+            digest = hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+            cached = self._reports.get(key)
+            if cached and cached['inputs'] == digest:
+                report = cached['report']
+            else:
+                scorer = QualityScorer(path, verbose=verbose, budget_ms=budget_ms,
+                                       session=session, stata_logs=stata_logs,
+                                       external=external,
+                                       stata_context={'inherited': self.inherited[key],
+                                                      'issues': issues})
+                report = json.loads(json.dumps(scorer.score_stata(), default=json_default))
+                if not report['provisional']:
+                    self._reports[key] = {'inputs': digest, 'report': report}
+                    self._dirty = True
+                cached = None
+            files.append(dict(report, key=key, depth=self.depth[key], calls=self.calls[key],
+                              cached=cached is not None))
+        code_index.save()
+
+        score = min(f['score'] for f in files)
+        auto_fail = any(f['auto_fail'] for f in files)
+        status, threshold = score_status(score, auto_fail)
+        return {'filepath': str(self.master), 'score': score, 'status': status,
+                'threshold': threshold, 'auto_fail': auto_fail,
+                'reanalyzed': sum(not f['cached'] for f in files), 'files': files}
+
+    def save(self) -> None:
+        """Persist parsed statements and reports, dropping files that are gone."""
+        for store in (self._facts, self._reports):
+            for key in [k for k in store if not (self.root / k).exists()]:
+                del store[key]
+                self._dirty = True
+        if self._dirty:
+            self._cache.save({'facts': self._facts, 'reports': self._reports})
+            self._dirty = False
+
+
+# ==============================================================================
+# EXTERNAL CHECKERS (local tools run concurrently, results cached)
+# ==============================================================================
+
+# name -> spec. `command` gets the source on stdin unless it contains a
+# `{file}` placeholder; `{name}` is replaced by the reported file name.
+# `format` is 'ruff-json' or 'lines' (each output line matched against
+# `pattern` with named groups line, code and message). `rules` map tool
+# codes (regex, first match wins) to an ISSUE_CODES entry and severity;
+# unmatched codes become minor style violations.
+EXTERNAL_CHECKERS = {
+    'chktex': {
+        'kinds': ('beamer',),
+        'command': ['chktex', '-q', '-I0', '-f', '%l:%n:%m\n'],
+        'version': ['chktex', '--version'],
+        'timeout': 20,
+        'format': 'lines',
+        'pattern': r'^(?P<line>\d+):(?P<code>\d+):(?P<message>.*)$',
+        # 9/10/15/17: unmatched or mismatched delimiters
+        'rules': [(r'^(?:9|10|15|17)$', 'external_error', 'major')],
+    },
+    'ruff': {
+        'kinds': ('python',),
+        'command': ['ruff', 'check', '--output-format', 'json', '--no-cache',
+                    '--exit-zero', '--stdin-filename', '{name}', '-'],
+        'version': ['ruff', '--version'],
+        'timeout': 20,
+        'format': 'ruff-json',
+        'rules': [(r'^F821$', 'external_undefined_name', 'critical'),
+                  (r'^E501$', 'external_long_line', 'minor'),
+                  (r'^(?:E9|F)', 'external_error', 'major')],
+    },
+}
+# Project-specific checkers (e.g. a Stata linter) in the same format, as JSON
+CHECKERS_CONFIG = Path('.claude') / 'quality_checkers.json'
+
+
+def checker_spec_problem(spec) -> Optional[str]:
+    """Why a configured checker spec is unusable, or None if it is valid."""
+    if not isinstance(spec, dict):
+        return 'spec is not an object'
+    command = spec.get('command')
+    if not (isinstance(command, list) and command
+            and all(isinstance(arg, str) for arg in command)):
+        return '`command` must be a non-empty list of strings'
+    kinds = spec.get('kinds', ())
+    if not isinstance(kinds, (list, tuple)) or not set(kinds) <= set(SCORE_KINDS.values()):
+        return f'`kinds` must list some of {", ".join(sorted(SCORE_KINDS.values()))}'
+    if not isinstance(spec.get('timeout', 30), (int, float)):
+        return '`timeout` must be a number of seconds'
+    fmt = spec.get('format', 'lines')
+    if fmt not in ('lines', 'ruff-json'):
+        return f'unknown `format` {fmt!r}'
+    patterns = []
+    if fmt == 'lines':
+        if not isinstance(spec.get('pattern'), str):
+            return "`pattern` is required for format 'lines'"
+        patterns.append(spec['pattern'])
+    rules = spec.get('rules', [])
+    if not isinstance(rules, list) or not all(
+            isinstance(rule, (list, tuple)) and len(rule) == 3
+            and all(isinstance(part, str) for part in rule) for rule in rules):
+        return '`rules` must be [pattern, issue code, severity] triples'
+    patterns.extend(rule[0] for rule in rules)
+    for pattern in patterns:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            return f'bad regex {pattern!r}: {e}'
+    return None
+
+
+def load_checkers(root: Path) -> Dict[str, Dict]:
+    """Built-in checkers plus the valid ones in `.claude/quality_checkers.json`.
+
+    Invalid configured specs are reported on stderr and left out.
+    """
+    checkers = dict(EXTERNAL_CHECKERS)
+    try:
+        configured = json.loads((root / CHECKERS_CONFIG).read_text(encoding='utf-8'))
+    except OSError:
+        return checkers
+    except ValueError as e:
+        print(f"Note: {root / CHECKERS_CONFIG}: invalid JSON ({e}); ignoring it",
+              file=sys.stderr)
+        return checkers
+    if not isinstance(configured, dict):
+        print(f"Note: {root / CHECKERS_CONFIG}: expected an object of name -> spec; "
+              f"ignoring it", file=sys.stderr)
+        return checkers
+    for name, spec in configured.items():
+        problem = checker_spec_problem(spec)
+        if problem:
+            print(f"Note: {CHECKERS_CONFIG}: checker {name!r} skipped: {problem}",
+                  file=sys.stderr)
+        else:
+            checkers[name] = spec
+    return checkers
+
+
+def _parse_checker_output(spec: Dict, output: str) -> List[Tuple[int, str, str]]:
+    """(line, code, message) findings from a checker's stdout."""
+    if spec.get('format') == 'ruff-json':
+        try:
+            findings = json.loads(output or '[]')
+        except ValueError:
+            return []
+        return [((f.get('location') or {}).get('row') or 0, str(f.get('code') or ''),
+                 f.get('message', '')) for f in findings]
+    pattern = re.compile(spec['pattern'])
+    result = []
+    for line in output.splitlines():
+        m = pattern.match(line)
+        if m:
+            groups = m.groupdict()
+            result.append((int(groups.get('line') or 0), groups.get('code') or '',
+                           (groups.get('message') or '').strip()))
+    return result
+
+
+class ExternalCheckRunner:
+    """Run local checkers (chktex, ruff, ...) concurrently on scored files.
+
+    Jobs go to a thread pool of `jobs` workers as soon as files are
+    submitted, so tools run while earlier files are being scored. Each
+    tool gets its spec's timeout. Parsed findings are cached per (tool,
+    tool version, command, content hash) under
+    `.claude/state/quality_score/`. Missing or failing tools are reported
+    once on stderr and otherwise ignored.
+    """
+
+    VERSION = 1
+    MAX_CACHE_ENTRIES = 5000
+
+    def __init__(self, names: Iterable[str], jobs: int = 4):
+        self.names = set(names)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._futures = {}
+        self._caches = {}
+        self._checkers = {}
+        self._warned = set()
+
+    def _warn(self, message: str) -> None:
+        with self._lock:
+            if message in self._warned:
+                return
+            self._warned.add(message)
+        print(f"Note: {message}", file=sys.stderr)
+
+    def checkers(self, root: Path) -> Dict[str, Dict]:
+        with self._lock:
+            if root not in self._checkers:
+                self._checkers[root] = {
+                    name: spec for name, spec in load_checkers(root).items()
+                    if 'all' in self.names or name in self.names}
+            return self._checkers[root]
+
+    def _version(self, name: str, spec: Dict) -> Optional[str]:
+        """Tool version string, or None when the tool is not installed."""
+        with self._lock:
+            if name in self._versions:
+                return self._versions[name]
+        version = None
+        if shutil.which(spec['command'][0]):
+            try:
+                result = subprocess.run(spec.get('version', spec['command'][:1]),
+                                        capture_output=True, text=True, timeout=10)
+                version = (result.stdout or result.stderr).strip()[:100] or 'unknown'
+            except (OSError, subprocess.TimeoutExpired):
+                version = None
+        if version is None:
+            self._warn(f"{name} not available; skipping it")
+        with self._lock:
+            self._versions[name] = version
+        return version
+
+    def _cache(self, root: Path) -> Tuple[JsonCache, Dict]:
+        with self._lock:
+            if root not in self._caches:
+                cache = JsonCache(root, 'external_checks', self.VERSION)
+                self._caches[root] = (cache, cache.load())
+            return self._caches[root]
+
+    def _run(self, name: str, spec: Dict, filepath: Path, content: Optional[bytes],
+             root: Path) -> List[Tuple[str, str, int, tuple]]:
+        """Findings of one tool on one file as (severity, code, line, args)."""
+        version = self._version(name, spec)
+        if version is None:
+            return []
+        on_disk = any('{file}' in arg for arg in spec['command'])
+        if content is None:
+            try:
+                content = filepath.read_bytes()
+            except OSError:
+                return []
+        elif on_disk:
+            return []  # tool needs a real file; in-memory buffers are skipped
+        digest = hashlib.sha1(content).hexdigest()
+        key = '\x00'.join((name, version, json.dumps(spec['command']), digest))
+        cache, entries = self._cache(root)
+        with self._lock:
+            cached = entries.get(key)
+        if cached is not None:
+            return [tuple(entry[:3]) + (tuple(entry[3]),) for entry in cached]
+
+        command = [arg.replace('{file}', str(filepath)).replace('{name}', str(filepath))
+                   for arg in spec['command']]
+        try:
+            result = subprocess.run(command, input=None if on_disk else content,
+                                    capture_output=True, timeout=spec.get('timeout', 30))
+        except subprocess.TimeoutExpired:
+            self._warn(f"{name} timed out on {filepath}")
+            return []
+        except OSError as e:
+            self._warn(f"{name} failed: {e}")
+            return []
+        findings = []
+        try:
+            for line, code, message in _parse_checker_output(spec,
+                                                             decode_source(result.stdout)):
+                issue_code, severity = 'external_warning', 'minor'
+                for pattern, mapped, mapped_severity in spec.get('rules', []):
+                    if re.search(pattern, code):
+                        if (mapped in ISSUE_CODES
+                                and mapped_severity in ('critical', 'major', 'minor')):
+                            issue_code, severity = mapped, mapped_severity
+                        break
+                findings.append((severity, issue_code, line, (name, code, message[:200])))
+        except (AttributeError, KeyError, TypeError, ValueError, re.error) as e:
+            # Unexpected output must not fail scoring of the file
+            self._warn(f"{name} output could not be parsed ({type(e).__name__}: {e}); "
+                       f"ignoring its findings")
+            return []
+        with self._lock:
+            entries[key] = [list(f[:3]) + [list(f[3])] for f in findings]
+            while len(entries) > self.MAX_CACHE_ENTRIES:
+                entries.pop(next(iter(entries)))
+        return findings
+
+    def submit(self, filepath: Path, kind: str, root: Path,
+               content: Optional[bytes] = None) -> None:
+        """Start every configured checker for `kind` on `filepath`."""
+        for name, spec in self.checkers(root).items():
+            job = (str(filepath), name)
+            with self._lock:
+                if job in self._futures or kind not in spec.get('kinds', ()):
+                    continue
+                self._futures[job] = self.pool.submit(self._run, name, spec, filepath,
+                                                      content, root)
+
+    def submit_ahead(self, filepaths: Iterable[Path],
+                     project_root: Callable[[Path], Path]) -> Iterator[Path]:
+        """Yield `filepaths` while a feeder thread submits each one as it arrives.
+
+        The feeder drains `filepaths` (e.g. a directory walk still in
+        progress) independently of the consumer, so checkers start on
+        files ahead of scoring and scoring never waits for the walk.
+        """
+        found = queue.Queue()
+        done = object()
+        failure = []
+
+        def feed():
+            try:
+                for filepath in filepaths:
+                    kind = SCORE_KINDS.get(filepath.suffix)
+                    if kind and filepath.exists():
+                        self.submit(filepath, kind, project_root(filepath))
+                    found.put(filepath)
+            except Exception as e:  # re-raised in the consumer
+                failure.append(e)
+            finally:
+                found.put(done)
+
+        threading.Thread(target=feed, daemon=True).start()
+        while True:
+            filepath = found.get()
+            if filepath is done:
+                break
+            yield filepath
+        if failure:
+            raise failure[0]
+
+    def results(self, filepath: Path, kind: str, root: Path,
+                content: Optional[bytes] = None) -> Dict[str, List[Issue]]:
+        """Issues from all checkers on `filepath` (waits for running jobs)."""
+        self.submit(filepath, kind, root, content)
+        issues = {'critical': [], 'major': [], 'minor': []}
+        for name in self.checkers(root):
+            with self._lock:
+                future = self._futures.pop((str(filepath), name), None)
+            if future is None:
+                continue
+            for severity, code, line, args in future.result():
+                issues[severity].append(Issue(code, line, args))
+        return issues
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+        for cache, entries in self._caches.values():
+            cache.save(entries)
+
+
+# ==============================================================================
+# FILE DISCOVERY (recursive, .gitignore-aware, parallel)
+# ==============================================================================
+
+SCORABLE_SUFFIXES = ('.tex', '.py', '.do')
+DEFAULT_EXCLUDES = ['.git/', '.claude/', 'explorations/ARCHIVE/']
+
+
+def _glob_to_regex(pattern: str) -> str:
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            out.append('/.*')
+            i += 3
+            continue
+        if c == '*':
+            out.append('.*' if pattern.startswith('**', i) else '[^/]*')
+            i += 2 if pattern.startswith('**', i) else 1
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                out.append('[' + pattern[i + 1:end].replace('!', '^', 1) + ']')
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+class IgnoreRules:
+    """Gitignore-style patterns relative to one base directory.
+
+    Supports negation (`!`), directory-only patterns (trailing `/`),
+    anchoring (a `/` before the end) and `*`, `?`, `**`, `[...]` globs.
+    """
+
+    def __init__(self, base: str, patterns: Iterable[str]):
+        self.base = base
+        self.rules = []
+        for raw in patterns:
+            line = raw.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            anchored = '/' in line
+            body = _glob_to_regex(line.lstrip('/'))
+            regex = re.compile(('^' if anchored else '(?:^|/)') + body + '$')
+            self.rules.append((regex, negate, dir_only))
+
+    @classmethod
+    def from_file(cls, path: Path) -> Optional['IgnoreRules']:
+        try:
+            text = path.read_text(encoding='utf-8', errors='replace')
+        except OSError:
+            return None
+        return cls(str(path.parent), text.splitlines())
+
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        """True/False if a rule decides `path`, None if no rule applies."""
+        rel = os.path.relpath(path, self.base).replace(os.sep, '/')
+        if rel.startswith('..'):
+            return None
+        decision = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(rel):
+                decision = not negate
+        return decision
+
+
+def _is_ignored(chain: List[IgnoreRules], path: str, is_dir: bool) -> bool:
+    ignored = False
+    for rules in chain:
+        decision = rules.match(path, is_dir)
+        if decision is not None:
+            ignored = decision
+    return ignored
+
+
+def discover_files(paths: Iterable[Path], excludes: Iterable[str] = (),
+                   use_gitignore: bool = True, workers: int = 8):
+    """Yield scorable files under `paths` while the walk is still running.
+
+    Explicit file arguments are yielded as-is. Directories are scanned
+    by a thread pool (one `os.scandir` per task), honoring `.gitignore`
+    files from the project root down plus `excludes` (gitignore syntax,
+    relative to the project root). Symlinked directories such as the
+    `project/` Dropbox link are followed once; cycles are cut by
+    tracking (device, inode) pairs.
+    """
+    excludes = list(excludes)
+    for path in paths:
+        if not path.is_dir():
+            yield path
+            continue
+
+        top = Path(os.path.abspath(path))
+        root = next((d for d in (top, *top.parents) if (d / '.git').exists()), top)
+        chain = [IgnoreRules(str(root), excludes)]
+        if use_gitignore:
+            # .gitignore files above the scanned directory, root first
+            for directory in reversed(top.parents):
+                if directory == root or root in directory.parents:
+                    rules = IgnoreRules.from_file(directory / '.gitignore')
+                    if rules:
+                        chain.append(rules)
+
+        found = queue.Queue()
+        visited = set()
+        lock = threading.Lock()
+        pending = [0]
+        done = object()
+
+        def scan(directory: str, chain: List[IgnoreRules]):
+            try:
+                if use_gitignore:
+                    rules = IgnoreRules.from_file(Path(directory) / '.gitignore')
+                    if rules:
+                        chain = chain + [rules]
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()  # follows symlinks
+                        except OSError:
+                            continue
+                        if _is_ignored(chain, entry.path, is_dir):
+                            continue
+                        if is_dir:
+                            submit(entry.path, chain)
+                        elif entry.name.endswith(SCORABLE_SUFFIXES):
+                            found.put(Path(entry.path))
+            except OSError:
+                pass
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        found.put(done)
+
+        def submit(directory: str, chain: List[IgnoreRules]) -> bool:
+            try:
+                st = os.stat(directory)
+            except OSError:
+                return False
+            with lock:
+                if (st.st_dev, st.st_ino) in visited:
+                    return False
+                visited.add((st.st_dev, st.st_ino))
+                pending[0] += 1
+            pool.submit(scan, directory, chain)
+            return True
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # A fast scan can drain `pending` before we look, so ask submit()
+            if not submit(str(path), chain):
+                continue
+            while True:
+                item = found.get()
+                if item is done:
+                    break
+                yield item
+
+
+# ==============================================================================
+# SCORING SESSION (resources shared across files)
+# ==============================================================================
+
+class ScoringSession:
+    """Resources reused across scores in one process.
+
+    Holds parsed bibliographies (re-read only when the .bib file's
+    mtime/size changes), preamble macro and notation indexes and layout
+    calibration per project root, so batch runs and editor integrations
+    pay for setup once. The macro index is re-validated against the
+    preambles and the asset index against the figure directories each
+    lookup goes through (at most every INDEX_RECHECK_SECONDS), so a
+    long-lived session sees later edits.
+    `bibliography` supplies BibTeX text directly for in-memory scoring.
+    """
+
+    def __init__(self, bibliography: Optional[str] = None):
+        self._fixed_bib_keys = parse_bib_keys(bibliography) if bibliography else None
+        self._bib_keys = {}
+        self._roots = {}
+        self._notation = {}
+        self._layout_ratios = {}
+        self._assets = {}
+        self._macros = {}
+        self._slides = {}
+        self._code = {}
+
+    def project_root(self, path: Path) -> Path:
+        key = str(path.parent)
+        root = self._roots.get(key)
+        if root is None:
+            root = self._roots[key] = find_project_root(path)
+        return root
+
+    def bib_keys(self, bib_file: Path) -> Optional[set]:
+        """Keys in `bib_file`, or None if it does not exist."""
+        if self._fixed_bib_keys is not None:
+            return self._fixed_bib_keys
+        signature = file_signature(bib_file)
+        if signature is None:
+            return None
+        cached = self._bib_keys.get(bib_file)
+        if cached and cached[0] == signature:
+            return cached[1]
+        keys = parse_bib_keys(read_source(bib_file))
+        self._bib_keys[bib_file] = (signature, keys)
+        return keys
+
+    def macro_index(self, root: Path) -> MacroIndex:
+        index = self._macros.get(root)
+        if index is None or not index.current():
+            index = self._macros[root] = MacroIndex(root)
+            # The notation index classifies uses against these macros
+            self._notation.pop(root, None)
+        return index
+
+    def notation_index(self, root: Path) -> NotationIndex:
+        macros = self.macro_index(root)
+        index = self._notation.get(root)
+        if index is None:
+            index = self._notation[root] = NotationIndex(root, macros.math)
+        return index
+
+    def asset_index(self, root: Path) -> AssetIndex:
+        index = self._assets.get(root)
+        if index is None:
+            index = self._assets[root] = AssetIndex(root)
+        return index
+
+    def slide_index(self, root: Path) -> SlideIndex:
+        index = self._slides.get(root)
+        if index is None:
+            index = self._slides[root] = SlideIndex(root)
+        return index
+
+    def code_index(self, root: Path) -> CodeIndex:
+        index = self._code.get(root)
+        if index is None:
+            index = self._code[root] = CodeIndex(root)
+        return index
+
+    def layout_ratio(self, root: Path) -> float:
+        ratio = self._layout_ratios.get(root)
+        if ratio is None:
+            ratio = self._layout_ratios[root] = layout_ratio_for(root)
+        return ratio
+
+
+DEFAULT_SESSION = ScoringSession()
+
+
+# ==============================================================================
+# BASELINE (accepted issues, matched by fingerprint)
+# ==============================================================================
+
+def issue_fingerprints(issues: Iterable[Issue], lines: List[str], key: str) -> List[str]:
+    """Line-number-free fingerprints for `issues` in the file `key`.
+
+    Each hashes the file key, rubric type and the whitespace-normalized
+    source line (or the issue's parameters for file-level issues), plus
+    an occurrence counter so repeated identical lines stay distinct.
+    Edits elsewhere in the file therefore do not invalidate them.
+    """
+    seen = {}
+    prints = []
+    for issue in issues:
+        if 0 < issue.line <= len(lines):
+            context = ' '.join(lines[issue.line - 1].split())
+        else:
+            context = '\x1f'.join(str(arg) for arg in issue.args)
+        ident = (issue.type, context)
+        seen[ident] = seen.get(ident, 0) + 1
+        raw = '\x00'.join((key, issue.type, context, str(seen[ident])))
+        prints.append(hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16])
+    return prints
+
+
+class Baseline:
+    """Accepted issues per file, loaded into a set per file key.
+
+    File keys are posix paths relative to the baseline file's directory,
+    so the baseline can be committed alongside the sources it covers.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.anchor = path.resolve().parent
+        self.files: Dict[str, set] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> 'Baseline':
+        """Read `path`; a missing file gives an empty baseline."""
+        baseline = cls(path)
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return baseline
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION:
+            raise ValueError(f'{path}: not a version {cls.VERSION} quality baseline')
+        baseline.files = {key: set(prints) for key, prints in data.get('files', {}).items()}
+        return baseline
+
+    def save(self) -> None:
+        files = {key: sorted(prints) for key, prints in sorted(self.files.items()) if prints}
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'version': self.VERSION, 'files': files}, indent=1) + '\n',
+                       encoding='utf-8')
+        os.replace(tmp, self.path)
+
+    def key(self, filepath: Path) -> str:
+        return relative_key(filepath, self.anchor)
+
+    def known(self, filepath: Path) -> set:
+        return self.files.get(self.key(filepath), set())
+
+    def record(self, filepath: Path, prints: Iterable[str]) -> None:
+        """Accept the given fingerprints as the file's full baseline."""
+        self.files[self.key(filepath)] = set(prints)
+
+    def prune(self, filepath: Path, prints: Iterable[str]) -> int:
+        """Drop accepted issues no longer reported; returns how many."""
+        key = self.key(filepath)
+        known = self.files.get(key, set())
+        kept = known & set(prints)
+        self.files[key] = kept
+        return len(known) - len(kept)
+
+    def prune_missing(self) -> int:
+        """Forget files that no longer exist; returns how many issues that drops."""
+        gone = [key for key in self.files if not (self.anchor / key).exists()]
+        return sum(len(self.files.pop(key)) for key in gone)
+
+
+# ==============================================================================
+# SHARDED RUNS (deterministic partitions, mergeable partial results)
+# ==============================================================================
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """`i/N` -> (i, N), with shards numbered from 1."""
+    m = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', spec)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError(f'expected i/N with 1 <= i <= N, got {spec!r}')
+    return int(m.group(1)), int(m.group(2))
+
+
+def shard_of(filepath: Path, shards: int) -> int:
+    """Shard (1..shards) that scores `filepath`.
+
+    Hashes the path as discovered, so every machine running the same
+    command over the same checkout layout agrees on the partition.
+    """
+    digest = hashlib.sha1(filepath.as_posix().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards + 1
+
+
+def report_exit_code(report: Dict) -> int:
+    """Exit code one report contributes: 2 auto-fail, 1 below commit, else 0."""
+    if report['auto_fail']:
+        return 2
+    if report['score'] < THRESHOLDS['commit']:
+        return 1
+    return 0
+
+
+class ShardResults:
+    """Reports and errors from one `--shard i/N` run, or several merged.
+
+    The exit code is stored alongside the reports; merging takes the
+    maximum, which is what a single unsharded run would have returned.
+    """
+
+    VERSION = 1
+
+    def __init__(self, shard: int, shards: int):
+        self.shard = shard
+        self.shards = shards
+        self.results: List[Dict] = []
+        self.errors: List[Dict] = []
+        self.exit_code = 0
+
+    def add_report(self, report: Dict) -> None:
+        self.results.append(report)
+        self.exit_code = max(self.exit_code, report_exit_code(report))
+
+    def add_error(self, filepath: Path, message: str) -> None:
+        self.errors.append({'filepath': str(filepath), 'error': message})
+        self.exit_code = max(self.exit_code, 1)
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'version': self.VERSION, 'shard': self.shard,
+                                   'shards': self.shards, 'exit_code': self.exit_code,
+                                   'results': self.results, 'errors': self.errors},
+                                  default=json_default) + '\n', encoding='utf-8')
+        os.replace(tmp, path)
+
+    @classmethod
+    def merge(cls, paths: Iterable[Path]) -> 'ShardResults':
+        """Combine partial results; every shard 1..N must appear exactly once."""
+        merged = None
+        seen = set()
+        for path in paths:
+            try:
+                data = json.loads(path.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as e:
+                raise ValueError(f'{path}: unreadable shard results ({e})')
+            if not isinstance(data, dict) or data.get('version') != cls.VERSION:
+                raise ValueError(f'{path}: not a version {cls.VERSION} shard results file')
+            if merged is None:
+                merged = cls(0, data['shards'])
+            if data['shards'] != merged.shards:
+                raise ValueError(f'{path}: shard {data["shard"]}/{data["shards"]} '
+                                 f'does not belong to a {merged.shards}-way run')
+            if data['shard'] in seen:
+                raise ValueError(f'{path}: shard {data["shard"]}/{data["shards"]} given twice')
+            seen.add(data['shard'])
+            merged.results.extend(data['results'])
+            merged.errors.extend(data['errors'])
+            merged.exit_code = max(merged.exit_code, data['exit_code'])
+        if merged is None:
+            raise ValueError('no shard results given')
+        missing = sorted(set(range(1, merged.shards + 1)) - seen)
+        if missing:
+            raise ValueError('missing shard(s) '
+                             + ', '.join(f'{i}/{merged.shards}' for i in missing))
+        merged.results.sort(key=lambda report: report['filepath'])
+        merged.errors.sort(key=lambda error: error['filepath'])
+        return merged
+
+
 # ==============================================================================
 # QUALITY SCORER
 # ==============================================================================
 
+def score_status(score: int, auto_fail: bool) -> Tuple[str, str]:
+    """(status, threshold reached) for a score."""
+    if auto_fail:
+        return 'FAIL', 'None (auto-fail)'
+    if score >= THRESHOLDS['excellence']:
+        return 'EXCELLENCE', 'excellence'
+    if score >= THRESHOLDS['pr']:
+        return 'PR_READY', 'pr'
+    if score >= THRESHOLDS['commit']:
+        return 'COMMIT_READY', 'commit'
+    return 'BLOCKED', 'None (below commit)'
+
+
 class QualityScorer:
     """Calculate quality scores for project materials."""
 
-    def __init__(self, filepath: Path, verbose: bool = False):
+    def __init__(self, filepath: Path, verbose: bool = False,
+                 budget_ms: Optional[float] = None,
+                 content: Optional[Union[str, bytes]] = None,
+                 session: Optional[ScoringSession] = None,
+                 stata_logs: bool = False,
+                 external: Optional[ExternalCheckRunner] = None,
+                 stata_context: Optional[Dict] = None):
         self.filepath = filepath
         self.verbose = verbose
+        self.budget_ms = budget_ms
+        self.stata_logs = stata_logs
+        self.external = external
+        # {'inherited': settings from callers, 'issues': call-graph issues}
+        self.stata_context = stata_context
+        self.content = content
+        self.session = session or DEFAULT_SESSION
+        self.report = None
         self.score = 100
         self.issues = {
             'critical': [],
@@ -697,191 +3920,346 @@ class QualityScorer:
             'minor': []
         }
         self.auto_fail = False
+        self.skipped_checks = []
+        self.baselined = 0
+
+    def _read_bytes(self) -> bytes:
+        """Raw source: in-memory content if given, else the file on disk."""
+        if self.content is None:
+            return self.filepath.read_bytes()
+        if isinstance(self.content, str):
+            return self.content.encode('utf-8')
+        return self.content
+
+    def _read(self) -> str:
+        """Source text, decoded once in its sniffed encoding."""
+        if isinstance(self.content, str):
+            return self.content
+        return decode_source(self._read_bytes())
+
+    def run(self, kind: str) -> Dict:
+        """Score as `kind` ('beamer', 'python' or 'stata')."""
+        return getattr(self, f'score_{kind}')()
+
+    def fingerprints(self, key: str) -> Dict[str, List[str]]:
+        """Baseline fingerprints of the reported issues, per severity."""
+        lines = self._read().splitlines()
+        prints = issue_fingerprints(
+            [issue for severity in ('critical', 'major', 'minor') for issue in self.issues[severity]],
+            lines, key)
+        result = {}
+        for severity in ('critical', 'major', 'minor'):
+            count = len(self.issues[severity])
+            result[severity], prints = prints[:count], prints[count:]
+        return result
+
+    def apply_baseline(self, baseline: Baseline) -> Dict:
+        """Drop issues accepted in `baseline` and re-score what is left.
+
+        Auto-fails are never suppressed: the file must compile to be scored.
+        """
+        known = baseline.known(self.filepath)
+        if self.auto_fail or not known:
+            return self.report
+        prints = self.fingerprints(baseline.key(self.filepath))
+        for severity, issues in self.issues.items():
+            kept = [issue for issue, fp in zip(issues, prints[severity]) if fp not in known]
+            self.baselined += len(issues) - len(kept)
+            self.issues[severity] = kept
+        self.score = max(0, 100 - sum(issue.points for issues in self.issues.values()
+                                      for issue in issues))
+        return self._generate_report()
+
+    def _external_check(self, kind: str) -> Tuple[str, Callable]:
+        """The ('external', check) pair running configured local checkers."""
+        def external():
+            root = self.session.project_root(self.filepath)
+            raw = None if self.content is None else self._read_bytes()
+            found = self.external.results(self.filepath, kind, root, raw)
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, found[severity])
+        return 'external', external
+
+    def _duplicate_code_check(self, lang: str) -> Tuple[str, Callable]:
+        """The ('duplicate_code', check) pair comparing against all project scripts."""
+        def duplicate_code():
+            root = self.session.project_root(self.filepath)
+            index = self.session.code_index(root)
+            key = relative_key(self.filepath, root)
+            # An in-memory buffer is indexed only for this check: the saved
+            # index keeps what is on disk; other scripts always come from disk
+            saved = index.scripts.get(key)
+            saved = saved and dict(saved)  # update_script edits its 'sig' in place
+            index.update_script(key, lang, self._read(),
+                                file_signature(self.filepath) if self.content is None else None)
+            index.refresh(skip=key)
+            found = IssueDetector.check_duplicate_code(index, key)
+            if self.content is not None:
+                index.restore_script(key, saved)
+            index.save()
+            self._add_issues('major', found)
+        return 'duplicate_code', duplicate_code
+
+    def _add_issues(self, severity: str, issues: List['Issue']) -> None:
+        for issue in issues:
+            self.issues[severity].append(issue)
+            self.score -= issue.points
+
+    def _fail(self, issues: List['Issue']) -> bool:
+        """Record an auto-fail: only the failing issues are reported."""
+        self.issues = {'critical': list(issues), 'major': [], 'minor': []}
+        self.auto_fail = True
+        self.score = 0
+        return False
+
+    def _run_checks(self, checks: List[Tuple[str, Callable]], size: int) -> None:
+        """Run (name, check) pairs in order; a check returning False stops the run.
+
+        With a latency budget, the auto-fail gates (AUTO_FAIL_CHECKS) run
+        first and are never skipped; the other checks follow cheapest-first
+        by `detector_cost`. Once the next check would not fit in the
+        remaining budget, or the score is already below the commit
+        threshold (checks only deduct), the rest are recorded in
+        `skipped_checks` instead of run.
+        """
+        if self.budget_ms is not None:
+            checks = sorted(checks, key=lambda c: (c[0] not in AUTO_FAIL_CHECKS,
+                                                   detector_cost(c[0], size)))
+        start = time.perf_counter()
+        for pos, (name, check) in enumerate(checks):
+            if self.budget_ms is not None and name not in AUTO_FAIL_CHECKS:
+                elapsed = (time.perf_counter() - start) * 1000
+                if (self.score < THRESHOLDS['commit']
+                        or elapsed + detector_cost(name, size) > self.budget_ms):
+                    self.skipped_checks = [n for n, _ in checks[pos:]]
+                    return
+            if check() is False:
+                return
 
     def score_beamer(self) -> Dict:
         """Score Beamer/LaTeX lecture slides."""
-        content = self.filepath.read_text(encoding='utf-8')
-
-        # Check for LaTeX syntax issues (without compiling)
-        syntax_issues = IssueDetector.check_latex_syntax(content)
-        if syntax_issues:
-            for issue in syntax_issues:
-                self.issues['critical'].append({
-                    'type': 'compilation_failure',
-                    'description': f'LaTeX syntax issue at line {issue["line"]}',
-                    'details': issue['description'],
-                    'points': 100
-                })
-            self.auto_fail = True
-            self.score = 0
-            return self._generate_report()
-
-        # Check for undefined/broken citations
-        bib_file = self.filepath.parent.parent / 'bibliography.bib'
-        if not bib_file.exists():
-            bib_file = self.filepath.parent / 'bibliography.bib'
-        broken_citations = IssueDetector.check_broken_citations(content, bib_file)
-        for key in broken_citations:
-            self.issues['critical'].append({
-                'type': 'undefined_citation',
-                'description': f'Citation key not in bibliography: {key}',
-                'details': 'Add to bibliography.bib or fix key',
-                'points': 15
-            })
-            self.score -= 15
-
-        # Check for lines likely to cause overfull hbox
-        overfull_lines = IssueDetector.check_overfull_hbox_risk(content)
-        for line in overfull_lines:
-            self.issues['critical'].append({
-                'type': 'overfull_hbox',
-                'description': f'Potential overfull hbox at line {line}',
-                'details': 'Line >120 chars inside frame may overflow slide width',
-                'points': 10
-            })
-            self.score -= 10
-
-        # Check equation overflow
-        equation_overflows = IssueDetector.check_equation_overflow(content)
-        for line_num in equation_overflows:
-            self.issues['critical'].append({
-                'type': 'overfull_hbox',
-                'description': f'Potential equation overflow at line {line_num}',
-                'details': 'Single equation line >120 chars likely to overflow',
-                'points': 10
-            })
-            self.score -= 10
-
-        # Check for orphan/runt words
-        runt_lines = IssueDetector.check_orphan_runts(content)
-        for line in runt_lines:
-            self.issues['minor'].append({
-                'type': 'orphan_runt',
-                'description': f'Orphan/runt word at line {line}',
-                'details': 'Short word alone on last line of text block; '
-                           'rephrase to pull it back to the previous line',
-                'points': 2
-            })
-            self.score -= 2
-
-        # Rhetoric checks (slide-level)
-        frames = IssueDetector._parse_frames(content)
-
-        for issue in IssueDetector.check_label_titles(frames):
-            self.issues['major'].append(issue)
-            self.score -= issue['points']
-
-        for issue in IssueDetector.check_generic_closing(frames):
-            self.issues['major'].append(issue)
-            self.score -= issue['points']
-
-        for issue in IssueDetector.check_slide_overload(frames):
-            self.issues['major'].append(issue)
-            self.score -= issue['points']
-
-        for issue in IssueDetector.check_box_fatigue(frames):
-            self.issues['minor'].append(issue)
-            self.score -= issue['points']
-
-        for issue in IssueDetector.check_generic_opening(frames):
-            self.issues['minor'].append(issue)
-            self.score -= issue['points']
+        content = self._read()
+        root = self.session.project_root(self.filepath)
+        parsed = []
+        resolved = []
+
+        def macros():
+            # Preamble index (cached across files and runs) plus deck-local definitions
+            if not resolved:
+                resolved.append(self.session.macro_index(root).for_document(content))
+            return resolved[0]
+
+        def frames():
+            if not parsed:
+                parsed.append(IssueDetector._parse_frames(content, macros()))
+            return parsed[0]
+
+        def latex_syntax():
+            # Check for LaTeX syntax issues (without compiling)
+            syntax_issues = IssueDetector.check_latex_syntax(content)
+            if syntax_issues:
+                return self._fail([Issue('latex_syntax', issue['line'], (issue['description'],))
+                                   for issue in syntax_issues])
+
+        def citations():
+            # Check for undefined/broken citations
+            bib_file = self.filepath.parent.parent / 'bibliography.bib'
+            if not bib_file.exists():
+                bib_file = self.filepath.parent / 'bibliography.bib'
+            broken_citations = IssueDetector.check_broken_citations(
+                content, bib_file, self.session.bib_keys(bib_file))
+            self._add_issues('critical', [Issue('undefined_citation', 0, (key,))
+                                          for key in broken_citations])
+
+        def overfull_hbox():
+            # Check for lines likely to cause overfull hbox
+            overfull_lines = IssueDetector.check_overfull_hbox_risk(content)
+            self._add_issues('critical', [Issue('overfull_hbox', line) for line in overfull_lines])
+
+        def equation_overflow():
+            # Check equation overflow
+            equation_overflows = IssueDetector.check_equation_overflow(content)
+            self._add_issues('critical', [Issue('equation_overflow', line_num)
+                                          for line_num in equation_overflows])
+
+        def assets():
+            # Check \includegraphics/\input targets against the asset index
+            deck_dir = os.path.dirname(relative_key(self.filepath, root))
+            self._add_issues('critical', IssueDetector.check_missing_assets(
+                content, deck_dir, self.session.asset_index(root)))
+
+        def orphan_runts():
+            # Check for orphan/runt words
+            runt_lines = IssueDetector.check_orphan_runts(content, macros())
+            self._add_issues('minor', [Issue('orphan_runt', line) for line in runt_lines])
+
+        def rhetoric():
+            # Rhetoric checks (slide-level)
+            self._add_issues('major', IssueDetector.check_label_titles(frames()))
+            self._add_issues('major', IssueDetector.check_generic_closing(frames()))
+            self._add_issues('major', IssueDetector.check_slide_overload(frames()))
+            self._add_issues('minor', IssueDetector.check_box_fatigue(frames(), macros()))
+            self._add_issues('minor', IssueDetector.check_generic_opening(frames()))
+
+        def layout():
+            # Approximate layout (overflow and font shrinking) without compiling
+            estimator = LayoutEstimator.from_document(content, self.session.layout_ratio(root))
+            estimates = [estimator.estimate(frame) for frame in frames()]
+            self._add_issues('major', IssueDetector.check_text_overflow(frames(), estimates))
+            self._add_issues('minor',
+                             IssueDetector.check_font_size_reduction(frames(), estimates))
+
+        def notation():
+            # Cross-deck notation consistency (incremental series-wide index)
+            index = self.session.notation_index(root)
+            deck = relative_key(self.filepath, root)
+            # An in-memory buffer is indexed only for this check: the saved
+            # index keeps what is on disk; sibling decks always come from disk
+            saved = index.decks.get(deck)
+            saved = saved and dict(saved)  # update_deck edits its 'sig' in place
+            index.update_deck(deck, content,
+                              file_signature(self.filepath) if self.content is None else None)
+            index.refresh(self.filepath.resolve().parent, skip=deck)
+            found = IssueDetector.check_notation_consistency(index, deck)
+            if self.content is not None:
+                index.restore_deck(deck, saved)
+            index.save()
+            self._add_issues('major', found)
+
+        def duplicates():
+            # Near-duplicate frames across the series (MinHash/LSH, cached per frame)
+            index = self.session.slide_index(root)
+            deck = relative_key(self.filepath, root)
+            saved = index.decks.get(deck)
+            saved = saved and dict(saved)  # update_deck edits its 'sig' in place
+            index.update_deck(deck, content,
+                              file_signature(self.filepath) if self.content is None else None)
+            index.refresh(self.filepath.resolve().parent, skip=deck)
+            found = IssueDetector.check_duplicate_slides(index, deck)
+            if self.content is not None:
+                index.restore_deck(deck, saved)
+            index.save()
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, found[severity])
+
+        self._run_checks([
+            ('latex_syntax', latex_syntax),
+            ('citations', citations),
+            ('overfull_hbox', overfull_hbox),
+            ('equation_overflow', equation_overflow),
+            ('assets', assets),
+            ('orphan_runts', orphan_runts),
+            ('rhetoric', rhetoric),
+            ('layout', layout),
+            ('notation', notation),
+            ('duplicates', duplicates),
+        ] + ([self._external_check('beamer')] if self.external else []), len(content))
 
         self.score = max(0, self.score)
         return self._generate_report()
 
     def score_python(self) -> Dict:
         """Score Python script quality."""
-        content = self.filepath.read_text(encoding='utf-8')
-
-        # Check syntax
-        is_valid, error = IssueDetector.check_python_syntax(self.filepath)
-        if not is_valid:
-            self.auto_fail = True
-            self.issues['critical'].append({
-                'type': 'syntax_error',
-                'description': 'Python syntax error',
-                'details': error[:200],
-                'points': 100
-            })
-            self.score = 0
-            return self._generate_report()
-
-        # Check hardcoded paths
-        path_issues = IssueDetector.check_hardcoded_paths(content)
-        for line in path_issues:
-            self.issues['critical'].append({
-                'type': 'hardcoded_path',
-                'description': f'Hardcoded absolute path at line {line}',
-                'details': 'Use relative paths or Path() objects',
-                'points': 20
-            })
-            self.score -= 20
-
-        # Check Python-specific quality
-        quality_issues = IssueDetector.check_python_quality(content)
-        for severity in ['critical', 'major', 'minor']:
-            for issue in quality_issues.get(severity, []):
-                self.issues[severity].append(issue)
-                self.score -= issue['points']
+        content = self._read_bytes()
+        # In-memory sources, and any file under a latency budget, are compiled
+        # in-process instead of in a py_compile subprocess
+        in_process = self.content is not None or self.budget_ms is not None
+
+        def python_syntax():
+            # Check syntax
+            if in_process:
+                is_valid, error = IssueDetector.check_python_source(content,
+                                                                    str(self.filepath))
+            else:
+                is_valid, error = IssueDetector.check_python_syntax(self.filepath)
+            if not is_valid:
+                return self._fail([Issue('python_syntax', 0, (error[:200],))])
+
+        def hardcoded_paths():
+            # Check hardcoded paths
+            path_issues = IssueDetector.check_hardcoded_paths(content)
+            self._add_issues('critical', [Issue('hardcoded_path', line) for line in path_issues])
+
+        def python_quality():
+            # Check Python-specific quality
+            quality_issues = IssueDetector.check_python_quality(content)
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, quality_issues.get(severity, []))
+
+        self._run_checks([
+            ('python_compile' if in_process else 'python_syntax', python_syntax),
+            ('hardcoded_paths', hardcoded_paths),
+            ('python_quality', python_quality),
+            self._duplicate_code_check('python'),
+        ] + ([self._external_check('python')] if self.external else []), len(content))
 
         self.score = max(0, self.score)
         return self._generate_report()
 
     def score_stata(self) -> Dict:
         """Score Stata .do file quality."""
-        content = self.filepath.read_text(encoding='utf-8')
-
-        # Check hardcoded paths
-        path_issues = IssueDetector.check_hardcoded_paths(content)
-        for line in path_issues:
-            self.issues['critical'].append({
-                'type': 'hardcoded_path',
-                'description': f'Hardcoded absolute path at line {line}',
-                'details': 'Use global macros ($root, $data, etc.)',
-                'points': 20
-            })
-            self.score -= 20
-
-        # Check Stata-specific basics
-        stata_issues = IssueDetector.check_stata_basics(content)
-        for severity in ['critical', 'major', 'minor']:
-            for issue in stata_issues.get(severity, []):
-                self.issues[severity].append(issue)
-                self.score -= issue['points']
+        content = self._read_bytes()
+
+        def hardcoded_paths():
+            # Check hardcoded paths
+            path_issues = IssueDetector.check_hardcoded_paths(content)
+            self._add_issues('critical', [Issue('hardcoded_path_stata', line)
+                                          for line in path_issues])
+
+        def stata_basics():
+            # Check Stata-specific basics
+            inherited = self.stata_context['inherited'] if self.stata_context else None
+            stata_issues = IssueDetector.check_stata_basics(content, inherited)
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, stata_issues.get(severity, []))
+
+        def stata_pipeline():
+            # Missing callees and undefined globals found while walking the call graph
+            pipeline_issues = IssueDetector.check_stata_pipeline(self.stata_context['issues'])
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, pipeline_issues[severity])
+
+        def stata_logs():
+            # Events from the run's own log (streamed; skipped when stale)
+            root = self.session.project_root(self.filepath)
+            log_issues = IssueDetector.check_stata_logs(self.filepath, content, root)
+            for severity in ['critical', 'major', 'minor']:
+                self._add_issues(severity, log_issues.get(severity, []))
+
+        checks = [
+            ('hardcoded_paths', hardcoded_paths),
+            ('stata_basics', stata_basics),
+            self._duplicate_code_check('stata'),
+        ]
+        if self.stata_context:
+            checks.append(('stata_pipeline', stata_pipeline))
+        if self.stata_logs and self.content is None:
+            checks.append(('stata_logs', stata_logs))
+        if self.external:
+            checks.append(self._external_check('stata'))
+        self._run_checks(checks, len(content))
 
         self.score = max(0, self.score)
         return self._generate_report()
 
     def _generate_report(self) -> Dict:
         """Generate quality score report."""
-        if self.auto_fail:
-            status = 'FAIL'
-            threshold = 'None (auto-fail)'
-        elif self.score >= THRESHOLDS['excellence']:
-            status = 'EXCELLENCE'
-            threshold = 'excellence'
-        elif self.score >= THRESHOLDS['pr']:
-            status = 'PR_READY'
-            threshold = 'pr'
-        elif self.score >= THRESHOLDS['commit']:
-            status = 'COMMIT_READY'
-            threshold = 'commit'
-        else:
-            status = 'BLOCKED'
-            threshold = 'None (below commit)'
+        status, threshold = score_status(self.score, self.auto_fail)
 
         critical_count = len(self.issues['critical'])
         major_count = len(self.issues['major'])
         minor_count = len(self.issues['minor'])
         total_count = critical_count + major_count + minor_count
 
-        return {
+        self.report = {
             'filepath': str(self.filepath),
             'score': self.score,
             'status': status,
             'threshold': threshold,
             'auto_fail': self.auto_fail,
+            'provisional': bool(self.skipped_checks),
+            'skipped_checks': self.skipped_checks,
+            'baselined': self.baselined,
             'issues': {
                 'critical': self.issues['critical'],
                 'major': self.issues['major'],
@@ -895,10 +4273,11 @@ class QualityScorer:
             },
             'thresholds': THRESHOLDS
         }
+        return self.report
 
     def print_report(self, summary_only: bool = False) -> None:
-        """Print formatted quality report."""
-        report = self._generate_report()
+        """Print formatted quality report (reuses the last scored report)."""
+        report = self.report or self._generate_report()
 
         print(f"\n# Quality Score: {self.filepath.name}\n")
 
@@ -930,6 +4309,14 @@ class QualityScorer:
         elif report['status'] == 'FAIL':
             print(f"\n**Status:** Auto-fail (compilation/syntax error)")
 
+        if report['provisional']:
+            print(f"**Provisional:** skipped {len(report['skipped_checks'])} check(s) "
+                  f"under --budget-ms {self.budget_ms:g}: "
+                  f"{', '.join(report['skipped_checks'])}")
+
+        if report['baselined']:
+            print(f"**Baseline:** {report['baselined']} accepted issue(s) not counted")
+
         if summary_only:
             print(f"\n**Total issues:** {report['issues']['counts']['total']} "
                   f"({report['issues']['counts']['critical']} critical, "
@@ -971,10 +4358,150 @@ class QualityScorer:
                 print("Fix major issues listed above to improve score")
 
 
+# ==============================================================================
+# LIBRARY API (in-memory scoring)
+# ==============================================================================
+
+SCORE_KINDS = {'.tex': 'beamer', '.py': 'python', '.do': 'stata'}
+
+
+def kind_for(value: str) -> Optional[str]:
+    """Normalize 'beamer'/'tex'/'.tex', 'python'/'py', 'stata'/'do' to a kind."""
+    value = value.lower()
+    if value in SCORE_KINDS.values():
+        return value
+    return SCORE_KINDS.get(value if value.startswith('.') else '.' + value)
+
+
+def score_content(content: Union[str, bytes], kind: str, name: Optional[str] = None,
+                  session: Optional[ScoringSession] = None, verbose: bool = False,
+                  budget_ms: Optional[float] = None) -> Dict:
+    """Score source held in memory (e.g. an unsaved editor buffer).
+
+    `name` is reported as the filepath and locates project resources such
+    as bibliography.bib; it does not need to exist on disk.
+
+    Example:
+        report = score_content(buffer, 'beamer', name='slides/Lecture01.tex')
+    """
+    resolved = kind_for(kind)
+    if resolved is None:
+        raise ValueError(f'Unsupported kind: {kind!r} (use beamer, python or stata)')
+    if name is None:
+        name = '<memory>' + {v: k for k, v in SCORE_KINDS.items()}[resolved]
+    scorer = QualityScorer(Path(name), verbose=verbose, budget_ms=budget_ms,
+                           content=content, session=session)
+    return scorer.run(resolved)
+
+
+def score_batch(items: Iterable[Tuple[str, Union[str, bytes], str]],
+                session: Optional[ScoringSession] = None, **options) -> Iterator[Dict]:
+    """Lazily score (name, content, kind) triples with one shared session."""
+    session = session or ScoringSession()
+    for name, content, kind in items:
+        yield score_content(content, kind, name=name, session=session, **options)
+
+
 # ==============================================================================
 # CLI INTERFACE
 # ==============================================================================
 
+def calibrate_layout_from_files(filepaths: List[Path]) -> int:
+    """Tune the layout overflow threshold from labelled sample decks.
+
+    Each sample frame carries a `% overflow: yes` or `% overflow: no`
+    comment (taken from a real compile); unlabelled frames are ignored.
+    """
+    samples = []
+    for filepath in filepaths:
+        content = read_source(filepath)
+        estimator = LayoutEstimator.from_document(content)
+        for frame in IssueDetector._parse_frames(content):
+            label = re.search(r'%\s*overflow:\s*(yes|no)\b', frame['body'])
+            if not label:
+                continue
+            est = estimator.estimate(frame)
+            samples.append((est['height'] / est['available'], label.group(1) == 'yes'))
+    if not samples:
+        print("Error: no frames labelled with `% overflow: yes|no`")
+        return 1
+    ratio = calibrate_layout(samples)
+    correct = sum((fill > ratio) == overflowed for fill, overflowed in samples)
+    root = find_project_root(filepaths[0])
+    JsonCache(root, 'layout_calibration', 1).save({'ratio': ratio, 'samples': len(samples)})
+    print(f"Layout overflow threshold: {ratio} "
+          f"({correct}/{len(samples)} sample frames classified correctly)")
+    return 0
+
+
+def merge_shards_from_files(filepaths: List[Path], as_json: bool = False) -> int:
+    """Combine `--shard` results files; returns the exit code of the full run."""
+    try:
+        merged = ShardResults.merge(filepaths)
+    except (KeyError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+    if as_json:
+        print(json.dumps(merged.results, indent=2))
+        return merged.exit_code
+
+    print(f"\n# Quality Scores: {len(merged.results)} file(s) from {merged.shards} shard(s)\n")
+    for report in sorted(merged.results, key=lambda r: (r['score'], r['filepath'])):
+        print(f"- {report['score']:>3}/100 {report['status']:<12} {report['filepath']}")
+    for error in merged.errors:
+        print(f"- Error: {error['error']}: {error['filepath']}")
+    blocked = sum(report_exit_code(report) == 1 for report in merged.results)
+    failed = sum(report_exit_code(report) == 2 for report in merged.results)
+    print(f"\n**Blocked:** {blocked}  **Auto-fail:** {failed}  **Errors:** {len(merged.errors)}")
+    return merged.exit_code
+
+
+def score_pipelines_from_files(filepaths: List[Path], args: argparse.Namespace) -> int:
+    """Score each master do-file's pipeline as a unit; returns the worst exit code."""
+    external = (ExternalCheckRunner(args.checkers.split(','), jobs=args.checker_jobs)
+                if args.checkers else None)
+    session = DEFAULT_SESSION
+    reports = []
+    exit_code = 0
+    for master in filepaths:
+        if not master.is_file() or master.suffix != '.do':
+            print(f"Error: not a master do-file: {master}")
+            exit_code = max(exit_code, 1)
+            continue
+        pipeline = StataPipeline(master, session.project_root(master)).build()
+        report = pipeline.score(session, verbose=args.verbose, budget_ms=args.budget_ms,
+                                stata_logs=args.stata_logs, external=external)
+        pipeline.save()
+        reports.append(report)
+        exit_code = max(exit_code, report_exit_code(report))
+        if args.json:
+            continue
+
+        print(f"\n# Stata Pipeline: {master.name} ({len(report['files'])} do-file(s), "
+              f"{report['reanalyzed']} re-analyzed)\n")
+        print(f"## Pipeline Score: {report['score']}/100 [{report['status']}]\n")
+        for node in report['files']:
+            print(f"{'  ' * node['depth']}- {node['score']:>3}/100 {node['status']:<12} "
+                  f"{node['key']}{' (cached)' if node['cached'] else ''}")
+        if args.summary:
+            continue
+        severities = ['critical', 'major'] + (['minor'] if args.verbose else [])
+        for node in report['files']:
+            shown = [(severity, issue) for severity in severities
+                     for issue in node['issues'][severity]]
+            if not shown:
+                continue
+            print(f"\n### {node['key']}")
+            for severity, issue in shown:
+                print(f"- [{severity}] **{issue['description']}** (-{issue['points']} points)")
+                print(f"  - {issue['details']}")
+    if external is not None:
+        external.close()
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    return exit_code
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Calculate quality scores for project materials',
@@ -993,12 +4520,41 @@ Examples:
   # Score multiple files
   python scripts/quality_score.py slides/*.tex
 
+  # Score every .tex/.py/.do under directories (honors .gitignore)
+  python scripts/quality_score.py slides/ scripts/ project/ --exclude 'drafts/'
+
   # Summary only (no detailed issues)
   python scripts/quality_score.py slides/Lecture01.tex --summary
 
   # Verbose output (include minor issues)
   python scripts/quality_score.py scripts/python/analysis.py --verbose
 
+  # Also run chktex/ruff (4 at a time), folding their findings into the score
+  python scripts/quality_score.py slides/ scripts/ --checkers all --checker-jobs 4
+
+  # Include errors and warnings from the do-file's last log
+  python scripts/quality_score.py scripts/stata/analysis.do --stata-logs
+
+  # Editor save hook: provisional score within ~100 ms
+  python scripts/quality_score.py scripts/python/analysis.py --budget-ms 100
+
+  # Accept today's issues, then report only new ones in hooks
+  python scripts/quality_score.py slides/ scripts/ --write-baseline quality_baseline.json
+  python scripts/quality_score.py slides/ scripts/ --baseline quality_baseline.json
+
+  # Forget accepted issues that have since been fixed
+  python scripts/quality_score.py slides/ scripts/ --refresh-baseline quality_baseline.json
+
+  # Nightly run split over 4 machines, then one combined report and exit code
+  python scripts/quality_score.py projects/ --shard 1/4 --shard-output shard1.json
+  python scripts/quality_score.py --merge-shards shard*.json
+
+  # Score a Stata pipeline from its master do-file (callees inherit settings)
+  python scripts/quality_score.py scripts/stata/master.do --stata-pipeline
+
+  # Calibrate the layout estimator on frames labelled `% overflow: yes|no`
+  python scripts/quality_score.py --calibrate-layout samples/overflow_frames.tex
+
 Quality Thresholds:
   80/100 = Commit threshold (blocks if below)
   90/100 = PR threshold (warning if below)
@@ -1011,56 +4567,154 @@ Exit Codes:
         """
     )
 
-    parser.add_argument('filepaths', type=Path, nargs='+', help='Path(s) to file(s) to score')
+    parser.add_argument('filepaths', type=Path, nargs='+',
+                        help='Path(s) to file(s) or directories to score')
     parser.add_argument('--summary', action='store_true', help='Show summary only')
     parser.add_argument('--verbose', action='store_true', help='Show all issues including minor')
     parser.add_argument('--json', action='store_true', help='Output as JSON')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='Gitignore-style pattern to skip when scanning directories '
+                             f'(default: {", ".join(DEFAULT_EXCLUDES)})')
+    parser.add_argument('--budget-ms', type=float, metavar='MS',
+                        help='Latency budget per file: run cheapest checks first, '
+                             'skip the rest and report a provisional score')
+    parser.add_argument('--stata-logs', action='store_true',
+                        help='Also scan each do-file\'s log (scripts/stata/logs/) for r(###) '
+                             'errors, convergence warnings and dropped observations')
+    parser.add_argument('--checkers', metavar='NAMES',
+                        help='Also run local checkers, comma-separated or "all" '
+                             f'(built-in: {", ".join(EXTERNAL_CHECKERS)}; more in {CHECKERS_CONFIG})')
+    parser.add_argument('--checker-jobs', type=int, default=os.cpu_count() or 4, metavar='N',
+                        help='Maximum concurrent checker processes (default: CPU count)')
+    parser.add_argument('--no-gitignore', action='store_true',
+                        help='Do not honor .gitignore files when scanning directories')
+    baseline_mode = parser.add_mutually_exclusive_group()
+    baseline_mode.add_argument('--baseline', type=Path, metavar='FILE',
+                               help='Score only issues not accepted in the baseline FILE')
+    baseline_mode.add_argument('--write-baseline', type=Path, metavar='FILE',
+                               help='Accept the current issues of the scored files into FILE')
+    baseline_mode.add_argument('--refresh-baseline', type=Path, metavar='FILE',
+                               help='Drop accepted issues in FILE that are no longer reported')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='Score only the files whose path hash falls in shard I of N '
+                             'and write their results to --shard-output')
+    parser.add_argument('--shard-output', type=Path, metavar='FILE',
+                        help='Partial results file for --shard (default: quality_shard_I_of_N.json)')
+    parser.add_argument('--merge-shards', action='store_true',
+                        help='Treat filepaths as --shard results files and combine them '
+                             'into one report and exit code')
+    parser.add_argument('--stata-pipeline', action='store_true',
+                        help='Treat filepaths as master do-files: follow do/run/include '
+                             'calls, pass clear all/set seed/log using/globals down, and '
+                             'score each pipeline as a unit')
+    parser.add_argument('--calibrate-layout', action='store_true',
+                        help='Treat filepaths as labelled sample decks and tune '
+                             'the text_overflow threshold (default: 1.0; see '
+                             'tests/fixtures/layout_samples.tex for the label format)')
 
     args = parser.parse_args()
 
-    results = []
-    exit_code = 0
+    if args.calibrate_layout:
+        sys.exit(calibrate_layout_from_files(args.filepaths))
+    if args.merge_shards:
+        sys.exit(merge_shards_from_files(args.filepaths, as_json=args.json))
+    if args.stata_pipeline:
+        sys.exit(score_pipelines_from_files(args.filepaths, args))
+    if args.shard and (args.write_baseline or args.refresh_baseline):
+        parser.error('--shard cannot write a baseline; run the baseline update unsharded')
 
-    for filepath in args.filepaths:
+    run = ShardResults(*(args.shard or (1, 1)))
+
+    baseline = None
+    baseline_path = args.baseline or args.write_baseline or args.refresh_baseline
+    if baseline_path:
+        try:
+            baseline = Baseline.load(baseline_path)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+    accepted = pruned = 0
+
+    discovered = discover_files(args.filepaths, DEFAULT_EXCLUDES + args.exclude,
+                                use_gitignore=not args.no_gitignore)
+    if args.shard:
+        discovered = (filepath for filepath in discovered
+                      if shard_of(filepath, run.shards) == run.shard)
+    external = None
+    if args.checkers:
+        # Queue checker runs as files are found so tools work while files are scored
+        external = ExternalCheckRunner(args.checkers.split(','), jobs=args.checker_jobs)
+        discovered = external.submit_ahead(discovered, DEFAULT_SESSION.project_root)
+
+    for filepath in discovered:
         if not filepath.exists():
             print(f"Error: File not found: {filepath}")
-            exit_code = 1
+            run.add_error(filepath, 'File not found')
             continue
 
         try:
-            scorer = QualityScorer(filepath, verbose=args.verbose)
-
-            if filepath.suffix == '.tex':
-                report = scorer.score_beamer()
-            elif filepath.suffix == '.py':
-                report = scorer.score_python()
-            elif filepath.suffix == '.do':
-                report = scorer.score_stata()
-            else:
+            scorer = QualityScorer(filepath, verbose=args.verbose,
+                                   budget_ms=args.budget_ms, stata_logs=args.stata_logs,
+                                   external=external)
+
+            kind = SCORE_KINDS.get(filepath.suffix)
+            if kind is None:
                 print(f"Error: Unsupported file type: {filepath.suffix}")
                 print(f"Supported types: .tex, .py, .do")
                 continue
+            report = scorer.run(kind)
 
-            results.append(report)
+            if args.write_baseline or args.refresh_baseline:
+                if scorer.auto_fail:
+                    # Never suppressed, and the other issues are unknown: keep the old entry
+                    print(f"Baseline: skipped {filepath} (auto-fail)")
+                    continue
+                prints = [fp for group in scorer.fingerprints(baseline.key(filepath)).values()
+                          for fp in group]
+                if args.write_baseline:
+                    baseline.record(filepath, prints)
+                    accepted += len(prints)
+                else:
+                    pruned += baseline.prune(filepath, prints)
+                continue
+            if baseline is not None:
+                report = scorer.apply_baseline(baseline)
+
+            run.add_report(report)
 
             if not args.json:
                 scorer.print_report(summary_only=args.summary)
 
-            if report['auto_fail']:
-                exit_code = max(exit_code, 2)
-            elif report['score'] < THRESHOLDS['commit']:
-                exit_code = max(exit_code, 1)
-
         except Exception as e:
             print(f"Error scoring {filepath}: {e}")
             import traceback
             traceback.print_exc()
-            exit_code = 1
+            run.add_error(filepath, f'Error scoring: {e}')
+
+    if external is not None:
+        external.close()
+
+    if args.write_baseline or args.refresh_baseline:
+        if args.refresh_baseline:
+            pruned += baseline.prune_missing()
+        baseline.save()
+        if args.write_baseline:
+            print(f"Baseline: accepted {accepted} issue(s) in {baseline_path}")
+        else:
+            print(f"Baseline: dropped {pruned} fixed issue(s) from {baseline_path}")
+        sys.exit(run.exit_code)
 
     if args.json:
-        print(json.dumps(results, indent=2))
+        print(json.dumps(run.results, indent=2, default=json_default))
+
+    if args.shard:
+        output = args.shard_output or Path(f'quality_shard_{run.shard}_of_{run.shards}.json')
+        run.save(output)
+        if not args.json:
+            print(f"\nShard {run.shard}/{run.shards}: {len(run.results)} file(s) "
+                  f"written to {output}")
 
-    sys.exit(exit_code)
+    sys.exit(run.exit_code)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,26 @@
+"""Latency-budget mode (`--budget-ms`): cheap checks only, auto-fail gates kept.
+
+Run with `python -m pytest tests/`.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import quality_score as qs  # noqa: E402
+
+
+def test_budget_compiles_python_in_process(tmp_path, monkeypatch):
+    (tmp_path / '.git').mkdir()
+    script = tmp_path / 'broken.py'
+    script.write_text('"""Broken."""\ndef f(:\n    pass\n', encoding='utf-8')
+
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError(f'subprocess started under a budget: {args[0]}')
+
+    monkeypatch.setattr(qs.subprocess, 'run', no_subprocess)
+    scorer = qs.QualityScorer(script, budget_ms=100, session=qs.ScoringSession())
+    report = scorer.run('python')
+    assert report['auto_fail'] and report['score'] == 0
+    assert [issue.code for issue in report['issues']['critical']] == ['python_syntax']
@@ -0,0 +1,199 @@
+"""Scaling tests: detector time must grow linearly on pathological input.
+
+Each detector runs on a generated input of size N and of size K*N; the
+ratio of the best-of-REPEATS timings must stay well below the K**2 a
+quadratic detector would show. Run with `python -m pytest tests/`.
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import quality_score as qs  # noqa: E402
+
+K = 4
+MAX_RATIO = 2 * K    # linear growth is ~K; quadratic would be ~K**2
+REPEATS = 3
+MIN_BASE_SECONDS = 0.02
+
+
+# ------------------------------------------------------------------------------
+# Pathological input generators (n scales the input size linearly)
+# ------------------------------------------------------------------------------
+
+def deck(body: str) -> str:
+    return '\\documentclass{beamer}\n\\begin{document}\n' + body + '\n\\end{document}\n'
+
+
+def long_lines(n: int) -> str:
+    return deck('\\begin{frame}{Long}\n' + 'word \\textbf{bold} $x_i$ ' * (40 * n)
+                + '\n\\end{frame}')
+
+
+def unclosed_frames(n: int) -> str:
+    return deck('\\begin{frame}[fragile]{Open ]{ ]{ ]{}\n\\item text\n' * (20 * n))
+
+
+def unclosed_environments(n: int) -> str:
+    return deck('\\begin{frame}{Envs}\n' + '\\begin{itemize}\n\\item x\n' * (20 * n)
+                + '\\end{frame}')
+
+
+def overlays(n: int) -> str:
+    return deck('\\begin{frame}{Overlays}\n' + '\\only<' * (50 * n) + '\n'
+                + '\\item[' * (50 * n) + '\n' + '\\textbf{' * (50 * n) + '\n\\end{frame}')
+
+
+def overlay_alternatives(n: int) -> str:
+    swap = '\\only<1>{\\includegraphics[width=0.8\\textwidth]{a}}'
+    return deck('\\begin{frame}{Swaps}\n' + swap * (20 * n) + '\n'
+                + '\\begin{onlyenv}<1>\nx\n\\end{onlyenv}\n' * (20 * n)
+                + '\\alt<1>{' * (20 * n) + '\n\\end{frame}')
+
+
+def nested_overlays(n: int) -> str:
+    return deck('\\begin{frame}{Nested}\n' + '\\only<1>{\\alt<2>{a}{b ' * (50 * n) + 'x'
+                + '}}' * (50 * n) + '\n\\end{frame}')
+
+
+def nested_braces(n: int) -> str:
+    return deck('\\begin{frame}{Nested}\n' + '{' * (100 * n) + 'x' + '}' * (100 * n)
+                + '\n$' + '\\frac{' * (20 * n) + '1' + '}{2}' * (20 * n) + '$\n\\end{frame}')
+
+
+def huge_table(n: int) -> str:
+    row = ' & '.join(f'{i}.5' for i in range(10)) + ' \\\\ '
+    return deck('\\begin{frame}{Table}\n\\begin{tabular}{' + 'c' * 10 + '}' + row * (20 * n)
+                + '\\end{tabular}\n\\end{frame}')
+
+
+def unclosed_citations(n: int) -> str:
+    return deck('\\begin{frame}{Cites}\n' + '\\cite{key,' * (50 * n) + '\n\\end{frame}')
+
+
+def asset_references(n: int) -> str:
+    return deck('\\graphicspath{{figures/}{../figures/}{' * (5 * n) + '\n\\begin{frame}{Assets}\n'
+                + ''.join(f'\\includegraphics[width=0.5\\textwidth]{{plots/missing{i}}}\n'
+                          f'\\input{{sections/part{i}}}\n' for i in range(20 * n))
+                + '\\includegraphics{' * (20 * n) + '\n\\end{frame}')
+
+
+def script_lines(n: int) -> str:
+    return ''.join(f'x{i} = df["col{i}"].mean() + "/Users/me/{i}"  # note\n'
+                   for i in range(100 * n))
+
+
+def stata_lines(n: int) -> str:
+    return ''.join(f'global g{i} "$root/{i}"\nqui do "$g{i}/step.do"\n'
+                   f'gen v{i} = log(w) if x > {i} // comment\n' for i in range(50 * n))
+
+
+DECKS = [long_lines, unclosed_frames, unclosed_environments, overlays, overlay_alternatives,
+         nested_overlays, nested_braces, huge_table, unclosed_citations, asset_references]
+
+
+# ------------------------------------------------------------------------------
+# Detectors under test (each takes the generated text)
+# ------------------------------------------------------------------------------
+
+def layout(content: str):
+    estimator = qs.LayoutEstimator.from_document(content)
+    return [estimator.estimate(frame) for frame in qs.IssueDetector._parse_frames(content)]
+
+
+class NoAssets(qs.AssetIndex):
+    """An empty asset index: every reference misses, so resolve() tries every candidate."""
+
+    def __init__(self):
+        self.root = Path('.')
+        self.dirs, self.files, self._lower, self._outside, self._checked = {}, set(), {}, {}, {}
+
+    def exists(self, rel: str) -> bool:
+        return False
+
+
+def frame_checks(content: str):
+    frames = qs.IssueDetector._parse_frames(content)
+    for check in (qs.IssueDetector.check_label_titles, qs.IssueDetector.check_slide_overload,
+                  qs.IssueDetector.check_box_fatigue, qs.IssueDetector.check_generic_opening,
+                  qs.IssueDetector.check_generic_closing):
+        check(frames)
+
+
+BEAMER_DETECTORS = {
+    'latex_syntax': qs.IssueDetector.check_latex_syntax,
+    'citations': lambda content: qs.IssueDetector.check_broken_citations(
+        content, Path('bibliography.bib'), bib_keys={'known'}),
+    'missing_assets': lambda content: qs.IssueDetector.check_missing_assets(
+        content, 'slides', NoAssets()),
+    'overfull_hbox': qs.IssueDetector.check_overfull_hbox_risk,
+    'equation_overflow': qs.IssueDetector.check_equation_overflow,
+    'orphan_runts': qs.IssueDetector.check_orphan_runts,
+    'parse_frames': qs.IssueDetector._parse_frames,
+    'frame_checks': frame_checks,
+    'layout': layout,
+    'notation': lambda content: qs.NotationIndex(Path('.'), macros={}).extract(content),
+    'slide_shingles': lambda content: qs.shingle_hashes(qs._DUP_TOKEN_RE.findall(content)),
+}
+
+SCRIPT_DETECTORS = {
+    'hardcoded_paths': lambda text: qs.IssueDetector.check_hardcoded_paths(text.encode()),
+    'python_quality': lambda text: qs.IssueDetector.check_python_quality(text.encode()),
+    'python_code_tokens': lambda text: qs.winnow(qs.code_tokens(text, 'python')),
+}
+
+STATA_DETECTORS = {
+    'stata_basics': lambda text: qs.IssueDetector.check_stata_basics(text.encode()),
+    'stata_code_tokens': lambda text: qs.winnow(qs.code_tokens(text, 'stata')),
+    'stata_pipeline_events': lambda text: qs.stata_pipeline_events(text.encode()),
+}
+
+
+def best_time(detector, content: str) -> float:
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        detector(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def growth_ratio(detector, generator) -> float:
+    """Time at K*N over time at N, with N grown until the base run is measurable."""
+    n = 1
+    while True:
+        base = best_time(detector, generator(n))
+        if base >= MIN_BASE_SECONDS or n >= 64:
+            break
+        n *= 2
+    return best_time(detector, generator(K * n)) / max(base, 1e-6)
+
+
+def assert_linear(name: str, detector, generator) -> None:
+    ratio = growth_ratio(detector, generator)
+    if ratio >= MAX_RATIO:
+        # Re-measure once: a scheduler hiccup is not quadratic growth
+        ratio = min(ratio, growth_ratio(detector, generator))
+    assert ratio < MAX_RATIO, (
+        f'{name} on {generator.__name__}: {K}x input took {ratio:.1f}x as long '
+        f'(limit {MAX_RATIO}x)')
+
+
+@pytest.mark.parametrize('generator', DECKS, ids=lambda g: g.__name__)
+@pytest.mark.parametrize('name', sorted(BEAMER_DETECTORS))
+def test_beamer_detectors_scale_linearly(name, generator):
+    assert_linear(name, BEAMER_DETECTORS[name], generator)
+
+
+@pytest.mark.parametrize('name', sorted(SCRIPT_DETECTORS))
+def test_script_detectors_scale_linearly(name):
+    assert_linear(name, SCRIPT_DETECTORS[name], script_lines)
+
+
+@pytest.mark.parametrize('name', sorted(STATA_DETECTORS))
+def test_stata_detectors_scale_linearly(name):
+    assert_linear(name, STATA_DETECTORS[name], stata_lines)
@@ -0,0 +1,137 @@
+"""Behavioural tests for the cross-file indexes (notation, slides, code).
+
+Each test builds a throwaway project under `tmp_path` (a `.git` directory
+marks its root) and scores files through the public entry points.
+Run with `python -m pytest tests/`.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import quality_score as qs  # noqa: E402
+
+DECK = r"""\documentclass{beamer}
+\begin{document}
+\begin{frame}{Returns to schooling rise with each extra year}
+Each extra year of schooling raises wages by about ten percent.
+$$ y_i = \alpha + \beta_i s_i + \varepsilon_i $$
+\end{frame}
+\end{document}
+"""
+
+
+def project(tmp_path: Path) -> Path:
+    (tmp_path / '.git').mkdir()
+    (tmp_path / 'slides').mkdir()
+    return tmp_path
+
+
+def write(path: Path, text: str) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding='utf-8')
+    return path
+
+
+def codes(report) -> list:
+    return [issue.code for severity in ('critical', 'major', 'minor')
+            for issue in report['issues'][severity]]
+
+
+def test_buffers_are_compared_but_never_persisted(tmp_path):
+    root = project(tmp_path)
+    deck = write(root / 'slides' / 'L1.tex', DECK)
+    buffer = root / 'slides' / 'unsaved.tex'
+    report = qs.score_content(DECK, 'beamer', name=str(buffer), session=qs.ScoringSession())
+    assert 'duplicate_slide' in codes(report)
+    state = root / qs.CACHE_DIR
+    for index in ('notation_index', 'slide_index'):
+        assert 'unsaved.tex' not in (state / f'{index}.json').read_text(encoding='utf-8')
+    report = qs.QualityScorer(deck, session=qs.ScoringSession()).run('beamer')
+    assert 'duplicate_slide' not in codes(report)
+
+
+CLEAN = '''def clean(frame):
+    frame = frame.dropna(subset=["wage", "educ"])
+    frame["lwage"] = np.log(frame["wage"])
+    frame["exper2"] = frame["exper"] ** 2
+    frame = frame[frame["age"].between(25, 64)]
+    model = smf.ols("lwage ~ educ + exper + exper2", data=frame).fit()
+    table = model.summary2().tables[1]
+    table.to_csv("output/table.csv")
+    return frame, model
+'''
+HEADER = '"""Analysis step."""\nimport numpy as np\nimport statsmodels.formula.api as smf\n\n\n'
+
+
+def duplicate_code(path: Path) -> list:
+    report = qs.QualityScorer(path, session=qs.ScoringSession()).run('python')
+    return [issue.args for issue in report['issues']['major'] if issue.code == 'duplicate_code']
+
+
+def test_repetitive_script_is_not_copy_paste(tmp_path):
+    root = project(tmp_path)
+    script = write(root / 'scripts' / 'python' / 'analysis.py',
+                   '"""Fill gaps."""\nimport pandas as pd\n\ndf = pd.read_csv("a.csv")\n'
+                   + 'df["x"] = df["x"].fillna(0)\n' * 9)
+    assert duplicate_code(script) == []
+
+
+def test_copy_across_scripts_is_one_region_pair(tmp_path):
+    root = project(tmp_path)
+    a = write(root / 'scripts' / 'python' / 'a.py', HEADER + CLEAN)
+    b = write(root / 'scripts' / 'python' / 'b.py',
+              HEADER + 'SAMPLE = "main"\n\n\n' + CLEAN.replace('frame', 'data'))
+    assert duplicate_code(a) == [(6, 14, 'scripts/python/b.py', 9, 17)]
+    assert duplicate_code(b) == [(9, 17, 'scripts/python/a.py', 6, 14)]
+
+
+def test_copy_within_one_script_is_reported_on_the_later_copy(tmp_path):
+    root = project(tmp_path)
+    script = write(root / 'scripts' / 'python' / 'a.py',
+                   HEADER + CLEAN + '\n\n' + CLEAN.replace('def clean', 'def clean_again'))
+    assert duplicate_code(script) == [(18, 25, 'scripts/python/a.py', 7, 14)]
+
+
+def test_deleted_decks_leave_the_slide_index(tmp_path):
+    root = project(tmp_path)
+    deck = write(root / 'slides' / 'L1.tex', DECK)
+    copy = write(root / 'explorations' / 'drafts' / 'L1_copy.tex', DECK)
+    qs.QualityScorer(copy, session=qs.ScoringSession()).run('beamer')
+    copy.unlink()
+    copy.parent.rmdir()
+    report = qs.QualityScorer(deck, session=qs.ScoringSession()).run('beamer')
+    assert 'duplicate_slide' not in codes(report)
+
+
+def test_deleted_decks_leave_the_notation_index(tmp_path):
+    root = project(tmp_path)
+    deck = write(root / 'slides' / 'L1.tex', DECK.replace(r'\beta_i', r'\beta_{i}'))
+    for name in ('L1_copy.tex', 'L1_copy2.tex'):
+        qs.QualityScorer(write(root / 'drafts' / name, DECK),
+                         session=qs.ScoringSession()).run('beamer')
+    assert 'notation_inconsistency' in codes(
+        qs.QualityScorer(deck, session=qs.ScoringSession()).run('beamer'))
+    for path in (root / 'drafts').iterdir():
+        path.unlink()
+    (root / 'drafts').rmdir()
+    report = qs.QualityScorer(deck, session=qs.ScoringSession()).run('beamer')
+    assert 'notation_inconsistency' not in codes(report)
+
+
+def test_asset_lookups_revalidate_only_their_own_directories(tmp_path, monkeypatch):
+    root = project(tmp_path)
+    for i in range(50):
+        (root / 'figures' / f'd{i}').mkdir(parents=True)
+    session = qs.ScoringSession()
+    assert session.asset_index(root).resolve('figures/d1/plot', 'includegraphics', [''])[0] is None
+    write(root / 'figures' / 'd1' / 'plot.pdf', '')
+    monkeypatch.setattr(qs, 'INDEX_RECHECK_SECONDS', 0.0)
+    stats = []
+    real_stat = qs.os.stat
+    monkeypatch.setattr(qs.os, 'stat', lambda path, *a, **k: stats.append(path)
+                        or real_stat(path, *a, **k))
+    found, _ = session.asset_index(root).resolve('figures/d1/plot', 'includegraphics', [''])
+    assert found == 'figures/d1/plot.pdf'
+    assert len(stats) <= 2 * len(qs.GRAPHICS_EXTENSIONS)
@@ -0,0 +1,56 @@
+"""LayoutEstimator predictions on labelled sample frames.
+
+`fixtures/layout_samples.tex` holds clear-cut frames labelled
+`% overflow: yes|no`; the default estimator and the calibration must
+classify every one of them correctly. Run with `python -m pytest tests/`.
+"""
+
+import re
+import shutil
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import quality_score as qs  # noqa: E402
+
+SAMPLES = Path(__file__).resolve().parent / 'fixtures' / 'layout_samples.tex'
+
+
+def labelled_estimates():
+    content = SAMPLES.read_text(encoding='utf-8')
+    estimator = qs.LayoutEstimator.from_document(content)
+    for frame in qs.IssueDetector._parse_frames(content):
+        label = re.search(r'%\s*overflow:\s*(yes|no)\b', frame['body'])
+        if label:
+            yield frame['title'], estimator.estimate(frame), label.group(1) == 'yes'
+
+
+def test_samples_cover_both_labels():
+    labels = [overflowed for _title, _est, overflowed in labelled_estimates()]
+    assert labels.count(True) >= 4 and labels.count(False) >= 4
+
+
+def test_estimate_classifies_labelled_frames():
+    wrong = [title for title, est, overflowed in labelled_estimates()
+             if est['overflow'] != overflowed]
+    assert wrong == []
+
+
+def test_calibration_separates_labelled_frames():
+    samples = [(est['height'] / est['available'], overflowed)
+               for _title, est, overflowed in labelled_estimates()]
+    ratio = qs.calibrate_layout(samples)
+    assert all((fill > ratio) == overflowed for fill, overflowed in samples)
+    assert max(f for f, o in samples if not o) < ratio < min(f for f, o in samples if o)
+
+
+def test_calibrate_layout_cli_stores_the_ratio(tmp_path, capsys):
+    (tmp_path / '.git').mkdir()
+    deck = tmp_path / 'samples.tex'
+    shutil.copy(SAMPLES, deck)
+    assert qs.calibrate_layout_from_files([deck]) == 0
+    assert '10/10 sample frames classified correctly' in capsys.readouterr().out
+    assert qs.layout_ratio_for(tmp_path) == qs.calibrate_layout(
+        (est['height'] / est['available'], overflowed)
+        for _title, est, overflowed in labelled_estimates())